@@ -1,23 +1,40 @@
-from flask import Flask, request, jsonify, redirect
-from instagram_processor import InstagramProcesser
+from flask import Flask, request, jsonify, redirect, url_for
+from instagram_processor import InstagramProcesser, get_user_by_instagram_user_id
 import basic_display_api
+import purge
+import webhooks
 from models import User
-from utils import init_db, SessionLocal
+from settings import get_settings
+from utils import init_db, init_async_db, SessionLocal, AsyncSessionLocal
 import ssl
-import os
 
 app = Flask(__name__)
 
-# Load environment variables
-INSTAGRAM_CLIENT_ID = os.getenv("INSTAGRAM_CLIENT_ID")
-INSTAGRAM_AUTH_CALLBACK_URI = os.getenv("INSTAGRAM_AUTH_CALLBACK_URI")
+
+def sync_notified_media(instagram_user_id, media_ids):
+    """Sync the media notified by the webhook for a user, or the whole account when the notification named no media."""
+    user = get_user_by_instagram_user_id(instagram_user_id)
+    if user is None:
+        return
+    InstagramProcesser(user).run(media_ids=sorted(media_ids) if media_ids else None)
+
+
+settings = get_settings()
+webhook_coalescer = webhooks.WebhookCoalescer(
+    sync_notified_media,
+    window=settings.webhook_coalesce_seconds,
+    max_workers=settings.webhook_max_workers,
+)
+purge_queue = purge.PurgeQueue(
+    batch_size=settings.purge_batch_size, batch_pause=settings.purge_batch_pause
+)
 
 
 @app.route("/")
 def home():
     """Redirect to Instagram's auth window."""
     instagram_auth_window = basic_display_api.auth_window(
-        INSTAGRAM_CLIENT_ID, INSTAGRAM_AUTH_CALLBACK_URI
+        get_settings().instagram_client_id, get_settings().instagram_auth_callback_uri
     )
     return redirect(instagram_auth_window)
 
@@ -37,21 +54,82 @@ def callback():
         return jsonify({"error": "No authorization code provided"}), 400
 
 
+@app.route("/webhook", methods=["GET"])
+def webhook_verification():
+    # Answer the verification request sent when the webhook subscription is set up
+    verify_token = get_settings().instagram_webhook_verify_token
+    if (
+        request.args.get("hub.mode") == "subscribe"
+        and verify_token
+        and request.args.get("hub.verify_token") == verify_token
+    ):
+        return request.args.get("hub.challenge", "")
+    return jsonify({"error": "Invalid verification request"}), 403
+
+
+@app.route("/webhook", methods=["POST"])
+def webhook():
+    # Acknowledge quickly, the notified media is synced in the background once the burst of events settles
+    if not webhooks.verify_signature(
+        request.get_data(),
+        request.headers.get("X-Hub-Signature-256"),
+        get_settings().instagram_client_secret,
+    ):
+        return jsonify({"error": "Invalid signature"}), 403
+
+    events = webhooks.parse_notification(request.get_json(silent=True) or {})
+    webhook_coalescer.add(events)
+    return jsonify({"received": len(events)})
+
+
 @app.route("/deauth", methods=["POST"])
 def deauth():
     # Handle user deauthorization
-    return jsonify({"message": "User deauthorization handled successfully"})
+    return _enqueue_purge("deauth")
 
 
 @app.route("/delete", methods=["POST"])
 def delete():
     # Handle user data deletion request
-    return jsonify({"message": "User data deletion request handled successfully"})
+    return _enqueue_purge("delete")
+
+
+@app.route("/delete/status/<confirmation_code>")
+def delete_status(confirmation_code):
+    status = purge_queue.status(confirmation_code)
+    if status is None:
+        return jsonify({"error": "Unknown confirmation code"}), 404
+    return jsonify(status)
+
+
+def _enqueue_purge(reason):
+    # The data is purged in the background, the callback only records the job and returns its confirmation code
+    signed_request = purge.parse_signed_request(
+        request.form.get("signed_request"), get_settings().instagram_client_secret
+    )
+    if signed_request is None:
+        return jsonify({"error": "Invalid signed request"}), 403
+
+    instagram_user_id = str(signed_request.get("user_id"))
+    # The notified media of the user is not synced again once the purge is requested
+    webhook_coalescer.discard(instagram_user_id)
+    user = get_user_by_instagram_user_id(instagram_user_id)
+    confirmation_code = purge_queue.enqueue(user.user_id if user else None, reason)
+    return jsonify(
+        {
+            "url": url_for(
+                "delete_status", confirmation_code=confirmation_code, _external=True
+            ),
+            "confirmation_code": confirmation_code,
+        }
+    )
 
 
 if __name__ == "__main__":
     engine = init_db()
     SessionLocal.configure(bind=engine)
+    AsyncSessionLocal.configure(bind=init_async_db())
+    purge_queue.resume()
 
     context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
     context.load_cert_chain("ssl.crt", "ssl.key")
@@ -1,4 +1,14 @@
-import requests
+import concurrent.futures
+import contextvars
+import logging
+import threading
+import tracing
+from settings import get_settings
+
+try:
+    import orjson as json_parser
+except ImportError:  # orjson is optional, fall back to the standard library parser
+    import json as json_parser
 
 """
 Instagram Basic Display API helper functions.
@@ -12,9 +22,63 @@ get_user_media(): Get user media from Instagram Basic Display API.
 get_carousel_album_media(): Get the media collection in a carousel album from Instagram Basic Display API.
 refresh_access_token(): Refresh the access token.
 get_user_media_paging(): Get user media from Instagram Basic Display API using a paging URL.
+get_media(): Get a single media item from Instagram Basic Display API.
+resolve_carousel_children(): Fetch the children of carousel albums whose nested children are truncated.
+get_session(): The pooled HTTP session shared by all calls.
 """
 
-media_limit_fetch = 20  # Number of media items to fetch per request
+DEFAULT_PAGE_SIZE = 20  # Number of media items to fetch per request
+DEFAULT_MAX_ITEMS = 500  # Stop paging once this many media items are fetched
+
+# Named field projections for the media endpoints, so each sync mode requests the smallest payload it needs
+MEDIA_FIELD_PROFILES = {
+    # Enough to tell whether there is anything new
+    "ids_only": "id,timestamp",
+    # Enough to compute the description hash of each media item
+    "diff": "id,caption,media_type,timestamp",
+    # Fields that can change after a media item is published (edited caption, re-signed CDN urls), of the albums' children too
+    "refresh": "id,caption,media_url,thumbnail_url,children{id,media_url,thumbnail_url}",
+    # Everything needed to describe and store a media item
+    "full": "caption,id,media_type,media_url,permalink,thumbnail_url,timestamp,username,children{id,media_type,media_url,permalink,thumbnail_url,timestamp}",
+}
+CAROUSEL_CHILDREN_FIELDS = "id,is_shared_to_feed,media_type,media_url,permalink,thumbnail_url,timestamp,username"
+
+logger = logging.getLogger(__name__)
+
+max_connections = 16  # Size of the pooled keep-alive connections to graph.instagram.com
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    A single pooled session shared by all calls, so concurrent requests reuse TCP/TLS connections.
+    It is created on first use, importing this module does not import requests.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                for prefix in ("https://", "http://"):
+                    session.mount(
+                        prefix,
+                        HTTPAdapter(
+                            pool_connections=max_connections,
+                            pool_maxsize=max_connections,
+                        ),
+                    )
+                _session = session
+    return _session
+
+
+def _decode(response):
+    # Decode the raw response body once, with orjson when it is installed
+    return json_parser.loads(response.content)
 
 
 def auth_window(client_id, redirect_uri):
@@ -28,7 +92,7 @@ def auth_window(client_id, redirect_uri):
     Returns:
         str: The Instagram authorization URL.
     """
-    instagram_auth_url = f"https://api.instagram.com/oauth/authorize?client_id={client_id}&redirect_uri={redirect_uri}&scope=user_profile,user_media&response_type=code"
+    instagram_auth_url = f"{get_settings().instagram_api_url}/oauth/authorize?client_id={client_id}&redirect_uri={redirect_uri}&scope=user_profile,user_media&response_type=code"
     return instagram_auth_url
 
 
@@ -46,7 +110,7 @@ def get_short_access_token(client_id, client_secret, redirect_uri, code):
     Returns:
         dict: The response JSON containing the access token and expiration time.
     """
-    url = "https://api.instagram.com/oauth/access_token"
+    url = f"{get_settings().instagram_api_url}/oauth/access_token"
     payload = {
         "client_id": client_id,
         "client_secret": client_secret,
@@ -54,10 +118,10 @@ def get_short_access_token(client_id, client_secret, redirect_uri, code):
         "redirect_uri": redirect_uri,
         "code": code,
     }
-    response = requests.post(url, data=payload)
+    response = get_session().post(url, data=payload)
 
     if response.status_code == 200:
-        return response.json()
+        return _decode(response)
     else:
         raise Exception(
             "Failed to retrieve access token. Error: {}".format(response.text)
@@ -77,7 +141,7 @@ def exchange_for_long_lived_token(short_lived_token, client_secret):
         dict: The response JSON containing the long-lived access token and expiration time.
     """
 
-    endpoint = "https://graph.instagram.com/access_token"
+    endpoint = f"{get_settings().instagram_graph_api_url}/access_token"
 
     params = {
         "grant_type": "ig_exchange_token",
@@ -85,10 +149,10 @@ def exchange_for_long_lived_token(short_lived_token, client_secret):
         "access_token": short_lived_token,
     }
 
-    response = requests.get(endpoint, params=params)
+    response = get_session().get(endpoint, params=params)
 
     if response.status_code == 200:
-        return response.json()
+        return _decode(response)
     else:
         raise Exception(
             "Failed to exchange for long-lived token. Error: {}".format(response.text)
@@ -106,56 +170,75 @@ def get_user_profile(access_token):
     returns:
         dict: The response JSON containing the user profile data.
     """
-    endpoint = "https://graph.instagram.com/me"
+    endpoint = f"{get_settings().instagram_graph_api_url}/me"
 
     params = {
         "fields": "id,username,account_type,media_count",
         "access_token": access_token,
     }
 
-    response = requests.get(endpoint, params=params)
+    response = get_session().get(endpoint, params=params)
 
     if response.status_code == 200:
-        return response.json()
+        return _decode(response)
     else:
         raise Exception(
             "Failed to retrieve user profile data. Error: {}".format(response.text)
         )
 
 
-def get_user_media(access_token):
+def get_user_media(
+    access_token,
+    profile="full",
+    page_size=DEFAULT_PAGE_SIZE,
+    max_items=DEFAULT_MAX_ITEMS,
+    until=None,
+):
     """
     Get user media from Instagram Basic Display API.
-    This includes caption,id,media_type,media_url,permalink,thumbnail_url,timestamp for each media item.
+    The fields fetched for each media item are set by the field profile (see MEDIA_FIELD_PROFILES).
 
     Args:
         access_token (str): The user's access token.
+        profile (str): Optional. The name of the field profile to fetch.
+        page_size (int): Optional. The number of media items to fetch per request.
+        max_items (int): Optional. Stop paging once this many media items are fetched. None pages the whole account.
+        until (Callable): Optional. Called with the media items of each page, stop paging once it returns True.
 
     Returns:
         dict: The response JSON containing the user media data.
     """
-    endpoint = "https://graph.instagram.com/me/media"
+    endpoint = f"{get_settings().instagram_graph_api_url}/me/media"
 
     params = {
-        "fields": "caption,id,media_type,media_url,permalink,thumbnail_url,timestamp,username,children{id,media_type,media_url,permalink,thumbnail_url,timestamp}",
+        "fields": MEDIA_FIELD_PROFILES[profile],
         "access_token": access_token,
-        "limit": media_limit_fetch,
+        "limit": page_size,
     }
 
-    response = requests.get(endpoint, params=params)
-
-    limit = 500
+    with tracing.span("graph_api.media_page", page_index=0, profile=profile):
+        response = get_session().get(endpoint, params=params)
+        tracing.set_attributes(http_status=response.status_code)
 
     if response.status_code == 200:
-        result = response.json()
+        result = _decode(response)
+        # The first page is passed to until even without paging, e.g. for the lookup of an incremental sync
+        stop = until is not None and until(result["data"])
         # Check if there are more pages of media. If so, fetch them and append to the result.
-        if "paging" in result:
+        if "paging" in result and not stop:
+            page_index = 0
             while "next" in result["paging"]:
-                if len(result["data"]) >= limit:
+                if max_items is not None and len(result["data"]) >= max_items:
                     break
+                page_index += 1
                 next_page_url = result["paging"]["next"]
-                next_page_data = get_user_media_paging(next_page_url)
+                with tracing.span(
+                    "graph_api.media_page", page_index=page_index, profile=profile
+                ):
+                    next_page_data = get_user_media_paging(next_page_url)
                 result["data"].extend(next_page_data["data"])
+                if until and until(next_page_data["data"]):
+                    break
                 if "paging" in next_page_data:
                     result["paging"] = next_page_data["paging"]
                 else:
@@ -181,23 +264,84 @@ def get_carousel_album_media(album_id, access_token):
         dict: The response JSON containing the carousel album media data.
     """
 
-    endpoint = f"https://graph.instagram.com/{album_id}/children"
+    endpoint = f"{get_settings().instagram_graph_api_url}/{album_id}/children"
 
     params = {
-        "fields": "id,is_shared_to_feed,media_type,media_url,permalink,thumbnail_url,timestamp,username",
+        "fields": CAROUSEL_CHILDREN_FIELDS,
         "access_token": access_token,
     }
 
-    response = requests.get(endpoint, params=params)
+    with tracing.span("graph_api.children", media_id=album_id, page_index=0):
+        response = get_session().get(endpoint, params=params)
+        tracing.set_attributes(http_status=response.status_code)
 
     if response.status_code == 200:
-        return response.json()
+        result = _decode(response)
+        # Follow the paging of albums with more children than fit in one page
+        page_index = 0
+        while "next" in result.get("paging", {}):
+            page_index += 1
+            with tracing.span(
+                "graph_api.children", media_id=album_id, page_index=page_index
+            ):
+                next_page_data = get_user_media_paging(result["paging"]["next"])
+            result["data"].extend(next_page_data["data"])
+            result["paging"] = next_page_data.get("paging", {})
+        return result
     else:
         raise Exception(
             "Failed to retrieve carousel album media. Error: {}".format(response.text)
         )
 
 
+def resolve_carousel_children(media_list, access_token, max_workers=8):
+    """
+    Complete the children of carousel albums whose nested children are missing or truncated (have a next page).
+    The children are fetched concurrently across albums, with at most max_workers requests in flight.
+    The albums in media_list are updated in place. Albums that fail to resolve keep their nested children.
+
+    Args:
+        media_list (list[dict]): The media items, as returned by get_user_media().
+        access_token (str): The user's access token.
+        max_workers (int): Optional. The maximum number of concurrent requests.
+
+    Returns:
+        int: The number of albums whose children were fetched.
+    """
+    albums = [
+        media
+        for media in media_list
+        if media.get("media_type") == "CAROUSEL_ALBUM"
+        and ("children" not in media or "next" in media["children"].get("paging", {}))
+    ]
+    if not albums:
+        return 0
+
+    resolved = 0
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(max_workers, len(albums))
+    ) as executor:
+        futures = {
+            # Each request runs in a copy of the caller's context, to continue its trace
+            executor.submit(
+                contextvars.copy_context().run,
+                get_carousel_album_media,
+                album["id"],
+                access_token,
+            ): album
+            for album in albums
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                futures[future]["children"] = {"data": future.result()["data"]}
+                resolved += 1
+            except Exception as e:
+                logger.error(
+                    f"Failed to resolve the children of album {futures[future]['id']}: {e}"
+                )
+    return resolved
+
+
 def refresh_access_token(long_lived_token):
     """
     Refresh the access token.
@@ -209,14 +353,14 @@ def refresh_access_token(long_lived_token):
     Returns:
         dict: The response JSON containing the refreshed access token.
     """
-    url = "https://graph.instagram.com/refresh_access_token"
+    url = f"{get_settings().instagram_graph_api_url}/refresh_access_token"
 
     params = {"grant_type": "ig_refresh_token", "access_token": long_lived_token}
 
-    response = requests.get(url, params=params)
+    response = get_session().get(url, params=params)
 
     if response.status_code == 200:
-        return response.json()
+        return _decode(response)
     else:
         raise Exception(
             "Failed to refresh access token. Error: {}".format(response.text)
@@ -233,16 +377,46 @@ def get_user_media_paging(next_page_url):
     Returns:
         dict: The response JSON containing the user media data.
     """
-    response = requests.get(next_page_url)
+    response = get_session().get(next_page_url)
+    tracing.set_attributes(http_status=response.status_code)
 
     if response.status_code == 200:
-        return response.json()
+        return _decode(response)
     else:
         raise Exception(
             "Failed to retrieve user media. Error: {}".format(response.text)
         )
 
 
+def get_media(media_id, access_token, profile="full"):
+    """
+    Get a single media item from Instagram Basic Display API.
+
+    Args:
+        media_id (str): The ID of the media item.
+        access_token (str): The user's access token.
+        profile (str): Optional. The name of the field profile to fetch (see MEDIA_FIELD_PROFILES).
+
+    Returns:
+        dict: The response JSON containing the media data.
+    """
+    endpoint = f"{get_settings().instagram_graph_api_url}/{media_id}"
+
+    params = {
+        "fields": MEDIA_FIELD_PROFILES[profile],
+        "access_token": access_token,
+    }
+
+    with tracing.span("graph_api.media", media_id=media_id, profile=profile):
+        response = get_session().get(endpoint, params=params)
+        tracing.set_attributes(http_status=response.status_code)
+
+    if response.status_code == 200:
+        return _decode(response)
+    else:
+        raise Exception("Failed to retrieve media. Error: {}".format(response.text))
+
+
 if __name__ == "__main__":
     access_token = ""
     media = get_user_media(access_token)
@@ -0,0 +1,101 @@
+import argparse
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import instagram_processor  # noqa: E402
+import json_validation  # noqa: E402
+import llm_providers  # noqa: E402
+import settings  # noqa: E402
+import usage  # noqa: E402
+from bench_field_profiles import synthetic_media  # noqa: E402
+from utils import set_llm_provider  # noqa: E402
+
+"""
+Offline load test of the description stage (construct_instagram_media).
+
+The model calls are answered by llm_providers.FakeLLMProvider at a realistic simulated latency, or replayed
+from a cassette recorded with LLM_PROVIDER=record. Images are sent as CDN urls and near-duplicate lookups are
+disabled, so nothing external (network, database) is needed.
+
+    python benchmarks/bench_descriptions.py --media 100 --latency 2.5 --jitter 1.0 --workers 14
+    python benchmarks/bench_descriptions.py --media 100 --cassette llm_cassette.jsonl --replay-latency
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load test the description stage against an offline LLM provider."
+    )
+    parser.add_argument(
+        "--media", type=int, default=100, help="media items to describe"
+    )
+    parser.add_argument("--workers", type=int, default=14, help="description workers")
+    parser.add_argument(
+        "--latency", type=float, default=2.5, help="mean fake call latency, seconds"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=1.0, help="fake call latency jitter, seconds"
+    )
+    parser.add_argument("--cassette", help="replay this cassette instead of faking")
+    parser.add_argument(
+        "--replay-latency",
+        action="store_true",
+        help="sleep for the recorded latency of replayed calls",
+    )
+    parser.add_argument(
+        "--album-mode",
+        default=settings.get_settings().album_description_mode,
+        choices=("text", "montage", "images"),
+    )
+    args = parser.parse_args()
+
+    if args.cassette:
+        provider = llm_providers.RecordReplayProvider(
+            args.cassette, replay_latency=args.replay_latency
+        )
+    else:
+        provider = llm_providers.FakeLLMProvider(
+            latency=args.latency, latency_jitter=args.jitter
+        )
+    set_llm_provider(provider)
+    config = settings.configure(
+        image_policy="original",
+        video_policy="thumbnail",
+        perceptual_hash_scope="off",
+        album_description_mode=args.album_mode,
+    )
+
+    media = [
+        json_validation.InstagramMedia.from_trusted_json(item)
+        for item in synthetic_media(args.media)
+    ]
+
+    tracker = usage.UsageTracker(
+        "benchmark_user",
+        prompt_price=config.llm_prompt_price,
+        completion_price=config.llm_completion_price,
+    )
+    start = perf_counter()
+    with usage.track(tracker):
+        records = instagram_processor.construct_instagram_media(
+            "benchmark_user", media, num_workers=args.workers
+        )
+    seconds = perf_counter() - start
+
+    totals = tracker.totals()
+    described = sum(1 for record in records if record.media_description)
+    print(f"{len(records)} records, {described} described in {seconds:.2f}s")
+    print(f"{totals.requests} calls ({totals.requests / seconds:.1f}/s)")
+    for stage, stage_usage in sorted(tracker.stages.items()):
+        print(
+            f"{stage:16} {stage_usage.requests:5} calls {stage_usage.images:6} images "
+            f"{stage_usage.prompt_tokens:10,} prompt {stage_usage.completion_tokens:8,} completion "
+            f"${stage_usage.cost:.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
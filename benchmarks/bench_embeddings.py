@@ -0,0 +1,220 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import embedding_storage  # noqa: E402
+
+"""
+Size, recall and latency of the embedding storage modes (see embedding_storage), against exact float32 search.
+
+The embeddings are synthetic by default: clusters of unit vectors whose variance decays across the dimensions, as in
+embeddings trained to be truncated (text-embedding-3). Real embeddings can be given as an (n, 1536) .npy file, the
+queries are then noisy copies of random rows. The search is brute force in numpy, with the encodings of each mode:
+
+    - full: float32 cosine, the ground truth
+    - halfvec: float16 vectors, cosine computed in float32 as pgvector does
+    - binary: hamming distance of the sign bits, without re-ranking, and re-ranking BINARY_RERANK_FACTOR candidates
+      per result with the float16 vectors
+    - reduced: cosine of the first REDUCED_DIMENSIONS dimensions, normalized again
+
+Reported, for each: the bytes per row of the stored columns and of the indexed column (as pgvector stores them, which is
+what an HNSW index holds per row besides its graph), the recall@k against full, and the search time per query.
+The search time is that of a sequential scan in numpy, it is indicative of the cost of the distance, not of an HNSW
+search in postgres, where the smaller values also mean fewer pages read.
+
+The database path is not measured: neither the HNSW index scan, its recall against exact search, nor the user_id
+filter of instagram_media_crud.search_similar_media_by_user_id, which is applied to the rows of all users the index
+returns (see HNSW_ITERATIVE_SCAN in embedding_storage).
+
+    python benchmarks/bench_embeddings.py --rows 20000 --queries 200 --k 10
+    python benchmarks/bench_embeddings.py --embeddings embeddings.npy
+"""
+
+# pgvector header of a vector, halfvec or bit value
+VALUE_HEADER_BYTES = 8
+
+
+def synthetic_embeddings(rows: int, dimensions: int, clusters: int, seed: int):
+    """Clustered unit vectors whose per dimension scale decays, most of the information is in the first dimensions."""
+    rng = np.random.default_rng(seed)
+    scale = np.exp(-np.arange(dimensions) / (dimensions / 6)).astype(np.float32)
+    centers = rng.standard_normal((clusters, dimensions)).astype(np.float32)
+    embeddings = centers[rng.integers(clusters, size=rows)] + 0.6 * rng.standard_normal(
+        (rows, dimensions)
+    ).astype(np.float32)
+    return normalize(embeddings * scale)
+
+
+def make_queries(embeddings, count: int, noise: float, seed: int):
+    """Noisy copies of random rows, normalized."""
+    rng = np.random.default_rng(seed + 1)
+    queries = embeddings[rng.integers(len(embeddings), size=count)]
+    return normalize(
+        queries
+        + noise
+        * np.linalg.norm(queries, axis=1, keepdims=True)
+        * rng.standard_normal(queries.shape).astype(np.float32)
+        / np.sqrt(queries.shape[1])
+    )
+
+
+def normalize(vectors):
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def top_k(scores, k: int):
+    """Indices of the k highest scores of each row, best first."""
+    candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1)
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def popcount(packed):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(packed)
+    return np.unpackbits(packed, axis=-1)
+
+
+class Mode:
+    def __init__(self, name: str, stored_bytes: int, indexed_bytes: int, search):
+        self.name = name
+        self.stored_bytes = stored_bytes
+        self.indexed_bytes = indexed_bytes
+        self.search = search
+
+
+def build_modes(embeddings, k: int, rerank_factor: int) -> list[Mode]:
+    dimensions = embeddings.shape[1]
+    reduced_dimensions = embedding_storage.REDUCED_DIMENSIONS
+    # The float16 values, the distances are computed in float32
+    half = embeddings.astype(np.float16).astype(np.float32)
+    bits = np.packbits(embeddings > 0, axis=1)
+    reduced = normalize(embeddings[:, :reduced_dimensions])
+
+    # The numpy encodings are those of embedding_storage
+    sample = embeddings[0].tolist()
+    assert np.array_equal(
+        np.array(list(embedding_storage.quantize_binary(sample)), dtype=int),
+        np.unpackbits(bits[0])[:dimensions],
+    )
+    assert np.allclose(
+        embedding_storage.reduce_dimensions(sample, reduced_dimensions),
+        reduced[0],
+        atol=1e-6,
+    )
+
+    def full(query):
+        return top_k(query @ embeddings.T, k)
+
+    def halfvec(query):
+        return top_k(query @ half.T, k)
+
+    def hamming(query):
+        query_bits = np.packbits(query > 0, axis=1)
+        distances = np.stack(
+            [popcount(np.bitwise_xor(bits, row)).sum(axis=1) for row in query_bits]
+        )
+        return distances
+
+    def binary(query):
+        return top_k(-hamming(query).astype(np.float32), k)
+
+    def binary_rerank(query):
+        candidates = top_k(-hamming(query).astype(np.float32), k * rerank_factor)
+        scores = np.einsum("qd,qcd->qc", query, half[candidates], optimize=True)
+        return np.take_along_axis(candidates, top_k(scores, k), axis=1)
+
+    def reduced_search(query):
+        return top_k(normalize(query[:, :reduced_dimensions]) @ reduced.T, k)
+
+    vector_bytes = VALUE_HEADER_BYTES + 4 * dimensions
+    half_bytes = VALUE_HEADER_BYTES + 2 * dimensions
+    bit_bytes = VALUE_HEADER_BYTES + (dimensions + 7) // 8
+    return [
+        Mode("full", vector_bytes, vector_bytes, full),
+        Mode("halfvec", half_bytes, half_bytes, halfvec),
+        Mode("binary (no re-rank)", bit_bytes + half_bytes, bit_bytes, binary),
+        Mode(
+            f"binary (re-rank x{rerank_factor})",
+            bit_bytes + half_bytes,
+            bit_bytes,
+            binary_rerank,
+        ),
+        Mode(
+            f"reduced ({reduced_dimensions})",
+            VALUE_HEADER_BYTES + 4 * reduced_dimensions,
+            VALUE_HEADER_BYTES + 4 * reduced_dimensions,
+            reduced_search,
+        ),
+    ]
+
+
+def run(modes: list[Mode], queries, k: int, batch: int) -> None:
+    truth = None
+    print(
+        f"{'mode':<22}{'bytes/row':>10}{'indexed':>9}{f'recall@{k}':>11}{'ms/query':>10}"
+    )
+    for mode in modes:
+        results = []
+        start = time.perf_counter()
+        for i in range(0, len(queries), batch):
+            results.append(mode.search(queries[i : i + batch]))
+        elapsed = time.perf_counter() - start
+        results = np.concatenate(results)
+        if truth is None:
+            truth = results
+        recall = np.mean(
+            [
+                len(set(result) & set(expected)) / k
+                for result, expected in zip(results, truth)
+            ]
+        )
+        print(
+            f"{mode.name:<22}{mode.stored_bytes:>10}{mode.indexed_bytes:>9}"
+            f"{recall:>11.3f}{1000 * elapsed / len(queries):>10.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the size, recall and latency of the embedding storage modes."
+    )
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument(
+        "--rerank-factor", type=int, default=embedding_storage.BINARY_RERANK_FACTOR
+    )
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument(
+        "--noise", type=float, default=0.5, help="relative noise of the queries"
+    )
+    parser.add_argument(
+        "--embeddings", help="an (n, dimensions) .npy file of real embeddings"
+    )
+    parser.add_argument("--batch", type=int, default=20, help="queries per search")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.embeddings:
+        embeddings = normalize(np.load(args.embeddings).astype(np.float32))
+    else:
+        embeddings = synthetic_embeddings(
+            args.rows, embedding_storage.EMBEDDING_DIMENSIONS, args.clusters, args.seed
+        )
+    queries = make_queries(embeddings, args.queries, args.noise, args.seed)
+    print(
+        f"{len(embeddings)} rows of {embeddings.shape[1]} dimensions, {len(queries)} queries"
+    )
+    run(
+        build_modes(embeddings, args.k, args.rerank_factor), queries, args.k, args.batch
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from basic_display_api import MEDIA_FIELD_PROFILES  # noqa: E402
+from mock_graph_api import project, synthetic_media  # noqa: E402
+
+"""
+Estimates the /me/media response bytes transferred per sync for each field profile.
+
+A synthetic account is generated by mock_graph_api.synthetic_media, and each sync mode is simulated by projecting the
+media onto the fields its profile requests and paging it with the given page size. Each mode is compared to listing the
+whole account with the full fields, which every sync did before the field profiles, except the new post check, which is
+compared to the incremental sync it replaces.
+
+    python benchmarks/bench_field_profiles.py --media 500 --new 5 --page-size 20
+"""
+
+
+def listing_bytes(media, profile, page_size):
+    """Bytes of all /me/media pages for the profile, and the number of pages."""
+    total, pages = 0, 0
+    for i in range(0, len(media), page_size):
+        page = {
+            "data": [
+                project(item, MEDIA_FIELD_PROFILES[profile])
+                for item in media[i : i + page_size]
+            ],
+            "paging": {
+                "cursors": {"before": "x" * 40, "after": "x" * 40},
+                "next": "https://graph.instagram.com/v20.0/me/media?after=" + "x" * 200,
+            },
+        }
+        total += len(json.dumps(page))
+        pages += 1
+    return total, pages
+
+
+def item_bytes(media, profile):
+    return sum(
+        len(json.dumps(project(item, MEDIA_FIELD_PROFILES[profile]))) for item in media
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Estimate /me/media bytes per sync for each field profile."
+    )
+    parser.add_argument(
+        "--media", type=int, default=500, help="media items in the account"
+    )
+    parser.add_argument(
+        "--new", type=int, default=5, help="new media since the last sync"
+    )
+    parser.add_argument(
+        "--expiring", type=int, default=100, help="stored media with expiring urls"
+    )
+    parser.add_argument("--page-size", type=int, default=20)
+    args = parser.parse_args()
+
+    media = synthetic_media(args.media)
+
+    # Before the field profiles, every sync listed the whole account with the full fields, as a first sync does
+    first_sync, first_pages = listing_bytes(media, "full", args.page_size)
+    # An incremental sync lists the diff fields until the first page whose media are all stored
+    diff_pages = min(args.new // args.page_size + 2, first_pages)
+    diff_listing, _ = listing_bytes(
+        media[: diff_pages * args.page_size], "diff", args.page_size
+    )
+    incremental = diff_listing + item_bytes(media[: args.new], "full")
+    old_refresh = first_sync
+    # The refresh pages /me/media until every expiring media is found, at worst the whole account
+    refresh, refresh_pages = listing_bytes(media, "refresh", args.page_size)
+    ids_only, ids_pages = listing_bytes(media[:1], "ids_only", 1)
+
+    rows = [
+        ("first sync (full)", first_pages, first_sync, first_sync),
+        (
+            f"incremental, {args.new} new (diff + full)",
+            diff_pages + args.new,
+            first_sync,
+            incremental,
+        ),
+        (
+            f"refresh, {args.expiring} expiring (refresh)",
+            refresh_pages,
+            old_refresh,
+            refresh,
+        ),
+        # Compared to the incremental sync it replaces when there is nothing new
+        ("new post check (ids_only, limit=1)", ids_pages, incremental, ids_only),
+    ]
+    print(
+        f"{'sync mode':45} {'calls':>6} {'bytes (before)':>14} {'bytes (profile)':>16} {'saved':>7}"
+    )
+    for name, calls, before, after in rows:
+        print(
+            f"{name:45} {calls:>6} {before:>14,} {after:>16,} {1 - after / before:>7.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
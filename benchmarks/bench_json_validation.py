@@ -0,0 +1,58 @@
+import argparse
+import json
+import os
+import sys
+from timeit import repeat
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json_validation  # noqa: E402
+from basic_display_api import json_parser  # noqa: E402
+from bench_field_profiles import synthetic_media  # noqa: E402
+
+"""
+Microbenchmark of decoding and validating a /me/media page.
+
+    before: json.loads + InstagramMediaList(**page), the validated models are discarded and the dicts passed downstream
+    after:  a single decode (orjson when installed) + parse_json_types in full, sample and skip modes
+
+    python benchmarks/bench_json_validation.py --items 500
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark decoding and validating a /me/media page."
+    )
+    parser.add_argument("--items", type=int, default=500, help="media items per page")
+    parser.add_argument("--number", type=int, default=20, help="runs per measurement")
+    args = parser.parse_args()
+
+    page = json.dumps({"data": synthetic_media(args.items)}).encode()
+
+    def before():
+        data = json.loads(page)
+        json_validation.InstagramMediaList(**data)
+        return data["data"]
+
+    def after(mode):
+        return json_validation.parse_json_types(
+            json_parser.loads(page), json_validation.InstagramMediaList, mode=mode
+        ).data
+
+    cases = [
+        ("before: json + validate and discard", before),
+        (f"after: {json_parser.__name__} + full", lambda: after("full")),
+        (f"after: {json_parser.__name__} + sample", lambda: after("sample")),
+        (f"after: {json_parser.__name__} + skip", lambda: after("skip")),
+    ]
+    print(f"{len(page):,} byte page with {args.items} items")
+    baseline = None
+    for name, case in cases:
+        best = min(repeat(case, number=args.number, repeat=5)) / args.number
+        baseline = baseline or best
+        print(f"{name:40} {best * 1000:8.2f} ms/page {baseline / best:6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
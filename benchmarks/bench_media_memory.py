@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json_validation  # noqa: E402
+import instagram_processor  # noqa: E402
+from bench_field_profiles import synthetic_media  # noqa: E402
+
+"""
+Peak memory of the in-flight media between fetch_data and save_data_to_db.
+
+    before: raw json dicts mutated with descriptions, copied into the keyword arguments of the ORM InstagramMedia
+            objects. The arguments are kept as plain dicts, without the ORM instances and their instance state, so
+            this is a lower bound of the old path.
+    after:  typed json_validation.InstagramMedia objects turned into slotted InstagramMediaRecord objects
+
+    python benchmarks/bench_media_memory.py --items 10000
+"""
+
+DESCRIPTION = "A detailed paragraph describing the image. " * 10
+
+
+def before(media_list):
+    media_objs = []
+    for media in media_list:
+        for child in media.get("children", {}).get("data", []):
+            child["caption"] = media.get("caption")
+            child["media_description"] = DESCRIPTION
+            media_objs.append(_row_from_dict(child, parent_media_id=media["id"]))
+        media["media_description"] = DESCRIPTION
+        media_objs.append(_row_from_dict(media))
+    return media_objs
+
+
+def _row_from_dict(media_dict, parent_media_id=None):
+    # The keyword arguments the old path passed to InstagramMedia, with the same derived columns as the records
+    return dict(
+        user_id="benchmark_user",
+        media_id=media_dict["id"],
+        publish_timestamp=datetime.fromisoformat(media_dict["timestamp"]),
+        media_type=media_dict["media_type"],
+        media_url=media_dict["media_url"],
+        media_description=media_dict.get("media_description"),
+        description_hash=instagram_processor.compute_description_hash(
+            media_dict["media_type"], media_dict.get("caption")
+        ),
+        permalink=media_dict.get("permalink"),
+        thumbnail_url=media_dict.get("thumbnail_url"),
+        url_expires_at=instagram_processor.parse_url_expiry(
+            media_dict["media_url"], media_dict.get("thumbnail_url")
+        ),
+        caption=media_dict.get("caption"),
+        parent_media_id=parent_media_id,
+    )
+
+
+def after(media_list):
+    typed_media = json_validation.parse_json_types(
+        {"data": media_list}, json_validation.InstagramMediaList, mode="skip"
+    ).data
+    media_objs = []
+    for media in typed_media:
+        children = media.children.data if media.children else []
+        for child in children:
+            media_objs.append(
+                instagram_processor._helper_construct_media(
+                    child,
+                    "benchmark_user",
+                    media_description=DESCRIPTION,
+                    caption=media.caption,
+                    parent_media_id=media.id,
+                )
+            )
+        media_objs.append(
+            instagram_processor._helper_construct_media(
+                media, "benchmark_user", media_description=DESCRIPTION
+            )
+        )
+    return media_objs
+
+
+def peak_memory(pipeline, payload):
+    media_list = json.loads(payload)
+    tracemalloc.start()
+    media_objs = pipeline(media_list)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(media_objs), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure peak memory of the in-flight media representation."
+    )
+    parser.add_argument("--items", type=int, default=10000, help="media items")
+    args = parser.parse_args()
+
+    payload = json.dumps(synthetic_media(args.items))
+    for name, pipeline in (
+        ("before: dicts + kwargs", before),
+        ("after: records", after),
+    ):
+        rows, peak = peak_memory(pipeline, payload)
+        print(f"{name:22} {rows:>8} rows {peak / 2**20:8.1f} MiB peak")
+
+
+if __name__ == "__main__":
+    main()
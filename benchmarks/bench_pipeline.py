@@ -0,0 +1,194 @@
+import argparse
+import os
+import resource
+import sys
+import uuid
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import instagram_processor  # noqa: E402
+import llm_providers  # noqa: E402
+import profiling  # noqa: E402
+import settings  # noqa: E402
+from mock_graph_api import MockGraphAPI  # noqa: E402
+from models.user import User  # noqa: E402
+from utils import SessionLocal, init_db, set_llm_provider  # noqa: E402
+
+"""
+Offline benchmark of the full InstagramProcesser pipeline.
+
+A synthetic account is served by a local mock Graph API (mock_graph_api.py), the model calls are answered by
+llm_providers.FakeLLMProvider, and the media is saved to a local PostgreSQL database (DATABASE_URI) holding the schema.
+Each run syncs a new user stage by stage (fetch_data, extract_and_preprocess, save_data_to_db, enrich), then
+InstagramProcesser.run is measured end to end on another new user, and again on the same user (an incremental
+sync with nothing new).
+
+Reported: the p50/p99 seconds of each stage across runs and the media/sec of those that process media (the incremental
+run processes none, so it has no rate), the API calls and their p50/p99 latency,
+the model calls and their p50/p99 latency, and the peak RSS of the process.
+
+    python benchmarks/bench_pipeline.py --media 200 --page-size 25 --api-latency 0.05 --api-error-rate 0.01 --llm-latency 2 --runs 3
+"""
+
+
+class LatencyRecordingProvider(llm_providers.LLMProvider):
+    """Wraps a provider to record the latency of every call."""
+
+    def __init__(self, provider: llm_providers.LLMProvider) -> None:
+        super().__init__(provider.timeout)
+        self.provider = provider
+        self.latencies = []
+
+    def complete(self, model, messages, timeout=None):
+        start = perf_counter()
+        response = self.provider.complete(model, messages, timeout)
+        self.latencies.append(perf_counter() - start)
+        self._record_usage(response.usage)
+        return response
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the InstagramProcesser pipeline offline."
+    )
+    parser.add_argument("--media", type=int, default=200, help="media per account")
+    parser.add_argument("--page-size", type=int, default=25, help="/me/media page size")
+    parser.add_argument("--carousel-ratio", type=float, default=0.3)
+    parser.add_argument("--video-ratio", type=float, default=0.1)
+    parser.add_argument(
+        "--api-latency", type=float, default=0.05, help="mock API latency, seconds"
+    )
+    parser.add_argument(
+        "--api-error-rate", type=float, default=0.0, help="fraction of API 500s"
+    )
+    parser.add_argument(
+        "--llm-latency", type=float, default=2.0, help="fake model latency, seconds"
+    )
+    parser.add_argument(
+        "--llm-jitter", type=float, default=0.5, help="fake model latency jitter"
+    )
+    parser.add_argument("--runs", type=int, default=3, help="runs per measurement")
+    parser.add_argument(
+        "--profile",
+        choices=profiling.PROFILE_MODES,
+        default="off",
+        help="profile the stages of the measured runs (see profiling.py)",
+    )
+    args = parser.parse_args()
+
+    api = MockGraphAPI(
+        media=args.media,
+        carousel_ratio=args.carousel_ratio,
+        video_ratio=args.video_ratio,
+        latency=args.api_latency,
+        error_rate=args.api_error_rate,
+    )
+    settings.configure(
+        instagram_graph_api_url=api.start(),
+        media_page_size=args.page_size,
+        media_max_items=args.media,
+    )
+
+    provider = LatencyRecordingProvider(
+        llm_providers.FakeLLMProvider(
+            latency=args.llm_latency, latency_jitter=args.llm_jitter
+        )
+    )
+    set_llm_provider(provider)
+    SessionLocal.configure(bind=init_db())
+    instagram_processor.get_instagram_access_token = _get_bench_access_token
+
+    stage_seconds = {}
+    stage_items = {}
+
+    def measure(stage, function, *function_args):
+        start = perf_counter()
+        result = function(*function_args)
+        stage_seconds.setdefault(stage, []).append(perf_counter() - start)
+        return result
+
+    api.reset_stats()
+    for _ in range(args.runs):
+        processor = _processor()
+        media = measure("fetch_data", processor.fetch_data)
+        stage_items["fetch_data"] = len(media)
+        records = measure(
+            "extract_and_preprocess", processor.extract_and_preprocess, media
+        )
+        stage_items["extract_and_preprocess"] = len(records)
+        measure("save_data_to_db", processor.save_data_to_db, records)
+        stage_items["save_data_to_db"] = len(records)
+        measure("enrich", processor.enrich)
+
+        processor = _processor()
+        measure("run (full sync)", processor.run, "sync", args.profile)
+        stage_items["run (full sync)"] = len(media)
+        measure("run (incremental)", processor.run, "sync", args.profile)
+
+    api.stop()
+
+    print(
+        f"{args.media} media, {args.runs} runs, API latency {args.api_latency}s "
+        f"error rate {args.api_error_rate}, model latency {args.llm_latency}s"
+    )
+    print(f"{'stage':26} {'p50 s':>9} {'p99 s':>9} {'items/s':>9}")
+    for stage, seconds in stage_seconds.items():
+        p50 = _percentile(seconds, 0.5)
+        items_per_second = (
+            f"{stage_items[stage] / p50:9.1f}" if stage in stage_items else " " * 9
+        )
+        print(
+            f"{stage:26} {p50:9.3f} {_percentile(seconds, 0.99):9.3f} {items_per_second}"
+        )
+
+    print(
+        f"API calls: {sum(api.calls.values())} {dict(api.calls)} {dict(api.statuses)}, "
+        f"p50 {_percentile(api.request_seconds, 0.5) * 1000:.1f} ms "
+        f"p99 {_percentile(api.request_seconds, 0.99) * 1000:.1f} ms"
+    )
+    print(
+        f"Model calls: {provider.usage.requests}, "
+        f"{provider.usage.prompt_tokens:,} prompt + {provider.usage.completion_tokens:,} completion tokens, "
+        f"p50 {_percentile(provider.latencies, 0.5):.2f} s "
+        f"p99 {_percentile(provider.latencies, 0.99):.2f} s"
+    )
+    # ru_maxrss is in KiB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Peak RSS: {peak_rss:.1f} MiB")
+
+
+def _processor() -> instagram_processor.InstagramProcesser:
+    """A processor for a new user, built by InstagramProcesser.__init__ with a token of the benchmark's token store."""
+    user_id = f"bench-{uuid.uuid4()}"
+    _tokens[user_id] = BenchToken(auth_info={"access_token": f"token-{user_id}"})
+    return instagram_processor.InstagramProcesser(
+        User(user_id=user_id, email="bench@example.com", name="bench")
+    )
+
+
+@dataclass
+class BenchToken:
+    auth_info: dict
+
+
+# The token store is not part of this repository (get_instagram_access_token always returns None), so the benchmark
+# serves the tokens of its users
+_tokens = {}
+
+
+def _get_bench_access_token(user_id: str) -> Optional[BenchToken]:
+    return _tokens.get(user_id)
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, round(q * (len(values) - 1)))]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import argparse
+import os
+import random
+import sys
+from bisect import bisect_right
+from datetime import datetime, timezone
+from statistics import median
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scheduler  # noqa: E402
+
+"""
+Offline simulation of the polling of a fleet of users, fixed interval polling against scheduler.PollingScheduler.
+
+Each simulated user posts at random (a Poisson process) at the rate of their kind: "active" users post daily, "regular"
+users twice a week, "dormant" users every couple of months. The history before the simulated period is what
+instagram_media would hold, and the scheduler learns the cadence of each user from it as PollingScheduler.load does.
+The simulation runs on a virtual clock, the API is not called:
+
+    - fixed: every user is synced every --fixed-interval hours, a sync lists the newest page of /me/media (1 call),
+      and processes what it found (SYNC_API_CALLS calls) when there is a new post
+    - scheduled: each check costs 1 call (the ids_only probe), a sync with new posts SYNC_API_CALLS calls
+
+Reported, for each: the API calls, the API calls per new post ingested, the peak API calls in an hour, and the median
+and p90 delay between a post and its ingestion.
+
+    python benchmarks/bench_scheduler.py --users 2000 --days 30 --fixed-interval 1 --budget 2000
+"""
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+# Kind: (share of the users, posts per day)
+USER_KINDS = {
+    "active": (0.15, 1.0),
+    "regular": (0.35, 2 / 7),
+    "dormant": (0.5, 1 / 60),
+}
+
+
+def simulate_posts(rng, start, end, posts_per_day):
+    posts = []
+    now = start
+    while True:
+        now += rng.expovariate(posts_per_day / DAY)
+        if now >= end:
+            return posts
+        posts.append(now)
+
+
+def build_fleet(users, days, history_days, seed):
+    rng = random.Random(seed)
+    start = datetime(2024, 6, 1, tzinfo=timezone.utc).timestamp()
+    fleet = {}
+    for i in range(users):
+        kind = rng.choices(
+            list(USER_KINDS), weights=[share for share, _ in USER_KINDS.values()]
+        )[0]
+        fleet[f"{kind}_{i}"] = simulate_posts(
+            rng, start - history_days * DAY, start + days * DAY, USER_KINDS[kind][1]
+        )
+    return start, fleet
+
+
+class Ingestion:
+    """The API calls and the ingestion delays of a simulation."""
+
+    def __init__(self, start, fleet):
+        self.start = start
+        self.fleet = fleet
+        self.calls_by_hour = {}
+        self.delays = []
+        # Index of the first post of each user not ingested yet
+        self.ingested = {
+            user_id: bisect_right(posts, start) for user_id, posts in fleet.items()
+        }
+
+    def call(self, now, calls=1):
+        hour = int((now - self.start) // HOUR)
+        self.calls_by_hour[hour] = self.calls_by_hour.get(hour, 0) + calls
+
+    def newest_post(self, user_id, now):
+        posts = self.fleet[user_id]
+        index = bisect_right(posts, now)
+        return posts[index - 1] if index else None
+
+    def ingest(self, user_id, now):
+        posts = self.fleet[user_id]
+        index = bisect_right(posts, now)
+        self.delays.extend(now - post for post in posts[self.ingested[user_id] : index])
+        found = index > self.ingested[user_id]
+        self.ingested[user_id] = index
+        return found
+
+    def report(self, name):
+        calls = sum(self.calls_by_hour.values())
+        new_posts = len(self.delays)
+        delays = sorted(self.delays)
+        print(
+            f"{name:>10}: {calls:>9} API calls, {new_posts:>6} new posts, "
+            f"{calls / max(new_posts, 1):>7.1f} calls/post, "
+            f"peak {max(self.calls_by_hour.values(), default=0):>6} calls/hour, "
+            f"delay p50 {median(delays) / HOUR if delays else 0:>5.1f}h "
+            f"p90 {delays[int(len(delays) * 0.9)] / HOUR if delays else 0:>5.1f}h"
+        )
+        return calls / max(new_posts, 1)
+
+
+def run_fixed(start, fleet, days, interval_hours):
+    ingestion = Ingestion(start, fleet)
+    end = start + days * DAY
+    for user_id in fleet:
+        # The users are spread over the interval, as they were signed up
+        now = start + random.random() * interval_hours * HOUR
+        while now < end:
+            ingestion.call(now)
+            if ingestion.ingest(user_id, now):
+                ingestion.call(now, scheduler.SYNC_API_CALLS)
+            now += interval_hours * HOUR
+    return ingestion
+
+
+def run_scheduled(start, fleet, days, budget, recent):
+    ingestion = Ingestion(start, fleet)
+    end = start + days * DAY
+    clock = [start]
+
+    def probe(user_id):
+        ingestion.call(clock[0])
+        return ingestion.newest_post(user_id, clock[0])
+
+    def sync(user_id):
+        ingestion.call(clock[0], scheduler.SYNC_API_CALLS)
+        ingestion.ingest(user_id, clock[0])
+
+    polling = scheduler.PollingScheduler(
+        probe,
+        sync,
+        budget=scheduler.ApiBudget(budget, now=start) if budget else None,
+        max_workers=0,
+        clock=lambda: clock[0],
+    )
+    for user_id, posts in fleet.items():
+        # The cadence of the most recent stored posts, as instagram_media_crud.get_posting_cadences computes it
+        history = posts[: ingestion.ingested[user_id]][-recent:]
+        polling.add_user(
+            user_id,
+            scheduler.estimate_interval(
+                len(history),
+                *(
+                    (
+                        datetime.fromtimestamp(history[0], timezone.utc),
+                        datetime.fromtimestamp(history[-1], timezone.utc),
+                    )
+                    if history
+                    else (None, None)
+                ),
+            ),
+            last_post_at=history[-1] if history else None,
+        )
+
+    while True:
+        next_check_at = polling.next_check_at()
+        if next_check_at is None or next_check_at >= end:
+            break
+        # The checks deferred by the budget are retried every minute
+        clock[0] = max(next_check_at, clock[0] + 60)
+        polling.run_due()
+    return ingestion, polling.stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate fixed interval and cadence scheduled polling of a fleet of users."
+    )
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--days", type=int, default=30, help="simulated days")
+    parser.add_argument(
+        "--history-days", type=int, default=120, help="days of stored posts"
+    )
+    parser.add_argument(
+        "--fixed-interval", type=float, default=1, help="fixed polling interval, hours"
+    )
+    parser.add_argument(
+        "--budget", type=float, default=0, help="API calls per hour, 0 is unlimited"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    start, fleet = build_fleet(args.users, args.days, args.history_days, args.seed)
+    print(
+        f"{args.users} users over {args.days} days, "
+        + ", ".join(
+            f"{sum(user_id.startswith(kind) for user_id in fleet)} {kind}"
+            for kind in USER_KINDS
+        )
+    )
+    fixed_calls_per_post = run_fixed(
+        start, fleet, args.days, args.fixed_interval
+    ).report("fixed")
+    ingestion, stats = run_scheduled(
+        start, fleet, args.days, args.budget, scheduler.CADENCE_RECENT_POSTS
+    )
+    scheduled_calls_per_post = ingestion.report("scheduled")
+    print(
+        f"{fixed_calls_per_post / scheduled_calls_per_post:.1f}x fewer API calls per new post, "
+        f"{stats['checks']} checks, {stats['syncs']} syncs, {stats['deferred']} check deferrals by the budget"
+    )
+
+
+if __name__ == "__main__":
+    main()
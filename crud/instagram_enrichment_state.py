@@ -0,0 +1,49 @@
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from models.instagram_enrichment_state import InstagramEnrichmentState
+
+
+class InstagramEnrichmentStateCrud():
+    def get_state_by_user_id(
+        self, db: Session, user_id: str
+    ) -> Optional[InstagramEnrichmentState]:
+        return db.query(InstagramEnrichmentState).filter_by(user_id=user_id).first()
+
+    def upsert_state(
+        self,
+        db: Session,
+        user_id: str,
+        profile: Optional[str],
+        media_count: int,
+        last_media_row_id: int,
+        prompt_version: Optional[str] = None,
+        last_described_at: Optional[datetime] = None,
+    ) -> None:
+        """Insert or update the enrichment state of the user."""
+        values = {
+            "profile": profile,
+            "media_count": media_count,
+            "last_described_at": last_described_at,
+            "last_media_row_id": last_media_row_id,
+            "prompt_version": prompt_version,
+        }
+        statement = insert(InstagramEnrichmentState).values(user_id=user_id, **values)
+        db.execute(
+            statement.on_conflict_do_update(
+                index_elements=["user_id"],
+                set_={**values, "updated_at": func.now()},
+            )
+        )
+
+    def delete_state_by_user_id(self, db: Session, user_id: str) -> int:
+        return (
+            db.query(InstagramEnrichmentState)
+            .filter_by(user_id=user_id)
+            .delete(synchronize_session=False)
+        )
+
+
+instagram_enrichment_state_crud = InstagramEnrichmentStateCrud()
@@ -1,21 +1,85 @@
-from typing import Optional
+from datetime import datetime
+from typing import Optional, Union
+from sqlalchemy import (
+    Select,
+    String,
+    all_,
+    any_,
+    bindparam,
+    case,
+    cast,
+    delete,
+    func,
+    or_,
+    select,
+    true,
+    tuple_,
+    update,
+)
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from types.instagram_media_type import InstagramMediaType
+from pgvector.sqlalchemy import Vector
+from embedding_storage import (
+    BINARY_RERANK_FACTOR,
+    EMBEDDING_COLUMNS,
+    HNSW_ITERATIVE_SCAN,
+    STORAGE_MODE_COLUMNS,
+    encode,
+    quantize_binary,
+    reduce_dimensions,
+)
+from models.types.instagram_media_type import InstagramMediaType
 from models.instagram_media import InstagramMedia
+from models.instagram_media_archive import InstagramMediaArchive
+from models.instagram_media_record import InstagramMediaRecord
 
+# Columns managed by the database that must never be overwritten by an upsert
+# url_checked_at is only set by the url refresh (see bulk_update_media_fields)
+_NON_UPSERT_COLUMNS = (
+    "id",
+    "created_at",
+    "updated_at",
+    "url_checked_at",
+    "described_at",
+)
 
-class InstagramMediaCrud():
-    def __init__(self) -> None:
-        super().__init__(InstagramMedia)
 
+class InstagramMediaCrud():
     def bulk_upsert_media(
         self,
         db: Session,
-        db_objs: list[InstagramMedia],
+        db_objs: list[Union[InstagramMediaRecord, InstagramMedia]],
         batch_size: int = 1000,
+        embedding_storage: str = "full",
     ) -> int:
-        """Bulk upsert a list of media. If the media already exists, update the existing record."""        
-        # IMPLEMENT HERE
+        """
+        Bulk upsert a list of media records. If the media already exists, update the existing record. Records are converted to rows one batch at a time.
+        The embeddings are stored in the columns of the embedding_storage mode (see embedding_storage.encode).
+        """
+        n = 0
+        for statement, batch_len in self._build_upsert_statements(
+            db_objs, batch_size, embedding_storage
+        ):
+            db.execute(statement)
+            n += batch_len
+        return n
+
+    async def bulk_upsert_media_async(
+        self,
+        db: AsyncSession,
+        db_objs: list[Union[InstagramMediaRecord, InstagramMedia]],
+        batch_size: int = 1000,
+        embedding_storage: str = "full",
+    ) -> int:
+        """Async version of bulk_upsert_media."""
+        n = 0
+        for statement, batch_len in self._build_upsert_statements(
+            db_objs, batch_size, embedding_storage
+        ):
+            await db.execute(statement)
+            n += batch_len
+        return n
 
     def get_media_by_user_id_media_id(
         self, db: Session, user_id: str, media_id: str
@@ -26,6 +90,535 @@ class InstagramMediaCrud():
             .first()
         )
 
+    async def get_media_by_user_id_media_id_async(
+        self, db: AsyncSession, user_id: str, media_id: str
+    ) -> Optional[InstagramMedia]:
+        """Async version of get_media_by_user_id_media_id."""
+        result = await db.scalars(
+            select(InstagramMedia)
+            .filter_by(user_id=user_id, media_id=media_id)
+            .limit(1)
+        )
+        return result.first()
+
+    def get_description_hashes_by_user_id_media_ids(
+        self,
+        db: Session,
+        user_id: str,
+        media_ids: list[str],
+        published_since: Optional[datetime] = None,
+    ) -> dict[str, Optional[str]]:
+        """
+        Get the description_hash of each media in media_ids that is already stored for the user, keyed by media_id. Media that is not stored is omitted.
+        published_since (the oldest publish time of the media, when known) lets a table partitioned by publish_timestamp skip the older partitions.
+        """
+        if not media_ids:
+            return {}
+        rows = db.execute(
+            self._select_description_hashes(user_id, media_ids, published_since)
+        ).all()
+        return {media_id: description_hash for media_id, description_hash in rows}
+
+    async def get_description_hashes_by_user_id_media_ids_async(
+        self,
+        db: AsyncSession,
+        user_id: str,
+        media_ids: list[str],
+        published_since: Optional[datetime] = None,
+    ) -> dict[str, Optional[str]]:
+        """Async version of get_description_hashes_by_user_id_media_ids."""
+        if not media_ids:
+            return {}
+        result = await db.execute(
+            self._select_description_hashes(user_id, media_ids, published_since)
+        )
+        return {
+            media_id: description_hash for media_id, description_hash in result.all()
+        }
+
+    def get_media_ids_by_user_id_description_hash(
+        self, db: Session, user_id: str, description_hash: str
+    ) -> list[str]:
+        """Get the media_id of the user's top-level media (not album children) stored with a description_hash, e.g. the deferred media."""
+        return list(
+            db.scalars(
+                select(InstagramMedia.media_id).where(
+                    InstagramMedia.user_id == user_id,
+                    InstagramMedia.description_hash == description_hash,
+                    InstagramMedia.parent_media_id.is_(None),
+                )
+            )
+        )
+
+    def get_described_perceptual_hashes_by_user_id(
+        self,
+        db: Session,
+        user_id: str,
+        prompt_version: str,
+        description_hashes: list[str],
+    ) -> list[tuple[str, str, str]]:
+        """Get the (perceptual_hash, description_hash, media_description) of the user's media described under prompt_version, with one of the description hashes."""
+        if not description_hashes:
+            return []
+        return (
+            db.query(
+                InstagramMedia.perceptual_hash,
+                InstagramMedia.description_hash,
+                InstagramMedia.media_description,
+            )
+            .filter(
+                InstagramMedia.user_id == user_id,
+                InstagramMedia.prompt_version == prompt_version,
+                InstagramMedia.description_hash.in_(description_hashes),
+                InstagramMedia.perceptual_hash.is_not(None),
+                InstagramMedia.media_description.is_not(None),
+            )
+            .all()
+        )
+
+    def get_perceptual_hashes_by_user_id(self, db: Session, user_id: str) -> list[str]:
+        """Get the distinct perceptual hashes of the user's media."""
+        return list(
+            db.scalars(
+                select(InstagramMedia.perceptual_hash)
+                .where(
+                    InstagramMedia.user_id == user_id,
+                    InstagramMedia.perceptual_hash.is_not(None),
+                )
+                .distinct()
+            )
+        )
+
+    def delete_media_batch_by_user_id(
+        self, db: Session, user_id: str, batch_size: int = 1000
+    ) -> int:
+        """
+        Delete up to batch_size media rows of the user, so a large purge is split into short transactions.
+
+        Returns:
+            int: the number of deleted rows, 0 once the user has no media left.
+        """
+        batch = (
+            select(InstagramMedia.id)
+            .where(InstagramMedia.user_id == user_id)
+            .limit(batch_size)
+        )
+        # The user_id also confines the delete to the user's partition when the table is partitioned by user
+        result = db.execute(
+            delete(InstagramMedia)
+            .where(
+                InstagramMedia.user_id == user_id,
+                InstagramMedia.id.in_(batch.scalar_subquery()),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+
+    def archive_media_batch(
+        self,
+        db: Session,
+        published_before: datetime,
+        batch_size: int = 1000,
+        keep_archive: bool = True,
+    ) -> int:
+        """
+        Move the descriptions and embeddings of up to batch_size media published before published_before out of instagram_media.
+        The rows stay, with their description_hash, so the media is not described again, and archived_at marks them as described.
+
+        Args:
+            published_before (datetime): Media published before this is archived.
+            batch_size (int): Optional. The number of rows archived per call.
+            keep_archive (bool): Optional. Copy the descriptions and embeddings to instagram_media_archive first, or drop them.
+
+        Returns:
+            int: the number of archived rows, 0 once there is nothing left to archive.
+        """
+        media_row_ids = list(
+            db.scalars(
+                select(InstagramMedia.id)
+                .where(
+                    InstagramMedia.publish_timestamp < published_before,
+                    InstagramMedia.archived_at.is_(None),
+                    InstagramMedia.media_description.is_not(None),
+                )
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
+        )
+        if not media_row_ids:
+            return 0
+        if keep_archive:
+            archived_columns = (
+                "user_id",
+                "media_id",
+                "publish_timestamp",
+                "media_description",
+            )
+            # The float16 embeddings are archived as float32, the binary and reduced ones are not archived
+            statement = insert(InstagramMediaArchive).from_select(
+                (*archived_columns, "embeddings"),
+                select(
+                    *(getattr(InstagramMedia, column) for column in archived_columns),
+                    func.coalesce(
+                        InstagramMedia.embeddings,
+                        cast(InstagramMedia.embeddings_half, Vector(1536)),
+                    ),
+                ).where(InstagramMedia.id.in_(media_row_ids)),
+            )
+            db.execute(
+                statement.on_conflict_do_update(
+                    constraint="media_archive_user_uc",
+                    set_={
+                        "media_description": statement.excluded.media_description,
+                        "embeddings": statement.excluded.embeddings,
+                        "created_at": func.now(),
+                    },
+                )
+            )
+        db.execute(
+            update(InstagramMedia)
+            .where(InstagramMedia.id.in_(media_row_ids))
+            .values(
+                media_description=None,
+                **dict.fromkeys(EMBEDDING_COLUMNS),
+                archived_at=func.now(),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        return len(media_row_ids)
+
+    def get_described_media_by_user_id_described_after(
+        self,
+        db: Session,
+        user_id: str,
+        described_after: Optional[datetime],
+        after_row_id: int,
+        limit: int = 50,
+    ) -> list[InstagramMedia]:
+        """
+        Get the user's described top-level media (album children excluded) described after (described_after, after_row_id), in (described_at, id) order.
+        Media described before described_at was tracked counts as described when it was inserted. described_after None gets every described media.
+        """
+        described_at = func.coalesce(
+            InstagramMedia.described_at, InstagramMedia.created_at
+        )
+        query = db.query(InstagramMedia).filter(
+            InstagramMedia.user_id == user_id,
+            InstagramMedia.parent_media_id.is_(None),
+            InstagramMedia.media_description.is_not(None),
+        )
+        if described_after is not None:
+            query = query.filter(
+                tuple_(described_at, InstagramMedia.id)
+                > tuple_(described_after, after_row_id)
+            )
+        return query.order_by(described_at, InstagramMedia.id).limit(limit).all()
+
+    def get_described_media_windows_by_user_id(
+        self, db: Session, user_id: str
+    ) -> list[tuple[datetime, int, int]]:
+        """
+        Get the (window_start, media_count, last_media_row_id) of each calendar month of publish_timestamp holding described top-level media of the user, oldest first.
+        Archived media counts as described, so archiving a window does not make its summary stale.
+        """
+        window_start = func.date_trunc("month", InstagramMedia.publish_timestamp)
+        return (
+            db.query(window_start, func.count(), func.max(InstagramMedia.id))
+            .filter(
+                InstagramMedia.user_id == user_id,
+                InstagramMedia.parent_media_id.is_(None),
+                or_(
+                    InstagramMedia.media_description.is_not(None),
+                    InstagramMedia.archived_at.is_not(None),
+                ),
+            )
+            .group_by(window_start)
+            .order_by(window_start)
+            .all()
+        )
+
+    def get_described_media_by_user_id_published_between(
+        self, db: Session, user_id: str, start: datetime, end: datetime
+    ) -> list[InstagramMedia]:
+        """Get the user's described top-level media published in [start, end), oldest first. The description of archived media is None (see instagram_media_archive_crud)."""
+        return (
+            db.query(InstagramMedia)
+            .filter(
+                InstagramMedia.user_id == user_id,
+                InstagramMedia.publish_timestamp >= start,
+                InstagramMedia.publish_timestamp < end,
+                InstagramMedia.parent_media_id.is_(None),
+                or_(
+                    InstagramMedia.media_description.is_not(None),
+                    InstagramMedia.archived_at.is_not(None),
+                ),
+            )
+            .order_by(InstagramMedia.publish_timestamp)
+            .all()
+        )
+
+    def get_posting_cadences(
+        self,
+        db: Session,
+        recent: int = 20,
+        user_ids: Optional[list[str]] = None,
+        exclude_user_ids: Optional[list[str]] = None,
+    ) -> list[tuple[str, int, datetime, datetime]]:
+        """
+        Get the posting cadence of each user from the publish_timestamp of their most recent top-level media, in a single query.
+        The recent posts of each user are read by a LATERAL subquery limited to recent rows, over the (user_id, publish_timestamp)
+        index, so the cost grows with the number of users rather than with the media of the whole fleet.
+
+        Args:
+            recent (int): Optional. The number of most recent posts of each user the cadence is computed over.
+            user_ids (list[str]): Optional. Only these users, every user with media otherwise.
+            exclude_user_ids (list[str]): Optional. Leave these users out, e.g. those already scheduled.
+
+        Returns:
+            list[tuple[str, int, datetime, datetime]]: the (user_id, post_count, first_published, last_published) of each user,
+            over their recent posts. The mean interval between posts is (last_published - first_published) / (post_count - 1).
+        """
+        users = select(InstagramMedia.user_id).where(
+            InstagramMedia.parent_media_id.is_(None)
+        )
+        if user_ids is not None:
+            users = users.where(InstagramMedia.user_id.in_(user_ids))
+        if exclude_user_ids:
+            users = users.where(
+                InstagramMedia.user_id
+                != all_(
+                    bindparam(
+                        "exclude_user_ids", list(exclude_user_ids), type_=ARRAY(String)
+                    )
+                )
+            )
+        users = users.distinct().subquery()
+        recent_posts = (
+            select(InstagramMedia.publish_timestamp)
+            .where(
+                InstagramMedia.user_id == users.c.user_id,
+                InstagramMedia.parent_media_id.is_(None),
+            )
+            .order_by(InstagramMedia.publish_timestamp.desc())
+            .limit(recent)
+            .lateral()
+        )
+        return db.execute(
+            select(
+                users.c.user_id,
+                func.count(),
+                func.min(recent_posts.c.publish_timestamp),
+                func.max(recent_posts.c.publish_timestamp),
+            )
+            .select_from(users)
+            .join(recent_posts, true())
+            .group_by(users.c.user_id)
+            .order_by(users.c.user_id)
+        ).all()
+
+    def search_similar_media_by_user_id(
+        self,
+        db: Session,
+        user_id: str,
+        query_embedding: list[float],
+        limit: int = 10,
+        embedding_storage: str = "full",
+        rerank_factor: int = BINARY_RERANK_FACTOR,
+        iterative_scan: Optional[str] = HNSW_ITERATIVE_SCAN,
+    ) -> list[tuple[InstagramMedia, float]]:
+        """
+        Get the user's media most similar to a query embedding, in the columns of the embedding_storage mode.
+        In "binary" mode, the limit * rerank_factor nearest media by hamming distance are re-ranked by the cosine distance of their float16 embeddings.
+        The HNSW indexes hold the media of all users and the user_id filter is applied to the rows the index scan returns,
+        hnsw.iterative_scan is set for the transaction so that the scan goes on until enough of the user's media are found.
+
+        Args:
+            query_embedding (list[float]): The float embedding to search for, encoded like the stored ones.
+            limit (int): Optional. The number of media returned.
+            embedding_storage (str): Optional. The storage mode the embeddings were written in (see embedding_storage).
+            rerank_factor (int): Optional. The number of binary candidates re-ranked per result.
+            iterative_scan (str): Optional. The hnsw.iterative_scan mode (pgvector 0.8+), None to leave it unset.
+
+        Returns:
+            list[tuple[InstagramMedia, float]]: the (media, cosine distance) pairs, most similar first.
+        """
+        if iterative_scan:
+            db.execute(
+                select(func.set_config("hnsw.iterative_scan", iterative_scan, True))
+            )
+        if embedding_storage == "binary":
+            candidate_row_ids = (
+                select(InstagramMedia.id)
+                .where(
+                    InstagramMedia.user_id == user_id,
+                    InstagramMedia.embeddings_binary.is_not(None),
+                )
+                .order_by(
+                    InstagramMedia.embeddings_binary.hamming_distance(
+                        quantize_binary(query_embedding)
+                    )
+                )
+                .limit(limit * rerank_factor)
+            )
+            column, query = InstagramMedia.embeddings_half, query_embedding
+            condition = InstagramMedia.id.in_(candidate_row_ids.scalar_subquery())
+        else:
+            column, query = {
+                "full": (InstagramMedia.embeddings, query_embedding),
+                "halfvec": (InstagramMedia.embeddings_half, query_embedding),
+                "reduced": (
+                    InstagramMedia.embeddings_reduced,
+                    reduce_dimensions(query_embedding),
+                ),
+            }[embedding_storage]
+            condition = InstagramMedia.user_id == user_id
+        distance = column.cosine_distance([float(value) for value in query])
+        return [
+            (media, media_distance)
+            for media, media_distance in db.execute(
+                select(InstagramMedia, distance)
+                .where(condition, column.is_not(None))
+                .order_by(distance)
+                .limit(limit)
+            ).all()
+        ]
+
+    def get_embeddings_to_reencode(
+        self,
+        db: Session,
+        embedding_storage: str,
+        after_row_id: int,
+        batch_size: int = 1000,
+    ) -> list[tuple[int, list[float]]]:
+        """
+        Get the (row id, float embedding) of up to batch_size media after the row id after_row_id, in row id order, whose embeddings are not stored in
+        exactly the columns of the embedding_storage mode. Only media with float32 or float16 embeddings can be encoded again.
+        """
+        mode_columns = STORAGE_MODE_COLUMNS[embedding_storage]
+        embedding = func.coalesce(
+            InstagramMedia.embeddings,
+            cast(InstagramMedia.embeddings_half, Vector(1536)),
+        )
+        return (
+            db.query(InstagramMedia.id, embedding)
+            .filter(
+                InstagramMedia.id > after_row_id,
+                embedding.is_not(None),
+                or_(
+                    *(
+                        getattr(InstagramMedia, column).is_(None)
+                        for column in mode_columns
+                    ),
+                    *(
+                        getattr(InstagramMedia, column).is_not(None)
+                        for column in EMBEDDING_COLUMNS
+                        if column not in mode_columns
+                    ),
+                ),
+            )
+            .order_by(InstagramMedia.id)
+            .limit(batch_size)
+            .all()
+        )
+
+    def bulk_update_embeddings(
+        self, db: Session, updates: list[tuple[int, dict]]
+    ) -> int:
+        """Bulk update the embedding columns of media, from (row id, column values) pairs (see embedding_storage.encode), as a single executemany."""
+        if not updates:
+            return 0
+        statement = (
+            update(InstagramMedia)
+            .where(InstagramMedia.id == bindparam("b_id"))
+            .values(
+                {
+                    column: bindparam(
+                        f"b_{column}", type_=InstagramMedia.__table__.c[column].type
+                    )
+                    for column in EMBEDDING_COLUMNS
+                }
+            )
+        )
+        db.connection().execute(
+            statement,
+            [
+                {
+                    "b_id": row_id,
+                    **{f"b_{column}": values[column] for column in EMBEDDING_COLUMNS},
+                }
+                for row_id, values in updates
+            ],
+        )
+        return len(updates)
+
+    def get_media_with_expiring_urls_by_user_id(
+        self,
+        db: Session,
+        user_id: str,
+        expires_before: datetime,
+        checked_before: Optional[datetime] = None,
+    ) -> list[InstagramMedia]:
+        """
+        Get all media of the user whose signed urls expire before expires_before, or whose expiry is unknown.
+        With checked_before, the media whose urls were checked since then are left out.
+        """
+        query = db.query(InstagramMedia).filter(
+            InstagramMedia.user_id == user_id,
+            or_(
+                InstagramMedia.url_expires_at.is_(None),
+                InstagramMedia.url_expires_at < expires_before,
+            ),
+        )
+        if checked_before is not None:
+            query = query.filter(
+                or_(
+                    InstagramMedia.url_checked_at.is_(None),
+                    InstagramMedia.url_checked_at < checked_before,
+                )
+            )
+        return query.all()
+
+    def bulk_update_media_fields(
+        self, db: Session, user_id: str, updates: list[dict]
+    ) -> int:
+        """
+        Bulk update only the changed columns of existing media. Each update is a dict holding the media_id and the new column values.
+        Updates changing the same set of columns are sent together as a single executemany.
+        """
+        updates_by_columns = {}
+        for media_update in updates:
+            columns = tuple(sorted(key for key in media_update if key != "media_id"))
+            if columns:
+                updates_by_columns.setdefault(columns, []).append(media_update)
+
+        n = 0
+        for columns, column_updates in updates_by_columns.items():
+            statement = (
+                update(InstagramMedia)
+                .where(
+                    InstagramMedia.user_id == bindparam("b_user_id"),
+                    InstagramMedia.media_id == bindparam("b_media_id"),
+                )
+                .values(
+                    {
+                        **{column: bindparam(f"b_{column}") for column in columns},
+                        "updated_at": func.now(),
+                    }
+                )
+            )
+            db.connection().execute(
+                statement,
+                [
+                    {
+                        "b_user_id": user_id,
+                        **{f"b_{key}": value for key, value in media_update.items()},
+                    }
+                    for media_update in column_updates
+                ],
+            )
+            n += len(column_updates)
+        return n
+
     def get_all_media_by_user_id_media_type_desc(
         self, db: Session, user_id: str, media_type: Optional[InstagramMediaType] = None
     ) -> list[InstagramMedia]:
@@ -45,6 +638,16 @@ class InstagramMediaCrud():
                 .all()
             )
 
+    async def get_all_media_by_user_id_media_type_desc_async(
+        self,
+        db: AsyncSession,
+        user_id: str,
+        media_type: Optional[InstagramMediaType] = None,
+    ) -> list[InstagramMedia]:
+        """Async version of get_all_media_by_user_id_media_type_desc."""
+        result = await db.scalars(self._select_timeline(user_id, media_type))
+        return list(result.all())
+
     def get_n_most_recent_media_by_user_id_media_type(
         self,
         db: Session,
@@ -71,4 +674,92 @@ class InstagramMediaCrud():
                 .all()
             )
 
+    async def get_n_most_recent_media_by_user_id_media_type_async(
+        self,
+        db: AsyncSession,
+        user_id: str,
+        n: int = 1,
+        media_type: Optional[InstagramMediaType] = None,
+    ) -> list[InstagramMedia]:
+        """Async version of get_n_most_recent_media_by_user_id_media_type."""
+        result = await db.scalars(self._select_timeline(user_id, media_type).limit(n))
+        return list(result.all())
+
+    @staticmethod
+    def _select_timeline(
+        user_id: str, media_type: Optional[InstagramMediaType] = None
+    ) -> Select:
+        """Build a select of the user's media, most recent first, optionally filtered by media_type."""
+        statement = select(InstagramMedia).filter_by(user_id=user_id)
+        if media_type is not None:
+            statement = statement.filter_by(media_type=media_type.name)
+        return statement.order_by(InstagramMedia.publish_timestamp.desc())
+
+    @staticmethod
+    def _select_description_hashes(
+        user_id: str, media_ids: list[str], published_since: Optional[datetime] = None
+    ) -> Select:
+        """Build a single indexed lookup (media_id = ANY(:media_ids)) over the media_user_uc constraint."""
+        statement = select(
+            InstagramMedia.media_id, InstagramMedia.description_hash
+        ).where(
+            InstagramMedia.user_id == user_id,
+            InstagramMedia.media_id
+            == any_(bindparam("media_ids", list(media_ids), type_=ARRAY(String))),
+        )
+        if published_since is not None:
+            statement = statement.where(
+                InstagramMedia.publish_timestamp >= published_since
+            )
+        return statement
+
+    @staticmethod
+    def _build_upsert_statements(
+        db_objs: list[Union[InstagramMediaRecord, InstagramMedia]],
+        batch_size: int,
+        embedding_storage: str = "full",
+    ):
+        """Yield (statement, batch length) pairs of INSERT ... ON CONFLICT DO UPDATE statements, one per batch."""
+        columns = [
+            column.key
+            for column in InstagramMedia.__table__.columns
+            if column.key not in _NON_UPSERT_COLUMNS
+        ]
+        record_columns = [key for key in columns if key not in EMBEDDING_COLUMNS]
+        for i in range(0, len(db_objs), batch_size):
+            batch = [
+                {
+                    **{key: getattr(obj, key) for key in record_columns},
+                    **encode(obj.embeddings, embedding_storage),
+                    "described_at": (
+                        func.now() if obj.media_description is not None else None
+                    ),
+                }
+                for obj in db_objs[i : i + batch_size]
+            ]
+            statement = insert(InstagramMedia).values(batch)
+            statement = statement.on_conflict_do_update(
+                constraint="media_user_uc",
+                set_={
+                    **{
+                        key: statement.excluded[key]
+                        for key in columns
+                        if key not in ("media_id", "user_id")
+                    },
+                    "updated_at": func.now(),
+                    # Kept when the description is unchanged, e.g. by a url refresh
+                    "described_at": case(
+                        (
+                            InstagramMedia.media_description.is_not_distinct_from(
+                                statement.excluded.media_description
+                            ),
+                            InstagramMedia.described_at,
+                        ),
+                        else_=statement.excluded.described_at,
+                    ),
+                },
+            )
+            yield statement, len(batch)
+
 
+instagram_media_crud = InstagramMediaCrud()
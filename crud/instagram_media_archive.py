@@ -0,0 +1,46 @@
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+from models.instagram_media_archive import InstagramMediaArchive
+
+
+class InstagramMediaArchiveCrud():
+    def get_descriptions_by_user_id_media_ids(
+        self, db: Session, user_id: str, media_ids: list[str]
+    ) -> dict[str, str]:
+        """Get the archived description of each media in media_ids, keyed by media_id. Media with no archived description is omitted."""
+        if not media_ids:
+            return {}
+        rows = db.execute(
+            select(
+                InstagramMediaArchive.media_id, InstagramMediaArchive.media_description
+            ).where(
+                InstagramMediaArchive.user_id == user_id,
+                InstagramMediaArchive.media_id.in_(media_ids),
+                InstagramMediaArchive.media_description.is_not(None),
+            )
+        ).all()
+        return {media_id: media_description for media_id, media_description in rows}
+
+    def delete_archive_batch_by_user_id(
+        self, db: Session, user_id: str, batch_size: int = 1000
+    ) -> int:
+        """
+        Delete up to batch_size archived rows of the user.
+
+        Returns:
+            int: the number of deleted rows, 0 once the user has no archived media left.
+        """
+        batch = (
+            select(InstagramMediaArchive.id)
+            .where(InstagramMediaArchive.user_id == user_id)
+            .limit(batch_size)
+        )
+        result = db.execute(
+            delete(InstagramMediaArchive)
+            .where(InstagramMediaArchive.id.in_(batch.scalar_subquery()))
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+
+
+instagram_media_archive_crud = InstagramMediaArchiveCrud()
@@ -0,0 +1,53 @@
+from typing import Optional
+from sqlalchemy.orm import Session
+from models.instagram_purge_job import InstagramPurgeJob
+
+
+class InstagramPurgeJobCrud():
+    def create_job(
+        self,
+        db: Session,
+        confirmation_code: str,
+        user_id: str,
+        reason: str,
+        status: str = "pending",
+    ) -> InstagramPurgeJob:
+        job = InstagramPurgeJob(
+            confirmation_code=confirmation_code,
+            user_id=user_id,
+            reason=reason,
+            status=status,
+            deleted_media=0,
+        )
+        db.add(job)
+        db.flush()
+        return job
+
+    def get_job_by_confirmation_code(
+        self, db: Session, confirmation_code: str
+    ) -> Optional[InstagramPurgeJob]:
+        return (
+            db.query(InstagramPurgeJob)
+            .filter_by(confirmation_code=confirmation_code)
+            .first()
+        )
+
+    def get_unfinished_jobs(self, db: Session) -> list[InstagramPurgeJob]:
+        """Get the jobs that are pending, or were running when the process stopped, oldest first."""
+        return (
+            db.query(InstagramPurgeJob)
+            .filter(InstagramPurgeJob.status.in_(["pending", "running"]))
+            .order_by(InstagramPurgeJob.id)
+            .all()
+        )
+
+    def update_job(self, db: Session, confirmation_code: str, **fields) -> int:
+        """Update the status, deleted_media or error of a job."""
+        return (
+            db.query(InstagramPurgeJob)
+            .filter_by(confirmation_code=confirmation_code)
+            .update(fields, synchronize_session=False)
+        )
+
+
+instagram_purge_job_crud = InstagramPurgeJobCrud()
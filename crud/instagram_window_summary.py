@@ -0,0 +1,58 @@
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from models.instagram_window_summary import InstagramWindowSummary
+
+
+class InstagramWindowSummaryCrud():
+    def get_summaries_by_user_id(
+        self, db: Session, user_id: str
+    ) -> dict[datetime, InstagramWindowSummary]:
+        """Get the cached window summaries of the user, keyed by window_start."""
+        return {
+            summary.window_start: summary
+            for summary in db.query(InstagramWindowSummary).filter_by(user_id=user_id)
+        }
+
+    def upsert_summary(
+        self,
+        db: Session,
+        user_id: str,
+        window_start: datetime,
+        summary: Optional[str],
+        media_count: int,
+        last_media_row_id: int,
+        prompt_version: Optional[str] = None,
+    ) -> None:
+        """Insert or update the summary of a window of the user."""
+        values = {
+            "summary": summary,
+            "media_count": media_count,
+            "last_media_row_id": last_media_row_id,
+            "prompt_version": prompt_version,
+        }
+        statement = insert(InstagramWindowSummary).values(
+            user_id=user_id, window_start=window_start, **values
+        )
+        db.execute(
+            statement.on_conflict_do_update(
+                constraint="window_summary_user_uc",
+                set_={**values, "updated_at": func.now()},
+            )
+        )
+
+    def delete_summaries_by_user_id(
+        self, db: Session, user_id: str, window_starts: list[datetime] = None
+    ) -> int:
+        """Delete the window summaries of the user, only those of window_starts if given."""
+        query = db.query(InstagramWindowSummary).filter(
+            InstagramWindowSummary.user_id == user_id
+        )
+        if window_starts is not None:
+            query = query.filter(InstagramWindowSummary.window_start.in_(window_starts))
+        return query.delete(synchronize_session=False)
+
+
+instagram_window_summary_crud = InstagramWindowSummaryCrud()
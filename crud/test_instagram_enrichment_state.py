@@ -0,0 +1,44 @@
+from datetime import datetime
+from crud.instagram_enrichment_state import instagram_enrichment_state_crud
+
+
+def test_upsert_state(mocked_session):
+    assert (
+        instagram_enrichment_state_crud.get_state_by_user_id(
+            mocked_session, user_id="test_user_id"
+        )
+        is None
+    )
+
+    instagram_enrichment_state_crud.upsert_state(
+        mocked_session,
+        user_id="test_user_id",
+        profile="Enjoys sunsets",
+        media_count=2,
+        last_media_row_id=2,
+        prompt_version="v1",
+    )
+    instagram_enrichment_state_crud.upsert_state(
+        mocked_session,
+        user_id="test_user_id",
+        profile="Enjoys sunsets and beaches",
+        media_count=3,
+        last_media_row_id=5,
+        prompt_version="v1",
+        last_described_at=datetime(2024, 6, 12),
+    )
+
+    state = instagram_enrichment_state_crud.get_state_by_user_id(
+        mocked_session, user_id="test_user_id"
+    )
+    assert state.profile == "Enjoys sunsets and beaches"
+    assert state.media_count == 3
+    assert state.last_media_row_id == 5
+    assert state.last_described_at == datetime(2024, 6, 12)
+
+    assert (
+        instagram_enrichment_state_crud.delete_state_by_user_id(
+            mocked_session, user_id="test_user_id"
+        )
+        == 1
+    )
@@ -1,9 +1,15 @@
+import asyncio
+import pytest
+from contextlib import asynccontextmanager
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import NullPool
 from models import InstagramMedia
 from crud import instagram_media_crud
+from crud.instagram_media_archive import instagram_media_archive_crud
+from embedding_storage import encode
 from models.types import InstagramMediaType
 from datetime import datetime
 
-
 TEST_ALBUM = {
     "caption": "My favorite two things",
     "id": "18024887825474332",
@@ -50,8 +56,12 @@ def helper_construct_media_from_dict(
         media_type=media_dict["media_type"],
         media_url=media_dict["media_url"],
         media_description=media_dict.get("media_description"),
+        description_hash=media_dict.get("description_hash"),
+        perceptual_hash=media_dict.get("perceptual_hash"),
+        prompt_version=media_dict.get("prompt_version"),
         permalink=media_dict.get("permalink"),
         thumbnail_url=media_dict.get("thumbnail_url"),
+        url_expires_at=media_dict.get("url_expires_at"),
         caption=media_dict.get("caption"),
         album_children=album_children,
         parent_media_id=parent_media_id,
@@ -206,6 +216,523 @@ def test_get_n_most_recent_media_by_user_id_media_type(mocked_session):
     assert fetched_2_most_recent_instagram_user_media[1].media_id == TEST_IMAGE["id"]
 
 
+def test_get_description_hashes_by_user_id_media_ids(mocked_session):
+    instagram_media_crud.bulk_upsert_media(
+        mocked_session,
+        [
+            helper_construct_media_from_dict({**TEST_IMAGE, "description_hash": "abc"}),
+            helper_construct_media_from_dict(TEST_VIDEO),
+            helper_construct_media_from_dict(TEST_ALBUM, user_id="another_user_id"),
+        ],
+    )
+
+    stored_description_hashes = (
+        instagram_media_crud.get_description_hashes_by_user_id_media_ids(
+            mocked_session,
+            user_id="test_user_id",
+            media_ids=[TEST_IMAGE["id"], TEST_VIDEO["id"], TEST_ALBUM["id"]],
+        )
+    )
+
+    # The album belongs to another user, so it is not reported as stored
+    assert stored_description_hashes == {
+        TEST_IMAGE["id"]: "abc",
+        TEST_VIDEO["id"]: None,
+    }
+
+    assert (
+        instagram_media_crud.get_description_hashes_by_user_id_media_ids(
+            mocked_session, user_id="test_user_id", media_ids=[]
+        )
+        == {}
+    )
+
+
+def test_get_media_ids_by_user_id_description_hash(mocked_session):
+    instagram_media_crud.bulk_upsert_media(
+        mocked_session,
+        [
+            helper_construct_media_from_dict(
+                {**TEST_IMAGE, "description_hash": "deferred"}
+            ),
+            helper_construct_media_from_dict(
+                {**TEST_ALBUM, "description_hash": "deferred"},
+                user_id="another_user_id",
+            ),
+            helper_construct_media_from_dict(
+                {**TEST_VIDEO, "description_hash": "deferred"},
+                parent_media_id=TEST_ALBUM["id"],
+            ),
+        ],
+    )
+
+    # The album belongs to another user, and the video is an album child
+    assert instagram_media_crud.get_media_ids_by_user_id_description_hash(
+        mocked_session, "test_user_id", "deferred"
+    ) == [TEST_IMAGE["id"]]
+
+
+def test_get_described_perceptual_hashes_by_user_id(mocked_session):
+    instagram_media_crud.bulk_upsert_media(
+        mocked_session,
+        [
+            helper_construct_media_from_dict(
+                {
+                    **TEST_IMAGE,
+                    "media_description": "A sunset",
+                    "description_hash": "caption_a",
+                    "perceptual_hash": "0f0f0f0f0f0f0f0f",
+                    "prompt_version": "v1",
+                }
+            ),
+            # Described under another prompt version
+            helper_construct_media_from_dict(
+                {
+                    **TEST_VIDEO,
+                    "media_description": "A beach",
+                    "description_hash": "caption_a",
+                    "perceptual_hash": "ffff0000ffff0000",
+                    "prompt_version": "v0",
+                }
+            ),
+            # Not described yet
+            helper_construct_media_from_dict(
+                {
+                    **TEST_ALBUM,
+                    "description_hash": "caption_a",
+                    "perceptual_hash": "00ff00ff00ff00ff",
+                    "prompt_version": "v1",
+                }
+            ),
+            # Described with another caption
+            helper_construct_media_from_dict(
+                {
+                    **TEST_IMAGE,
+                    "id": "another_image_id",
+                    "media_description": "A sunset, captioned",
+                    "description_hash": "caption_b",
+                    "perceptual_hash": "0f0f0f0f0f0f0f0e",
+                    "prompt_version": "v1",
+                }
+            ),
+        ],
+    )
+
+    assert instagram_media_crud.get_described_perceptual_hashes_by_user_id(
+        mocked_session,
+        user_id="test_user_id",
+        prompt_version="v1",
+        description_hashes=["caption_a"],
+    ) == [("0f0f0f0f0f0f0f0f", "caption_a", "A sunset")]
+    assert (
+        instagram_media_crud.get_described_perceptual_hashes_by_user_id(
+            mocked_session,
+            user_id="test_user_id",
+            prompt_version="v1",
+            description_hashes=[],
+        )
+        == []
+    )
+
+
+def test_get_posting_cadences(mocked_session):
+    instagram_media_crud.bulk_upsert_media(
+        mocked_session,
+        [
+            helper_construct_media_from_dict(TEST_IMAGE),
+            helper_construct_media_from_dict(TEST_VIDEO),
+            helper_construct_media_from_dict(
+                {**TEST_ALBUM, "timestamp": "2024-05-02T10:00:00+0000"}
+            ),
+            helper_construct_media_from_dict(TEST_IMAGE, user_id="other_user_id"),
+        ],
+    )
+
+    cadences = instagram_media_crud.get_posting_cadences(mocked_session, recent=2)
+    # Only the two most recent posts of each user
+    assert [
+        (user_id, post_count, first_published.day, last_published.day)
+        for user_id, post_count, first_published, last_published in cadences
+    ] == [
+        ("other_user_id", 1, 11, 11),
+        ("test_user_id", 2, 11, 11),
+    ]
+
+    cadences = instagram_media_crud.get_posting_cadences(
+        mocked_session, user_ids=["test_user_id"]
+    )
+    assert [(user_id, post_count) for user_id, post_count, _, _ in cadences] == [
+        ("test_user_id", 3)
+    ]
+    assert cadences[0][2].month == 5
+
+    # Users already scheduled are left out
+    cadences = instagram_media_crud.get_posting_cadences(
+        mocked_session, exclude_user_ids=["test_user_id"]
+    )
+    assert [user_id for user_id, _, _, _ in cadences] == ["other_user_id"]
+
+
+def test_delete_media_batch_by_user_id(mocked_session):
+    instagram_media_crud.bulk_upsert_media(
+        mocked_session,
+        [
+            helper_construct_media_from_dict(
+                {**TEST_IMAGE, "perceptual_hash": "0f0f0f0f0f0f0f0f"}
+            ),
+            helper_construct_media_from_dict(
+                {**TEST_ALBUM, "perceptual_hash": "0f0f0f0f0f0f0f0f"}
+            ),
+            helper_construct_media_from_dict(TEST_VIDEO),
+            helper_construct_media_from_dict(TEST_IMAGE, user_id="other_user_id"),
+        ],
+    )
+
+    assert instagram_media_crud.get_perceptual_hashes_by_user_id(
+        mocked_session, user_id="test_user_id"
+    ) == ["0f0f0f0f0f0f0f0f"]
+
+    # Deleted two rows at a time, until the user has no media left
+    assert [
+        instagram_media_crud.delete_media_batch_by_user_id(
+            mocked_session, user_id="test_user_id", batch_size=2
+        )
+        for _ in range(3)
+    ] == [2, 1, 0]
+
+    assert (
+        instagram_media_crud.get_all_media_by_user_id_media_type_desc(
+            mocked_session, user_id="test_user_id"
+        )
+        == []
+    )
+    assert (
+        instagram_media_crud.get_media_by_user_id_media_id(
+            mocked_session, user_id="other_user_id", media_id=TEST_IMAGE["id"]
+        )
+        is not None
+    )
+
+
+def test_refresh_expiring_media_urls(mocked_session):
+    instagram_media_crud.bulk_upsert_media(
+        mocked_session,
+        [
+            helper_construct_media_from_dict(
+                {**TEST_IMAGE, "url_expires_at": datetime(2024, 6, 18, 9, 59, 23)}
+            ),
+            helper_construct_media_from_dict(
+                {**TEST_VIDEO, "url_expires_at": datetime(2024, 7, 1)}
+            ),
+        ],
+    )
+
+    expiring_media = instagram_media_crud.get_media_with_expiring_urls_by_user_id(
+        mocked_session, user_id="test_user_id", expires_before=datetime(2024, 6, 19)
+    )
+
+    assert [media.media_id for media in expiring_media] == [TEST_IMAGE["id"]]
+
+    n = instagram_media_crud.bulk_update_media_fields(
+        mocked_session,
+        user_id="test_user_id",
+        updates=[
+            {
+                "media_id": TEST_IMAGE["id"],
+                "media_url": "https://refreshed.jpg",
+                "url_expires_at": datetime(2024, 7, 2),
+            },
+            {"media_id": TEST_VIDEO["id"], "thumbnail_url": "https://refreshed.jpg"},
+        ],
+    )
+
+    assert n == 2
+
+    fetched_image = instagram_media_crud.get_media_by_user_id_media_id(
+        mocked_session, user_id="test_user_id", media_id=TEST_IMAGE["id"]
+    )
+    fetched_video = instagram_media_crud.get_media_by_user_id_media_id(
+        mocked_session, user_id="test_user_id", media_id=TEST_VIDEO["id"]
+    )
+
+    assert fetched_image.media_url == "https://refreshed.jpg"
+    assert fetched_image.url_expires_at == datetime(2024, 7, 2)
+    # Columns that are not part of an update are left untouched
+    assert fetched_video.media_url == TEST_VIDEO["media_url"]
+    assert fetched_video.thumbnail_url == "https://refreshed.jpg"
+
+    # A media whose urls were checked since checked_before is left out, e.g. an unknown expiry
+    instagram_media_crud.bulk_update_media_fields(
+        mocked_session,
+        user_id="test_user_id",
+        updates=[
+            {
+                "media_id": TEST_IMAGE["id"],
+                "url_expires_at": None,
+                "url_checked_at": datetime(2024, 6, 18, 12),
+            }
+        ],
+    )
+
+    for checked_before, expected_media_ids in (
+        (datetime(2024, 6, 18, 6), []),
+        (datetime(2024, 6, 18, 18), [TEST_IMAGE["id"]]),
+    ):
+        expiring_media = instagram_media_crud.get_media_with_expiring_urls_by_user_id(
+            mocked_session,
+            user_id="test_user_id",
+            expires_before=datetime(2024, 6, 19),
+            checked_before=checked_before,
+        )
+        assert [media.media_id for media in expiring_media] == expected_media_ids
+
+
+def test_get_described_media_by_user_id_described_after(mocked_session):
+    instagram_media_crud.bulk_upsert_media(
+        mocked_session,
+        [
+            helper_construct_media_from_dict(
+                {**TEST_IMAGE, "media_description": "A sunset"}
+            ),
+            # Album children are folded through their album
+            helper_construct_media_from_dict(
+                {**TEST_VIDEO, "media_description": "A beach"},
+                parent_media_id=TEST_ALBUM["id"],
+            ),
+            helper_construct_media_from_dict(TEST_ALBUM),
+        ],
+    )
+
+    described_media = (
+        instagram_media_crud.get_described_media_by_user_id_described_after(
+            mocked_session, user_id="test_user_id", described_after=None, after_row_id=0
+        )
+    )
+    assert [media.media_id for media in described_media] == [TEST_IMAGE["id"]]
+    last_described_at = described_media[-1].described_at
+    assert last_described_at is not None
+
+    # Only the media described after the last folded row is returned
+    assert (
+        instagram_media_crud.get_described_media_by_user_id_described_after(
+            mocked_session,
+            user_id="test_user_id",
+            described_after=last_described_at,
+            after_row_id=described_media[-1].id,
+        )
+        == []
+    )
+
+    # Upserting the same description keeps described_at
+    instagram_media_crud.bulk_upsert_media(
+        mocked_session,
+        [
+            helper_construct_media_from_dict(
+                {**TEST_IMAGE, "media_description": "A sunset"}
+            )
+        ],
+    )
+    mocked_session.expire_all()
+    assert (
+        instagram_media_crud.get_described_media_by_user_id_described_after(
+            mocked_session,
+            user_id="test_user_id",
+            described_after=last_described_at,
+            after_row_id=described_media[-1].id,
+        )
+        == []
+    )
+
+    # The album, described after it was inserted, is returned
+    instagram_media_crud.bulk_upsert_media(
+        mocked_session,
+        [
+            helper_construct_media_from_dict(
+                {**TEST_ALBUM, "media_description": "A trip"}
+            )
+        ],
+    )
+    described_media = (
+        instagram_media_crud.get_described_media_by_user_id_described_after(
+            mocked_session,
+            user_id="test_user_id",
+            described_after=last_described_at,
+            after_row_id=described_media[-1].id,
+        )
+    )
+    assert [media.media_id for media in described_media] == [TEST_ALBUM["id"]]
+
+
+def test_archive_media_batch(mocked_session):
+    instagram_media_crud.bulk_upsert_media(
+        mocked_session,
+        [
+            helper_construct_media_from_dict(
+                {**TEST_IMAGE, "media_description": "A sunset"}
+            ),
+            helper_construct_media_from_dict(
+                {
+                    **TEST_ALBUM,
+                    "timestamp": "2024-05-02T10:00:00+0000",
+                    "media_description": "A trip",
+                }
+            ),
+            helper_construct_media_from_dict(
+                {
+                    **TEST_VIDEO,
+                    "timestamp": "2024-05-03T10:00:00+0000",
+                    "media_description": "A beach",
+                },
+                user_id="other_user_id",
+            ),
+        ],
+    )
+    windows_before = instagram_media_crud.get_described_media_windows_by_user_id(
+        mocked_session, user_id="test_user_id"
+    )
+
+    # Archived one row at a time, until nothing published before June is left
+    published_before = datetime.fromisoformat("2024-06-01T00:00:00+0000")
+    assert [
+        instagram_media_crud.archive_media_batch(
+            mocked_session, published_before, batch_size=1
+        )
+        for _ in range(3)
+    ] == [1, 1, 0]
+    mocked_session.expire_all()
+
+    album = instagram_media_crud.get_media_by_user_id_media_id(
+        mocked_session, user_id="test_user_id", media_id=TEST_ALBUM["id"]
+    )
+    assert album.media_description is None
+    assert album.archived_at is not None
+    assert album.description_hash is not None
+    assert instagram_media_archive_crud.get_descriptions_by_user_id_media_ids(
+        mocked_session, user_id="test_user_id", media_ids=[TEST_ALBUM["id"]]
+    ) == {TEST_ALBUM["id"]: "A trip"}
+
+    # Archived media still counts as described, the window summaries stay fresh
+    assert (
+        instagram_media_crud.get_described_media_windows_by_user_id(
+            mocked_session, user_id="test_user_id"
+        )
+        == windows_before
+    )
+
+
+@pytest.mark.parametrize("embedding_storage", ["full", "halfvec", "binary", "reduced"])
+def test_search_similar_media_by_user_id(mocked_session, embedding_storage):
+    sunset = [1.0] * 768 + [-1.0] * 768
+    beach = [-1.0] * 768 + [1.0] * 768
+    trip = [1.0, -1.0] * 768
+    instagram_media_crud.bulk_upsert_media(
+        mocked_session,
+        [
+            helper_construct_media_from_dict({**TEST_IMAGE, "embeddings": sunset}),
+            helper_construct_media_from_dict({**TEST_ALBUM, "embeddings": trip}),
+            helper_construct_media_from_dict({**TEST_VIDEO, "embeddings": beach}),
+            helper_construct_media_from_dict(
+                {**TEST_IMAGE, "embeddings": sunset}, user_id="other_user_id"
+            ),
+        ],
+        embedding_storage=embedding_storage,
+    )
+
+    results = instagram_media_crud.search_similar_media_by_user_id(
+        mocked_session,
+        user_id="test_user_id",
+        query_embedding=[value + 0.1 for value in sunset],
+        limit=2,
+        embedding_storage=embedding_storage,
+    )
+    assert [media.media_id for media, _ in results] == [
+        TEST_IMAGE["id"],
+        TEST_ALBUM["id"],
+    ]
+    assert results[0][1] < results[1][1]
+
+
+def test_reencode_embeddings(mocked_session):
+    sunset = [1.0] * 768 + [-1.0] * 768
+    instagram_media_crud.bulk_upsert_media(
+        mocked_session,
+        [
+            helper_construct_media_from_dict({**TEST_IMAGE, "embeddings": sunset}),
+            helper_construct_media_from_dict(TEST_VIDEO),
+        ],
+    )
+
+    # Only the media with embeddings stored in other columns than those of the mode
+    rows = instagram_media_crud.get_embeddings_to_reencode(
+        mocked_session, "binary", after_row_id=0
+    )
+    assert len(rows) == 1
+    assert (
+        instagram_media_crud.bulk_update_embeddings(
+            mocked_session,
+            [(row_id, encode(embedding, "binary")) for row_id, embedding in rows],
+        )
+        == 1
+    )
+    mocked_session.expire_all()
+
+    image = instagram_media_crud.get_media_by_user_id_media_id(
+        mocked_session, user_id="test_user_id", media_id=TEST_IMAGE["id"]
+    )
+    assert image.embeddings is None
+    assert list(image.embeddings_half) == sunset
+    assert image.embeddings_binary is not None
+    assert (
+        instagram_media_crud.get_embeddings_to_reencode(
+            mocked_session, "binary", after_row_id=0
+        )
+        == []
+    )
+
+
+def test_get_described_media_windows_by_user_id(mocked_session):
+    instagram_media_crud.bulk_upsert_media(
+        mocked_session,
+        [
+            helper_construct_media_from_dict(
+                {**TEST_IMAGE, "media_description": "A sunset"}
+            ),
+            helper_construct_media_from_dict(
+                {**TEST_VIDEO, "media_description": "A beach"}
+            ),
+            helper_construct_media_from_dict(
+                {
+                    **TEST_ALBUM,
+                    "timestamp": "2024-05-02T10:00:00+0000",
+                    "media_description": "A trip",
+                }
+            ),
+        ],
+    )
+
+    windows = instagram_media_crud.get_described_media_windows_by_user_id(
+        mocked_session, user_id="test_user_id"
+    )
+    assert [
+        (window_start.month, media_count) for window_start, media_count, _ in windows
+    ] == [
+        (5, 1),
+        (6, 2),
+    ]
+
+    june_media = instagram_media_crud.get_described_media_by_user_id_published_between(
+        mocked_session,
+        user_id="test_user_id",
+        start=windows[1][0],
+        end=windows[1][0].replace(month=7),
+    )
+    # Oldest first
+    assert [media.media_id for media in june_media] == [
+        TEST_IMAGE["id"],
+        TEST_VIDEO["id"],
+    ]
+
+
 def test_fetch_non_existent(mocked_session):
     fetched_all_instagram_user_media = (
         instagram_media_crud.get_all_media_by_user_id_media_type_desc(
@@ -220,3 +747,78 @@ def test_fetch_non_existent(mocked_session):
     )
 
     assert fetched_non_existent_media_id is None
+
+
+@asynccontextmanager
+async def helper_async_session(mocked_session):
+    # An AsyncSession on the test database of mocked_session (through asyncpg), rolled back after the test
+    url = mocked_session.get_bind().engine.url.set(drivername="postgresql+asyncpg")
+    engine = create_async_engine(url, poolclass=NullPool)
+    try:
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            try:
+                yield session
+            finally:
+                await session.rollback()
+    finally:
+        await engine.dispose()
+
+
+def test_async_crud_matches_sync(mocked_session):
+    # Run without an asyncio pytest plugin, the event loop lives for the duration of the test
+    asyncio.run(helper_async_crud_matches_sync(mocked_session))
+
+
+async def helper_async_crud_matches_sync(mocked_session):
+    async with helper_async_session(mocked_session) as mocked_async_session:
+        n = await instagram_media_crud.bulk_upsert_media_async(
+            mocked_async_session,
+            [
+                helper_construct_media_from_dict(TEST_IMAGE),
+                helper_construct_media_from_dict(TEST_VIDEO),
+            ],
+        )
+
+        assert n == 2
+
+        fetched_image = await instagram_media_crud.get_media_by_user_id_media_id_async(
+            mocked_async_session, user_id="test_user_id", media_id=TEST_IMAGE["id"]
+        )
+
+        assert fetched_image is not None
+        assert fetched_image.media_url == TEST_IMAGE["media_url"]
+
+        fetched_all_instagram_user_media = (
+            await instagram_media_crud.get_all_media_by_user_id_media_type_desc_async(
+                mocked_async_session, user_id="test_user_id"
+            )
+        )
+
+        assert [media.media_id for media in fetched_all_instagram_user_media] == [
+            TEST_VIDEO["id"],
+            TEST_IMAGE["id"],
+        ]
+
+        fetched_most_recent_instagram_user_media = (
+            await instagram_media_crud.get_n_most_recent_media_by_user_id_media_type_async(
+                mocked_async_session,
+                user_id="test_user_id",
+                n=1,
+                media_type=InstagramMediaType.IMAGE,
+            )
+        )
+
+        assert len(fetched_most_recent_instagram_user_media) == 1
+        assert fetched_most_recent_instagram_user_media[0].media_id == TEST_IMAGE["id"]
+
+        # Upserting the same media again updates in place instead of duplicating it
+        await instagram_media_crud.bulk_upsert_media_async(
+            mocked_async_session,
+            [helper_construct_media_from_dict({**TEST_IMAGE, "caption": "edited"})],
+        )
+
+        fetched_image = await instagram_media_crud.get_media_by_user_id_media_id_async(
+            mocked_async_session, user_id="test_user_id", media_id=TEST_IMAGE["id"]
+        )
+
+        assert fetched_image.caption == "edited"
@@ -0,0 +1,43 @@
+from datetime import datetime
+from models.instagram_media_archive import InstagramMediaArchive
+from crud.instagram_media_archive import instagram_media_archive_crud
+
+
+def test_get_and_delete_archived_descriptions(mocked_session):
+    mocked_session.add_all(
+        [
+            InstagramMediaArchive(
+                user_id=user_id,
+                media_id=media_id,
+                publish_timestamp=datetime(2022, 5, 1),
+                media_description=media_description,
+            )
+            for user_id, media_id, media_description in (
+                ("test_user_id", "1", "A trip"),
+                ("test_user_id", "2", None),
+                ("test_user_id", "3", "A sunset"),
+                ("other_user_id", "1", "A beach"),
+            )
+        ]
+    )
+    mocked_session.flush()
+
+    assert instagram_media_archive_crud.get_descriptions_by_user_id_media_ids(
+        mocked_session, user_id="test_user_id", media_ids=["1", "2", "4"]
+    ) == {"1": "A trip"}
+    assert (
+        instagram_media_archive_crud.get_descriptions_by_user_id_media_ids(
+            mocked_session, user_id="test_user_id", media_ids=[]
+        )
+        == {}
+    )
+
+    assert [
+        instagram_media_archive_crud.delete_archive_batch_by_user_id(
+            mocked_session, user_id="test_user_id", batch_size=2
+        )
+        for _ in range(3)
+    ] == [2, 1, 0]
+    assert instagram_media_archive_crud.get_descriptions_by_user_id_media_ids(
+        mocked_session, user_id="other_user_id", media_ids=["1"]
+    ) == {"1": "A beach"}
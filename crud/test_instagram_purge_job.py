@@ -0,0 +1,50 @@
+from crud.instagram_purge_job import instagram_purge_job_crud
+
+
+def test_purge_job_lifecycle(mocked_session):
+    instagram_purge_job_crud.create_job(
+        mocked_session,
+        confirmation_code="code_a",
+        user_id="test_user_id",
+        reason="delete",
+    )
+    instagram_purge_job_crud.create_job(
+        mocked_session,
+        confirmation_code="code_b",
+        user_id="",
+        reason="deauth",
+        status="done",
+    )
+
+    job = instagram_purge_job_crud.get_job_by_confirmation_code(
+        mocked_session, confirmation_code="code_a"
+    )
+    assert job.user_id == "test_user_id"
+    assert job.status == "pending"
+    assert job.deleted_media == 0
+
+    assert [
+        job.confirmation_code
+        for job in instagram_purge_job_crud.get_unfinished_jobs(mocked_session)
+    ] == ["code_a"]
+
+    assert (
+        instagram_purge_job_crud.update_job(
+            mocked_session, "code_a", status="done", deleted_media=3
+        )
+        == 1
+    )
+    mocked_session.expire_all()
+
+    job = instagram_purge_job_crud.get_job_by_confirmation_code(
+        mocked_session, confirmation_code="code_a"
+    )
+    assert job.status == "done"
+    assert job.deleted_media == 3
+    assert instagram_purge_job_crud.get_unfinished_jobs(mocked_session) == []
+    assert (
+        instagram_purge_job_crud.get_job_by_confirmation_code(
+            mocked_session, confirmation_code="missing"
+        )
+        is None
+    )
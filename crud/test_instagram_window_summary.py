@@ -0,0 +1,35 @@
+from datetime import datetime
+from crud.instagram_window_summary import instagram_window_summary_crud
+
+
+def test_upsert_and_delete_summaries(mocked_session):
+    for month, summary in ((5, "A trip"), (6, "Sunsets"), (6, "Sunsets and beaches")):
+        instagram_window_summary_crud.upsert_summary(
+            mocked_session,
+            user_id="test_user_id",
+            window_start=datetime(2024, month, 1),
+            summary=summary,
+            media_count=1,
+            last_media_row_id=month,
+            prompt_version="v1",
+        )
+
+    summaries = instagram_window_summary_crud.get_summaries_by_user_id(
+        mocked_session, user_id="test_user_id"
+    )
+    assert {
+        window_start.month: summary.summary
+        for window_start, summary in summaries.items()
+    } == {5: "A trip", 6: "Sunsets and beaches"}
+
+    assert (
+        instagram_window_summary_crud.delete_summaries_by_user_id(
+            mocked_session, user_id="test_user_id", window_starts=[datetime(2024, 5, 1)]
+        )
+        == 1
+    )
+    assert list(
+        instagram_window_summary_crud.get_summaries_by_user_id(
+            mocked_session, user_id="test_user_id"
+        )
+    ) == [datetime(2024, 6, 1)]
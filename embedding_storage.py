@@ -0,0 +1,190 @@
+import argparse
+import logging
+import math
+from typing import Optional
+
+from settings import get_settings
+
+"""
+Storage modes of the media embeddings, trading size and recall.
+
+An embedding is 1536 float32 (about 6KB per row, and as much again in an HNSW index). EMBEDDING_STORAGE chooses how it
+is stored, each mode in its own column of instagram_media, the columns of the other modes are left NULL:
+
+    - "full": the float32 vector (embeddings, vector(1536)), exact
+    - "halfvec": the float16 vector (embeddings_half, halfvec(1536)), half the size, the recall is unchanged in practice
+    - "binary": the sign bit of each dimension (embeddings_binary, bit(1536), 192 bytes) is what is indexed and
+      searched by hamming distance, and the BINARY_RERANK_FACTOR candidates per result are re-ranked by cosine
+      distance with the float16 vector (embeddings_half, stored but not indexed). The index is 16x smaller than halfvec's.
+    - "reduced": the first REDUCED_DIMENSIONS dimensions, normalized again (embeddings_reduced, vector(256)). Only for
+      embeddings whose leading dimensions hold most of the information, e.g. the text-embedding-3 models.
+
+Embeddings are encoded when they are written (instagram_media_crud.bulk_upsert_media), and the similarity search
+(instagram_media_crud.search_similar_media_by_user_id) queries the columns of the mode. Switching mode needs the
+stored embeddings encoded again (reencode_embeddings(), from the float32 or float16 vectors) and the index of the mode:
+
+    python embedding_storage.py reencode --mode halfvec
+    python embedding_storage.py index --mode halfvec
+
+The indexes hold the media of all users, and the search filters them by user_id. pgvector applies the filter after the
+index scan, so the search enables iterative index scans (HNSW_ITERATIVE_SCAN, pgvector 0.8+) to keep scanning until
+the limit is reached. With older pgvector versions, or many users, partial indexes per large user
+(CREATE INDEX ... WHERE user_id = '...') or a table partitioned by user_id keep the scan within the user's media.
+
+benchmarks/bench_embeddings.py measures the size, recall and latency of each mode.
+
+EMBEDDING_STORAGE_MODES: The storage modes.
+encode(): The column values of an embedding in a storage mode.
+quantize_binary(), reduce_dimensions(): The binary and reduced encodings.
+index_statement(): The statement creating the similarity index of a storage mode.
+reencode_embeddings(): Encode the stored embeddings again in a storage mode, in batches.
+"""
+
+EMBEDDING_STORAGE_MODES = ("full", "halfvec", "binary", "reduced")
+EMBEDDING_DIMENSIONS = 1536
+REDUCED_DIMENSIONS = 256
+# Candidates fetched by hamming distance per result of a binary search, re-ranked with the float16 vectors
+BINARY_RERANK_FACTOR = 10
+# hnsw.iterative_scan of the similarity search (pgvector 0.8+). The HNSW indexes are global, the user_id filter is applied
+# to the ef_search nearest rows of all users, so without iterative scans a user can get fewer results than the limit.
+HNSW_ITERATIVE_SCAN = "strict_order"
+# The instagram_media column of each encoding
+EMBEDDING_COLUMNS = (
+    "embeddings",
+    "embeddings_half",
+    "embeddings_binary",
+    "embeddings_reduced",
+)
+# The columns set in each mode
+STORAGE_MODE_COLUMNS = {
+    "full": ("embeddings",),
+    "halfvec": ("embeddings_half",),
+    "binary": ("embeddings_binary", "embeddings_half"),
+    "reduced": ("embeddings_reduced",),
+}
+# The indexed column of each mode, and its HNSW operator class
+_INDEXED_COLUMNS = {
+    "full": ("embeddings", "vector_cosine_ops"),
+    "halfvec": ("embeddings_half", "halfvec_cosine_ops"),
+    "binary": ("embeddings_binary", "bit_hamming_ops"),
+    "reduced": ("embeddings_reduced", "vector_cosine_ops"),
+}
+
+logger = logging.getLogger(__name__)
+
+
+def encode(embedding: Optional[list[float]], mode: str = "full") -> dict:
+    """
+    Encode an embedding in a storage mode.
+
+    Args:
+        embedding (list[float]): The float embedding, None if the media has none.
+        mode (str): Optional. "full", "halfvec", "binary" or "reduced" (see EMBEDDING_STORAGE_MODES).
+
+    Returns:
+        dict: the value of every embedding column (see EMBEDDING_COLUMNS), None for the columns not used by the mode
+            (see STORAGE_MODE_COLUMNS).
+    """
+    if mode not in EMBEDDING_STORAGE_MODES:
+        raise ValueError(f"Unknown embedding storage mode: {mode}")
+    values = dict.fromkeys(EMBEDDING_COLUMNS)
+    if embedding is None:
+        return values
+    embedding = [float(value) for value in embedding]
+    if mode == "full":
+        values["embeddings"] = embedding
+    elif mode == "halfvec":
+        values["embeddings_half"] = embedding
+    elif mode == "binary":
+        values["embeddings_binary"] = quantize_binary(embedding)
+        values["embeddings_half"] = embedding
+    else:
+        values["embeddings_reduced"] = reduce_dimensions(embedding)
+    return values
+
+
+def quantize_binary(embedding: list[float]) -> str:
+    """The sign bit of each dimension, as a bit string ("1" for positive values)."""
+    return "".join("1" if value > 0 else "0" for value in embedding)
+
+
+def reduce_dimensions(
+    embedding: list[float], dimensions: int = REDUCED_DIMENSIONS
+) -> list[float]:
+    """The first dimensions of an embedding, normalized again to unit length."""
+    reduced = [float(value) for value in embedding[:dimensions]]
+    norm = math.sqrt(sum(value * value for value in reduced))
+    return [value / norm for value in reduced] if norm else reduced
+
+
+def index_statement(mode: str) -> str:
+    """The statement creating the HNSW similarity index of the column searched in a storage mode."""
+    column, operator_class = _INDEXED_COLUMNS[mode]
+    return (
+        f"CREATE INDEX IF NOT EXISTS ix_instagram_media_{column}_hnsw "
+        f"ON instagram_media USING hnsw ({column} {operator_class})"
+    )
+
+
+def reencode_embeddings(mode: Optional[str] = None, batch_size: int = 1000) -> int:
+    """
+    Encode the stored embeddings again in a storage mode, from their float32 or float16 vectors, in batches.
+    Embeddings stored only in binary or reduced form cannot be encoded again, they are left as they are.
+
+    Args:
+        mode (str): Optional. The storage mode to encode the embeddings in, EMBEDDING_STORAGE by default.
+        batch_size (int): Optional. The number of rows encoded per transaction.
+
+    Returns:
+        int: the number of rows encoded again.
+    """
+    from crud.instagram_media import instagram_media_crud
+    from utils import SessionLocal
+
+    mode = mode or get_settings().embedding_storage
+    reencoded = 0
+    after_row_id = 0
+    while True:
+        with SessionLocal() as db:
+            rows = instagram_media_crud.get_embeddings_to_reencode(
+                db, mode, after_row_id, batch_size
+            )
+            instagram_media_crud.bulk_update_embeddings(
+                db,
+                [(row_id, encode(embedding, mode)) for row_id, embedding in rows],
+            )
+            db.commit()
+        reencoded += len(rows)
+        if len(rows) < batch_size:
+            return reencoded
+        after_row_id = rows[-1][0]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Switch the storage mode of the media embeddings."
+    )
+    parser.add_argument(
+        "command",
+        choices=("reencode", "index"),
+        help="encode the stored embeddings again, or print the index statement",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=EMBEDDING_STORAGE_MODES,
+        default=get_settings().embedding_storage,
+    )
+    args = parser.parse_args()
+
+    if args.command == "index":
+        print(index_statement(args.mode) + ";")
+        return
+    from utils import SessionLocal, init_db
+
+    logging.basicConfig(level=logging.INFO)
+    SessionLocal.configure(bind=init_db())
+    logger.info(f"Encoded {reencode_embeddings(args.mode)} embeddings as {args.mode}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,46 @@
-from datetime import datetime, timedelta
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlparse
 from time import perf_counter
+import hashlib
+import json
 import os
+import re
+import uuid
 import basic_display_api
-from crud.instagram_media import instagram_media_crud
-from models.instagram_media import InstagramMedia
+from models.instagram_media_record import InstagramMediaRecord
 from models.types.instagram_media_type import InstagramMediaType
-from dotenv import load_dotenv
 from social_media_processor import SocialMediaProcessor
 from models.user import User
-from utils import read_prompt_file, init_db, SessionLocal, call_OAI
+from lazy_imports import lazy_import
+from settings import get_settings
+from utils import read_prompt_file, init_db, init_async_db, call_OAI
 import concurrent.futures
-import json_validation
+import media_preprocessing
+import perceptual_hash
+import profiling
+import tracing
+import usage
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Optional, Union
+
+# SQLAlchemy, pgvector (crud, models, session factories) and Pydantic (json_validation) are imported on first use
+instagram_media_crud = lazy_import("crud.instagram_media", "instagram_media_crud")
+instagram_media_archive_crud = lazy_import(
+    "crud.instagram_media_archive", "instagram_media_archive_crud"
+)
+instagram_enrichment_state_crud = lazy_import(
+    "crud.instagram_enrichment_state", "instagram_enrichment_state_crud"
+)
+instagram_window_summary_crud = lazy_import(
+    "crud.instagram_window_summary", "instagram_window_summary_crud"
+)
+InstagramMedia = lazy_import("models.instagram_media", "InstagramMedia")
+SessionLocal = lazy_import("utils", "SessionLocal")
+AsyncSessionLocal = lazy_import("utils", "AsyncSessionLocal")
+json_validation = lazy_import("json_validation")
 
 """
     This defines the implementation of a Instagram Processer class, which inherits from the SocialMediaProcessor class.
@@ -23,24 +53,51 @@ import json_validation
 """
 
 
-env_path = ".env"
-load_dotenv(dotenv_path=env_path)
+@lru_cache(maxsize=None)
+def _configure_tracing() -> None:
+    # The exporter of the traces of the runs, set from the settings by the first run of the process
+    settings = get_settings()
+    tracing.set_exporter(
+        tracing.get_exporter(
+            settings.trace_exporter,
+            path=settings.trace_file,
+            endpoint=settings.trace_otlp_endpoint,
+        )
+    )
+
+
+@lru_cache(maxsize=None)
+def _global_perceptual_hash_index() -> perceptual_hash.PerceptualHashIndex:
+    # Descriptions of the images described by this process, shared across users when PERCEPTUAL_HASH_SCOPE is "global"
+    return perceptual_hash.PerceptualHashIndex(
+        get_settings().perceptual_hash_max_distance
+    )
+
 
-# Load environment variables
-INSTAGRAM_CLIENT_ID = os.getenv("INSTAGRAM_CLIENT_ID")
-INSTAGRAM_CLIENT_SECRET = os.getenv("INSTAGRAM_CLIENT_SECRET")
-INSTAGRAM_AUTH_CALLBACK_URI = os.getenv("INSTAGRAM_AUTH_CALLBACK_URI")
-DEBUG = os.getenv("DEBUG") == "1"
-DESCRIBE_IMAGE_PROMPT = os.getenv("DESCRIBE_IMAGE_PROMPT")
-DESCRIBE_ALBUM_PROMPT = os.getenv("DESCRIBE_ALBUM_PROMPT")
-MODEL = os.getenv("MODEL")
+# Token and secret values, as dict items or url query parameters, e.g. in the token responses or in HTTP error messages
+_SECRET_PATTERN = re.compile(
+    r"((?:access_token|client_secret)['\"]?\s*[:=]\s*['\"]?)[^'\"&\s,}]+"
+)
 
 
 def debug(*args, **kwargs):
-    if DEBUG:
+    recording = tracing.recording()
+    if not recording and not get_settings().debug:
+        return
+    message = _SECRET_PATTERN.sub(r"\1<redacted>", " ".join(str(arg) for arg in args))
+    # Recorded on the current span, so the messages of concurrent workers can be told apart in the trace
+    if recording:
+        tracing.event(message)
+    if get_settings().debug:
         print("=" * 10, "DEBUG", "=" * 10)  # noqa
-        print(*args, **kwargs)  # noqa
-        pass
+        print(message, **kwargs)  # noqa
+
+
+@contextmanager
+def _stage(name: str):
+    # A stage of a run, traced and (when profiling is enabled) profiled
+    with tracing.span(name), profiling.stage(name):
+        yield
 
 
 class InstagramProcesser(SocialMediaProcessor):
@@ -64,42 +121,106 @@ class InstagramProcesser(SocialMediaProcessor):
             basic_display_api.refresh_access_token(self.token.auth_info["access_token"])
             pass
 
-    def run(self) -> dict:
+    def run(
+        self,
+        mode: str = "sync",
+        profile: Optional[str] = None,
+        media_ids: Optional[list[str]] = None,
+    ) -> dict:
         """
         Runs the Instagram Processor.
 
         This function fetches Instagram media data, extracts and preprocesses the data,
         saves the fetched media data to the database, process the data, and prints a completion message.
 
+        Args:
+            mode (str): Optional. "sync" fetches and processes new media. "refresh" only refreshes expiring urls and edited captions of stored media.
+            profile (str): Optional. Profile each stage of the run, "cprofile" or "sampling" (see profiling.py). Defaults to PROFILE_MODE.
+            media_ids (list[str]): Optional. Only fetch and process these media (e.g. notified by a webhook) instead of listing /me/media.
+
         Returns:
-            dict: return data if the processing process completes successfully. None otherwise.
+            dict: return data, including the run id, the usage of the model calls and the profile files, if the processing process completes successfully. None otherwise.
         """
-        try:
-            # Fetch the Instagram media data
-            media_data = self.fetch_data()
-
-            if not media_data or len(media_data) == 0:
-                debug("No new media to fetch.")
-                return None
-            # Extract and preprocess the media data
-            media_objs = self.extract_and_preprocess(media_data)
-
-            if not media_objs or len(media_objs) == 0:
-                debug("No new media to process.")
-                return None
-
-            # Save the fetched media data to the db
-            self.save_data_to_db(media_objs)
-
-            # Process and enrich the data as desired
-            result = self.enrich()
-
-            debug("Instagram Processing Complete.")
+        _configure_tracing()
+        settings = get_settings()
+        run_id = uuid.uuid4().hex
+        with tracing.span(
+            "instagram.run", run_id=run_id, user_id=self.user.user_id, mode=mode
+        ):
+            if mode == "refresh":
+                try:
+                    return {"refreshed_media": self.refresh_media()}
+                except Exception as e:
+                    debug(f"Error: {e}")
+                    return {}
+
+            self.usage_tracker = usage.UsageTracker(
+                self.user.user_id,
+                budget=usage.UsageBudget(
+                    max_tokens=settings.usage_budget_tokens or None,
+                    max_images=settings.usage_budget_images or None,
+                    max_cost=settings.usage_budget_cost or None,
+                ),
+                prompt_price=settings.llm_prompt_price,
+                completion_price=settings.llm_completion_price,
+            )
+            profile = profile or settings.profile_mode
+            profiler = None
+            if profile != "off":
+                # The profiles are named after the run, to find them from its trace
+                profiler = profiling.RunProfiler(
+                    f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{run_id}",
+                    profile,
+                    output_dir=settings.profile_dir,
+                    interval=settings.profile_interval,
+                )
+            try:
+                with profiling.profile(profiler):
+                    # Fetch the Instagram media data
+                    with _stage("fetch_data"):
+                        media_data = (
+                            self.fetch_media(media_ids)
+                            if media_ids
+                            else self.fetch_data()
+                        )
 
-            return result
-        except Exception as e:
-            debug(f"Error: {e}")
-            return {}
+                    if not media_data or len(media_data) == 0:
+                        debug("No new media to fetch.")
+                        return None
+                    with usage.track(self.usage_tracker):
+                        # Extract and preprocess the media data
+                        with _stage("extract_and_preprocess"):
+                            media_objs = self.extract_and_preprocess(media_data)
+
+                        if not media_objs or len(media_objs) == 0:
+                            debug("No new media to process.")
+                            return None
+
+                        # Save the fetched media data to the db
+                        with _stage("save_data_to_db"):
+                            self.save_data_to_db(media_objs)
+
+                        # Process and enrich the data as desired
+                        with _stage("enrich"):
+                            result = self.enrich()
+                debug("Usage:", self.usage_tracker.as_dict())
+                if profiler is not None:
+                    debug("Profiles:", profiler.paths)
+
+                debug("Instagram Processing Complete.")
+
+                if result is not None:
+                    result["run_id"] = run_id
+                    result["usage"] = self.usage_tracker.as_dict()
+                    if profiler is not None:
+                        result["profiles"] = profiler.paths
+                return result
+            except Exception as e:
+                debug(f"Error: {e}")
+                return {}
+            finally:
+                # Also the runs that spent tokens before finding nothing to store, or failing
+                self.usage_tracker.finish()
 
     def authorize(self) -> bool:
         """
@@ -137,114 +258,503 @@ class InstagramProcesser(SocialMediaProcessor):
         Fetches new Instagram media data from the Instagram API.
 
         Returns:
-            list[InstagramMedia]: a list of raw Instagram media json objects.
+            list[json_validation.InstagramMedia]: a list of validated Instagram media objects.
         """
 
-        user_media_data = basic_display_api.get_user_media(
-            self.token.auth_info["access_token"]
-        )
+        access_token = self.token.auth_info["access_token"]
 
-        json_validation.validate_json_types(
-            user_media_data, json_validation.InstagramMediaList
+        # A user with stored media only needs an incremental sync
+        with SessionLocal() as db:
+            incremental = bool(
+                instagram_media_crud.get_n_most_recent_media_by_user_id_media_type(
+                    db,
+                    self.user.user_id,
+                    n=1,
+                )
+            )
+            # Media deferred over budget by an earlier sync, wherever they are in the listing
+            unseen_deferred_media_ids = (
+                set(
+                    instagram_media_crud.get_media_ids_by_user_id_description_hash(
+                        db, self.user.user_id, DEFERRED_DESCRIPTION_HASH
+                    )
+                )
+                if incremental
+                else set()
+            )
+
+        # Look up the fetched media in the db, so only new or changed media is described
+        stored_description_hashes = {}
+
+        def lookup_stored(page: list[dict]) -> bool:
+            with SessionLocal() as db:
+                stored_description_hashes.update(
+                    instagram_media_crud.get_description_hashes_by_user_id_media_ids(
+                        db,
+                        self.user.user_id,
+                        [media["id"] for media in page],
+                        published_since=_oldest_timestamp(page),
+                    )
+                )
+            unseen_deferred_media_ids.difference_update(media["id"] for media in page)
+            return not unseen_deferred_media_ids and not any(
+                _is_new_or_changed_media(media, stored_description_hashes)
+                for media in page
+            )
+
+        # An incremental sync lists only the fields needed to diff against the db, page by page, and stops at the
+        # first page whose media are all stored, unchanged and not deferred, once every deferred media was listed: the
+        # older media was synced before (edited captions of older media are picked up by run(mode="refresh")). A deferred
+        # media deleted from the account keeps every listing going up to MEDIA_MAX_ITEMS.
+        # The full fields of the new or changed media are fetched afterwards.
+        user_media_data = basic_display_api.get_user_media(
+            access_token,
+            profile="diff" if incremental else "full",
+            page_size=get_settings().media_page_size,
+            max_items=get_settings().media_max_items,
+            until=lookup_stored if incremental else None,
         )
 
         api_fetched_media = user_media_data["data"]
 
         debug("Fetched Images:", len(api_fetched_media))
 
-        # Fetch the latest media from the db to compare with the media fetched from the API
+        # A first sync looks up every fetched media in a single query
+        if not incremental:
+            lookup_stored(api_fetched_media)
+
+        new_media = [
+            media
+            for media in api_fetched_media
+            if _is_new_or_changed_media(media, stored_description_hashes)
+        ]
+
+        debug("New or changed media:", len(new_media))
+
+        if incremental and new_media:
+            full_media = _fetch_media_by_ids(
+                [media["id"] for media in new_media], access_token, profile="full"
+            )
+            new_media = [
+                full_media[media["id"]]
+                for media in new_media
+                if media["id"] in full_media
+            ]
+
+        # Only the albums that will be described need their full list of children
+        basic_display_api.resolve_carousel_children(new_media, access_token)
+
+        # The new media is validated once, into the typed objects passed downstream
+        return _parse_media_list(new_media)
+
+    def fetch_media(self, media_ids: list[str]) -> list[json_validation.InstagramMedia]:
+        """
+        Fetches only the given Instagram media from the Instagram API, e.g. the media notified by a webhook,
+        without listing /me/media. Media that is already stored unchanged, or that fails to fetch (e.g. deleted), is left out.
+
+        Args:
+            media_ids (list[str]): The ids of the media to fetch.
+
+        Returns:
+            list[json_validation.InstagramMedia]: a list of validated Instagram media objects.
+        """
+        access_token = self.token.auth_info["access_token"]
+
+        fetched_media = _fetch_media_by_ids(media_ids, access_token, profile="full")
         with SessionLocal() as db:
-            db_fetched_media = (
-                instagram_media_crud.get_n_most_recent_media_by_user_id_media_type(
+            stored_description_hashes = (
+                instagram_media_crud.get_description_hashes_by_user_id_media_ids(
                     db,
                     self.user.user_id,
-                    n=1,
+                    list(fetched_media),
+                    published_since=_oldest_timestamp(fetched_media.values()),
                 )
             )
-        if db_fetched_media:
-            db_fetched_media = db_fetched_media[0]
-            new_media = []
-            for media in api_fetched_media:
-                if media["id"] == db_fetched_media.media_id:
-                    break
-                new_media.append(media)
-            return new_media
-
-        else:
-            return api_fetched_media
+        new_media = [
+            media
+            for media in fetched_media.values()
+            if _is_new_or_changed_media(media, stored_description_hashes)
+        ]
+        debug("Fetched media:", len(fetched_media), "New or changed:", len(new_media))
 
-        return api_fetched_media
+        basic_display_api.resolve_carousel_children(new_media, access_token)
+        return _parse_media_list(new_media)
 
     def extract_and_preprocess(
-        self, data: json_validation.InstagramMedia
-    ) -> list[InstagramMedia]:
+        self, data: list[json_validation.InstagramMedia]
+    ) -> list[InstagramMediaRecord]:
         """
-        Extract and preprocess the Instagram media raw data to construct media objects.
+        Extract and preprocess the Instagram media data to construct media objects.
         Generates media description for each media object on the fly.
 
         Args:
-            data (list[json_validation.InstagramMedia]): a list of raw Instagram media json objects.
+            data (list[json_validation.InstagramMedia]): a list of validated Instagram media objects.
 
         Returns:
-            list[InstagramMedia]: a list of preprocessed InstagramMedia objects.
+            list[InstagramMediaRecord]: a list of preprocessed InstagramMediaRecord objects.
         """
         media_objs = construct_instagram_media(self.user.user_id, data)
 
         debug("Preprocessed Images:", len(media_objs))
         return media_objs
 
-    def save_data_to_db(self, data: list[InstagramMedia]) -> int:
+    def save_data_to_db(self, data: list[InstagramMediaRecord]) -> int:
         """
         Saves the fetched Instagram media data to the database.
 
         Args:
-            data (list[InstagramMedia]): a list of preprocessed InstagramMedia objects.
+            data (list[InstagramMediaRecord]): a list of preprocessed InstagramMediaRecord objects.
 
         Returns:
             int: the number of media objects inserted into the db.
         """
         with SessionLocal() as db:
-            n = instagram_media_crud.bulk_upsert_media(db, data)
+            n = instagram_media_crud.bulk_upsert_media(
+                db, data, embedding_storage=get_settings().embedding_storage
+            )
             db.commit()
             return n
 
-    def enrich(self) -> dict:
+    async def save_data_to_db_async(self, data: list[InstagramMediaRecord]) -> int:
         """
-        Process the data as desired and save it to the database.
+        Async version of save_data_to_db, for callers running inside an event loop.
+
+        Args:
+            data (list[InstagramMediaRecord]): a list of preprocessed InstagramMediaRecord objects.
 
         Returns:
-            dict: processed data if the processing process completes successfully. None otherwise.
+            int: the number of media objects inserted into the db.
         """
-        debug("Processing Instagram data...")
+        async with AsyncSessionLocal() as db:
+            n = await instagram_media_crud.bulk_upsert_media_async(
+                db, data, embedding_storage=get_settings().embedding_storage
+            )
+            await db.commit()
+            return n
+
+    def refresh_media(self, expiry_window: timedelta = None) -> int:
+        """
+        Refreshes stored media whose signed CDN urls are about to expire.
+        Only id,caption,media_url,thumbnail_url are re-fetched, by paging /me/media until every expiring media is found.
+        Changed urls are updated in bulk, and media is described again only when its caption was edited.
+        Every checked media records its check, so media whose urls are unchanged or have no known expiry
+        is not checked again before URL_RECHECK_HOURS.
+
+        Args:
+            expiry_window (timedelta): Optional. Refresh media whose urls expire within this window.
+
+        Returns:
+            int: the number of media objects updated in the db.
+        """
+        settings = get_settings()
+        if expiry_window is None:
+            expiry_window = timedelta(hours=settings.url_refresh_window_hours)
+        access_token = self.token.auth_info["access_token"]
+        now = _utcnow()
 
-        # Fetch the media data from the db
         with SessionLocal() as db:
-            fetched_images = None
+            stored_media = instagram_media_crud.get_media_with_expiring_urls_by_user_id(
+                db,
+                self.user.user_id,
+                expires_before=now + expiry_window,
+                checked_before=now - timedelta(hours=settings.url_recheck_hours),
+            )
+        debug("Media with expiring urls:", len(stored_media))
+        if not stored_media:
+            return 0
+
+        fetched_media = _list_media_by_ids(
+            {media.media_id for media in stored_media},
+            access_token,
+            profile="refresh",
+        )
 
-            fetched_albums = None
+        url_updates = []
+        refreshed_urls = 0
+        recaptioned_media_ids = []
+        for media in stored_media:
+            fetched = fetched_media.get(media.media_id)
+            if fetched is None:
+                url_updates.append({"media_id": media.media_id, "url_checked_at": now})
+                continue
+
+            # Album children inherit the album caption, so only top level captions are compared
+            if (
+                media.parent_media_id is None
+                and fetched.get("caption") != media.caption
+            ):
+                recaptioned_media_ids.append(media.media_id)
+                continue
+
+            changed_fields = {
+                field: fetched[field]
+                for field in ("media_url", "thumbnail_url")
+                if fetched.get(field) and fetched[field] != getattr(media, field)
+            }
+            if changed_fields:
+                changed_fields["url_expires_at"] = parse_url_expiry(
+                    fetched.get("media_url") or media.media_url,
+                    fetched.get("thumbnail_url") or media.thumbnail_url,
+                )
+                refreshed_urls += 1
+            url_updates.append(
+                {"media_id": media.media_id, "url_checked_at": now, **changed_fields}
+            )
 
-            fetched_videos = None
+        # Edited captions change the description, so these media go through the full pipeline again
+        media_objs = []
+        if recaptioned_media_ids:
+            recaptioned_media = _fetch_media_by_ids(
+                recaptioned_media_ids, access_token, profile="full"
+            )
+            basic_display_api.resolve_carousel_children(
+                list(recaptioned_media.values()), access_token
+            )
+            media_objs = construct_instagram_media(
+                self.user.user_id,
+                _parse_media_list(list(recaptioned_media.values())),
+            )
 
-            fetched_images.extend(fetched_albums)
-            fetched_images.extend(fetched_videos)
-        debug("Formating media for analysis and post processing...")
-        formatted_results = format_crud_results(fetched_images)
+        debug("Refreshed urls:", refreshed_urls, "Edited captions:", len(media_objs))
 
-        if not formatted_results or len(formatted_results) == 0:
+        with SessionLocal() as db:
+            instagram_media_crud.bulk_update_media_fields(
+                db, self.user.user_id, url_updates
+            )
+            n = refreshed_urls
+            if media_objs:
+                n += instagram_media_crud.bulk_upsert_media(
+                    db, media_objs, embedding_storage=settings.embedding_storage
+                )
+            db.commit()
+        return n
+
+    def enrich(self) -> dict:
+        """
+        Fold the media described since the last enrichment (new, or described again e.g. after a caption edit) into the user's rolling profile,
+        and save it to the database. The profile is folded again from scratch when the prompt changes.
+        Only the new media is loaded and sent to the model, in batches of ENRICH_BATCH_SIZE, and the state is saved after each batch,
+        so the cost of an enrichment is proportional to the new posts rather than to the size of the account.
+
+        With ENRICH_MODE "map_reduce", the profile is built by enrich_map_reduce() instead.
+
+        Returns:
+            dict: the profile and the number of media folded into it if the processing process completes successfully. None otherwise.
+        """
+        if get_settings().enrich_mode == "map_reduce":
+            return self.enrich_map_reduce()
+
+        debug("Processing Instagram data...")
+        user_id = self.user.user_id
+        prompt_version = get_prompt_version(get_settings().enrich_profile_prompt)
+
+        try:
+            with SessionLocal() as db:
+                state = instagram_enrichment_state_crud.get_state_by_user_id(
+                    db, user_id
+                )
+            profile, media_count = None, 0
+            last_described_at, last_media_row_id = None, 0
+            # A profile built with another prompt (or before described_at was tracked) is folded again from scratch
+            if (
+                state
+                and state.prompt_version == prompt_version
+                and state.last_described_at is not None
+            ):
+                profile, media_count = state.profile, state.media_count
+                last_described_at = state.last_described_at
+                last_media_row_id = state.last_media_row_id
+
+            folded_media = 0
+            while True:
+                # Fetch only the media described since the last enrichment from the db, new or described again
+                with SessionLocal() as db:
+                    new_media = instagram_media_crud.get_described_media_by_user_id_described_after(
+                        db,
+                        user_id,
+                        last_described_at,
+                        last_media_row_id,
+                        limit=get_settings().enrich_batch_size,
+                    )
+                if not new_media:
+                    break
+
+                debug("Formating media for analysis and post processing...")
+                formatted_results = format_crud_results(new_media)
+                debug("Enriching data ... with {} media".format(len(formatted_results)))
+                if formatted_results:
+                    profile = fold_media_into_profile(profile, formatted_results)
+                    if profile is None:
+                        return None
+
+                media_count += len(formatted_results)
+                folded_media += len(formatted_results)
+                last_described_at = (
+                    new_media[-1].described_at or new_media[-1].created_at
+                )
+                last_media_row_id = new_media[-1].id
+                with SessionLocal() as db:
+                    debug("Saving result to DB...")
+                    instagram_enrichment_state_crud.upsert_state(
+                        db,
+                        user_id,
+                        profile=profile,
+                        media_count=media_count,
+                        last_media_row_id=last_media_row_id,
+                        prompt_version=prompt_version,
+                        last_described_at=last_described_at,
+                    )
+                    db.commit()
+
+        except Exception as e:
+            debug("Error:", e)
             return None
+        return {
+            "profile": profile,
+            "media_count": media_count,
+            "folded_media": folded_media,
+        }
+
+    def enrich_map_reduce(self) -> dict:
+        """
+        Build the user's profile hierarchically, for users with very large media histories.
+        The described media is split into calendar month windows of publish_timestamp, each window is summarized (in parallel, by at most
+        ENRICH_MAX_WORKERS model calls) and cached in the database, and the window summaries are reduced into the profile.
+        Only the windows whose media changed since they were cached are summarized again, and nothing is reduced when none changed.
+
+        Returns:
+            dict: the profile, the number of media it covers and the number of windows summarized if the processing process completes successfully. None otherwise.
+        """
+        debug("Processing Instagram data (map reduce)...")
+        user_id = self.user.user_id
+        window_prompt_version = get_prompt_version(get_settings().enrich_profile_prompt)
+        reduce_prompt_version = get_prompt_version(get_settings().enrich_reduce_prompt)
+
         try:
-            debug("Enriching data ... with {} images".format(len(formatted_results)))
+            with SessionLocal() as db:
+                windows = instagram_media_crud.get_described_media_windows_by_user_id(
+                    db, user_id
+                )
+                cached = instagram_window_summary_crud.get_summaries_by_user_id(
+                    db, user_id
+                )
+                state = instagram_enrichment_state_crud.get_state_by_user_id(
+                    db, user_id
+                )
+
+            # The descriptions of the windows dropped by the retention policy are gone, their cached summaries are kept
+            frozen_before = (
+                _utcnow() - timedelta(days=get_settings().media_retention_days)
+                if get_settings().media_retention_mode == "drop"
+                else None
+            )
+            stale_windows = [
+                (window_start, media_count, last_media_row_id)
+                for window_start, media_count, last_media_row_id in windows
+                if window_start not in cached
+                or (
+                    (
+                        cached[window_start].media_count,
+                        cached[window_start].last_media_row_id,
+                        cached[window_start].prompt_version,
+                    )
+                    != (media_count, last_media_row_id, window_prompt_version)
+                    and not (
+                        frozen_before and _window_end(window_start) <= frozen_before
+                    )
+                )
+            ]
+            removed_windows = [
+                window_start
+                for window_start in cached
+                if window_start not in {window[0] for window in windows}
+            ]
+            debug("Summarizing windows:", len(stale_windows), "of", len(windows))
+
+            if (
+                state
+                and state.prompt_version == reduce_prompt_version
+                and not stale_windows
+                and not removed_windows
+            ):
+                return {
+                    "profile": state.profile,
+                    "media_count": state.media_count,
+                    "summarized_windows": 0,
+                }
+
+            summaries = {
+                window_start: summary.summary
+                for window_start, summary in cached.items()
+            }
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=get_settings().enrich_max_workers
+            ) as executor:
+                futures = {
+                    usage.submit_in_context(
+                        executor, summarize_window, user_id, window[0]
+                    ): window
+                    for window in stale_windows
+                }
+                for future in concurrent.futures.as_completed(futures):
+                    window_start, media_count, last_media_row_id = futures[future]
+                    summary = future.result()
+                    if summary is None:
+                        continue
+                    summaries[window_start] = summary
+                    with SessionLocal() as db:
+                        instagram_window_summary_crud.upsert_summary(
+                            db,
+                            user_id,
+                            window_start,
+                            summary=summary,
+                            media_count=media_count,
+                            last_media_row_id=last_media_row_id,
+                            prompt_version=window_prompt_version,
+                        )
+                        db.commit()
 
-            # Process the data as desired here
-            # call_OAI(model=MODEL, messages=messages)
+            # Windows whose summary failed are summarized again by the next run
+            if any(window[0] not in summaries for window in stale_windows):
+                return None
 
+            if removed_windows:
+                with SessionLocal() as db:
+                    instagram_window_summary_crud.delete_summaries_by_user_id(
+                        db, user_id, removed_windows
+                    )
+                    db.commit()
+
+            profile = reduce_window_summaries(
+                [
+                    (window_start, summaries[window_start])
+                    for window_start, _, _ in windows
+                ]
+            )
+            if windows and profile is None:
+                return None
+
+            media_count = sum(window[1] for window in windows)
             with SessionLocal() as db:
                 debug("Saving result to DB...")
+                instagram_enrichment_state_crud.upsert_state(
+                    db,
+                    user_id,
+                    profile=profile,
+                    media_count=media_count,
+                    last_media_row_id=max((window[2] for window in windows), default=0),
+                    prompt_version=reduce_prompt_version,
+                )
+                db.commit()
 
         except Exception as e:
             debug("Error:", e)
             return None
-        return {}
+        return {
+            "profile": profile,
+            "media_count": media_count,
+            "summarized_windows": len(stale_windows),
+        }
 
 
 def get_instagram_access_token_profile_info(authorization_code: str) -> dict:
@@ -262,9 +772,9 @@ def get_instagram_access_token_profile_info(authorization_code: str) -> dict:
         # Get the short-lived access token
 
         short_lived_token = basic_display_api.get_short_access_token(
-            INSTAGRAM_CLIENT_ID,
-            INSTAGRAM_CLIENT_SECRET,
-            INSTAGRAM_AUTH_CALLBACK_URI,
+            get_settings().instagram_client_id,
+            get_settings().instagram_client_secret,
+            get_settings().instagram_auth_callback_uri,
             authorization_code,
         )
 
@@ -275,7 +785,7 @@ def get_instagram_access_token_profile_info(authorization_code: str) -> dict:
 
         # Exchange the short-lived token for a long-lived one
         long_lived_token = basic_display_api.exchange_for_long_lived_token(
-            short_lived_token["access_token"], INSTAGRAM_CLIENT_SECRET
+            short_lived_token["access_token"], get_settings().instagram_client_secret
         )
 
         json_validation.validate_json_types(
@@ -309,61 +819,181 @@ def construct_instagram_media(
     user_id: str,
     raw_media_list: list[json_validation.InstagramMedia],
     num_workers=14,
-) -> list[InstagramMedia]:
+) -> list[InstagramMediaRecord]:
     """
     Construct Instagram media objects from raw_media_list.
     Generate media description for each media object.
 
     Args:
         user_id (str): The user_id associated with the active instagram access token.
-        raw_media_list (list[json_validation.InstagramMedia]): a list of raw Instagram media json objects.
+        raw_media_list (list[json_validation.InstagramMedia]): a list of validated Instagram media objects.
         num_workers (int): Optional. The number of worker threads to use for processing the media objects.
 
     Returns:
-        list[InstagramMedia]: a list of preprocessed InstagramMedia objects.
+        list[InstagramMediaRecord]: a list of preprocessed InstagramMediaRecord objects.
     """
 
+    settings = get_settings()
+    # Download and downscale every image up front, so the workers only wait on the model
+    image_urls = _image_urls(raw_media_list)
+    with tracing.span("prepare_images", images=len(image_urls)):
+        prepared_images = media_preprocessing.prepare_images(
+            image_urls,
+            policy=settings.image_policy,
+            target_size=settings.image_target_size,
+        )
+    debug(
+        "Preprocessed images:",
+        media_preprocessing.summarize_prepared_images(prepared_images.values()),
+    )
+    # Keyframe extraction is capped per sync, in videos and in time, the remaining videos are described from their thumbnail
+    video_sources = _video_sources(raw_media_list)
+    with tracing.span("prepare_videos", videos=len(video_sources)):
+        prepared_videos = media_preprocessing.prepare_videos(
+            video_sources,
+            policy=settings.video_policy,
+            image_policy=settings.image_policy,
+            target_size=settings.image_target_size,
+            max_frames=settings.video_frames,
+            max_videos=settings.video_max_per_sync,
+            workers=settings.video_workers,
+            deadline=settings.video_deadline_seconds,
+        )
+    debug(
+        "Preprocessed videos:",
+        len(prepared_videos),
+        media_preprocessing.summarize_prepared_images(
+            frame for frames in prepared_videos.values() for frame in frames
+        ),
+    )
+
+    # Reuse the descriptions of near-duplicate images instead of describing them again
+    image_prompt_version = get_prompt_version(settings.describe_image_prompt)
+    album_prompt_version = get_prompt_version(
+        settings.describe_album_prompt
+        if settings.album_description_mode == "images"
+        else settings.describe_album_from_children_prompt
+    )
+    reused_descriptions, duplicate_of = _find_duplicate_images(
+        user_id,
+        prepared_images,
+        image_prompt_version,
+        _image_description_hashes(raw_media_list),
+    )
+    debug(
+        "Reused image descriptions:",
+        len(reused_descriptions),
+        "Duplicate images:",
+        len(duplicate_of),
+    )
+
+    def construct_media(media, caption=None, parent_media_id=None):
+        with tracing.span(
+            "describe_media",
+            media_id=media.id,
+            media_type=media.media_type,
+            parent_media_id=parent_media_id,
+        ):
+            image = (
+                prepared_images.get(media.media_url)
+                if media.media_type == InstagramMediaType.IMAGE.value
+                else None
+            )
+            if media.media_url in reused_descriptions:
+                media_description = reused_descriptions[media.media_url]
+            elif media.media_url in duplicate_of:
+                # Copied from the duplicated image once every worker is done
+                media_description = None
+            else:
+                media_description = get_media_description(
+                    media,
+                    caption=caption,
+                    prepared_images=prepared_images,
+                    prepared_videos=prepared_videos,
+                )
+            return _helper_construct_media(
+                media,
+                user_id,
+                media_description=media_description,
+                caption=caption,
+                parent_media_id=parent_media_id,
+                perceptual_hash=image.perceptual_hash if image else None,
+                prompt_version=(
+                    image_prompt_version
+                    if image or media.media_url in prepared_videos
+                    else None
+                ),
+            )
+
     def worker_process(user_id, raw_media_list):
         media_objs = []
         # Iterate through the raw media list and construct media objects
         for media in raw_media_list:
-            # If the media is a carousel album, construct a media object for each child media
-            if media.get("media_type") == InstagramMediaType.CAROUSEL_ALBUM.name:
-                album_children = media.get("children", {}).get("data", [])
+            # Over budget, the media is stored undescribed and left for the next sync
+            if usage.degraded("defer"):
+                usage.defer(media.id)
+                media_objs.append(
+                    _helper_construct_media(
+                        media,
+                        user_id,
+                        album_children=(
+                            [{"id": child.id} for child in media.children.data]
+                            if media.children
+                            else None
+                        ),
+                    )
+                )
+                continue
 
-                for child in album_children:
-                    # Set the caption of the parent media as the caption of the childs media
-                    child["caption"] = media.get("caption")
+            # If the media is a carousel album, construct a media object for each child media
+            if media.media_type == InstagramMediaType.CAROUSEL_ALBUM.name:
+                album_children = media.children.data if media.children else []
+                with tracing.span(
+                    "describe_album", media_id=media.id, children=len(album_children)
+                ):
+                    for child in album_children:
+                        # The caption of the parent media is used as the caption of the childs media
+                        media_objs.append(
+                            construct_media(
+                                child, caption=media.caption, parent_media_id=media.id
+                            )
+                        )
 
-                    child["media_description"] = get_media_description(child)
+                    # add the parent media object with a media description for the whole album, passing in the list of children media ids
                     media_objs.append(
-                        _helper_construct_media_from_dict(
-                            child,
+                        _helper_construct_media(
+                            media,
                             user_id,
-                            parent_media_id=media["id"],
+                            # Otherwise described from the child descriptions once every worker is done
+                            media_description=(
+                                get_album_description(
+                                    media,
+                                    album_children=album_children,
+                                    prepared_images=prepared_images,
+                                    prepared_videos=prepared_videos,
+                                )
+                                if settings.album_description_mode == "images"
+                                else None
+                            ),
+                            album_children=[
+                                {"id": child.id} for child in album_children
+                            ],
+                            prompt_version=album_prompt_version,
                         )
                     )
-
-                # Generate a media description for the whole album
-                media["media_description"] = get_album_description(
-                    media, album_children=album_children
-                )
-
-                # add the parent media object, passing in the list of children media ids
-                media_objs.append(
-                    _helper_construct_media_from_dict(
-                        media,
-                        user_id,
-                        album_children=[
-                            {"id": child["id"]} for child in album_children
-                        ],
+                    debug(
+                        "Preprocessed album images:",
+                        media.id,
+                        media_preprocessing.summarize_prepared_images(
+                            prepared_images[child.media_url]
+                            for child in album_children
+                            if child.media_url in prepared_images
+                        ),
                     )
-                )
 
             # If the media is not a carousel album (video, or image), construct a media object
             else:
-                media["media_description"] = get_media_description(media)
-                media_objs.append(_helper_construct_media_from_dict(media, user_id))
+                media_objs.append(construct_media(media))
             debug("Processed Images:", len(media_objs))
 
         return media_objs
@@ -380,7 +1010,8 @@ def construct_instagram_media(
         futures = []
         for batch in batches:
             futures.append(
-                executor.submit(
+                usage.submit_in_context(
+                    executor,
                     worker_process,
                     user_id=user_id,
                     raw_media_list=batch,
@@ -390,9 +1021,298 @@ def construct_instagram_media(
         for future in concurrent.futures.as_completed(futures):
             media_objs.extend(future.result())
 
+    described = {
+        media.media_url: media
+        for media in media_objs
+        if media.perceptual_hash and media.media_url not in duplicate_of
+    }
+    for media in media_objs:
+        if media.media_url not in duplicate_of:
+            continue
+        duplicated = described.get(duplicate_of[media.media_url])
+        if duplicated is not None:
+            media.media_description = duplicated.media_description
+        else:
+            # The duplicated image was deferred over budget, so is its duplicate (and the album listing it, if any)
+            usage.defer(media.media_id)
+            if media.parent_media_id:
+                usage.defer(media.parent_media_id)
+    if settings.album_description_mode != "images":
+        _describe_albums_from_children(
+            media_objs, prepared_images, prepared_videos, num_workers
+        )
+    # Media deferred and albums left undescribed over budget are stored as deferred, so the next sync describes them
+    deferred_media_ids = set(usage.deferred_media_ids()) | set(
+        usage.skipped_album_ids()
+    )
+    for media in media_objs:
+        if media.media_id in deferred_media_ids:
+            media.description_hash = DEFERRED_DESCRIPTION_HASH
+    if settings.perceptual_hash_scope == "global":
+        for media in described.values():
+            _global_perceptual_hash_index().add(
+                media.perceptual_hash,
+                _perceptual_hash_context(media.prompt_version, media.description_hash),
+                media.media_description,
+            )
+
     return media_objs
 
 
+def _describe_albums_from_children(
+    media_objs: list[InstagramMediaRecord],
+    prepared_images: dict,
+    prepared_videos: dict,
+    num_workers=14,
+) -> None:
+    """Describe the album records in place, from the descriptions of their children (and a montage of them in "montage" mode)."""
+    children = {media.media_id: media for media in media_objs if media.parent_media_id}
+    albums = [
+        media
+        for media in media_objs
+        if media.media_type == InstagramMediaType.CAROUSEL_ALBUM.value
+    ]
+
+    def describe(album):
+        with tracing.span("describe_album", media_id=album.media_id):
+            album_children = [
+                children[child["id"]]
+                for child in album.album_children or []
+                if child["id"] in children
+            ]
+            montage = None
+            if get_settings().album_description_mode == "montage":
+                montage = media_preprocessing.build_montage(
+                    [
+                        prepared_images.get(child.media_url)
+                        or (prepared_videos.get(child.media_url) or [None])[0]
+                        for child in album_children
+                    ]
+                )
+            album.media_description = get_album_description_from_children(
+                album, album_children, montage=montage
+            )
+
+    if albums:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = [
+                usage.submit_in_context(executor, describe, album) for album in albums
+            ]
+            for future in futures:
+                future.result()
+
+
+def _find_duplicate_images(
+    user_id: str,
+    prepared_images: dict,
+    prompt_version: str,
+    description_hashes: dict[str, str],
+) -> tuple[dict, dict]:
+    """
+    Match the prepared images against already described near-duplicate images (of the user, or of every user when PERCEPTUAL_HASH_SCOPE is "global"),
+    and group the near-duplicates within the prepared images so each group is described once.
+    An image only reuses a description generated with the same prompt version and the same caption, since the caption is sent with the image.
+
+    Args:
+        user_id (str): The user_id of the media.
+        prepared_images (dict): The preprocessed images keyed by media url.
+        prompt_version (str): The prompt version the images will be described with.
+        description_hashes (dict): The description hash (media type and caption) of each image, keyed by media url.
+
+    Returns:
+        tuple: the reused descriptions keyed by media url, and for each in-run near-duplicate the media url it copies its description from.
+    """
+    settings = get_settings()
+    if settings.perceptual_hash_scope == "off":
+        return {}, {}
+
+    user_index = perceptual_hash.PerceptualHashIndex(
+        settings.perceptual_hash_max_distance
+    )
+    with SessionLocal() as db:
+        # Only the images sharing a caption with this run can be reused
+        for (
+            image_hash,
+            description_hash,
+            description,
+        ) in instagram_media_crud.get_described_perceptual_hashes_by_user_id(
+            db, user_id, prompt_version, list(set(description_hashes.values()))
+        ):
+            user_index.add(
+                image_hash,
+                _perceptual_hash_context(prompt_version, description_hash),
+                description,
+            )
+    indexes = [user_index]
+    if settings.perceptual_hash_scope == "global":
+        indexes.append(_global_perceptual_hash_index())
+
+    reused_descriptions = {}
+    duplicate_of = {}
+    # Media url of the first image of each in-run near-duplicate group
+    run_index = perceptual_hash.PerceptualHashIndex(
+        settings.perceptual_hash_max_distance
+    )
+    for media_url, image in prepared_images.items():
+        if image.perceptual_hash is None or media_url not in description_hashes:
+            continue
+        context = _perceptual_hash_context(
+            prompt_version, description_hashes[media_url]
+        )
+        description = next(
+            filter(
+                None,
+                (index.lookup(image.perceptual_hash, context) for index in indexes),
+            ),
+            None,
+        )
+        if description:
+            reused_descriptions[media_url] = description
+            continue
+        duplicated_url = run_index.lookup(image.perceptual_hash, context)
+        if duplicated_url:
+            duplicate_of[media_url] = duplicated_url
+        else:
+            run_index.add(image.perceptual_hash, context, media_url)
+    return reused_descriptions, duplicate_of
+
+
+def _perceptual_hash_context(prompt_version: str, description_hash: str) -> str:
+    # The context a description is reused under: the prompt and the caption it was generated with
+    return f"{prompt_version}:{description_hash}"
+
+
+def _image_description_hashes(
+    media_list: list[json_validation.InstagramMedia],
+) -> dict[str, str]:
+    """Return the description hash of every image, including album children (described with the album caption), keyed by media url."""
+    description_hashes = {}
+    for media in media_list:
+        for item in media.children.data if media.children else [media]:
+            if item.media_type == InstagramMediaType.IMAGE.value:
+                caption = media.caption if media.caption is not None else item.caption
+                description_hashes[item.media_url] = compute_description_hash(
+                    item.media_type, caption
+                )
+    return description_hashes
+
+
+def _image_urls(media_list: list[json_validation.InstagramMedia]) -> list[str]:
+    """Return the urls of every image, including album children, that will be described."""
+    image_urls = []
+    for media in media_list:
+        for item in media.children.data if media.children else [media]:
+            if item.media_type == InstagramMediaType.IMAGE.value:
+                image_urls.append(item.media_url)
+    return image_urls
+
+
+def _video_sources(
+    media_list: list[json_validation.InstagramMedia],
+) -> dict[str, Optional[str]]:
+    """Return the thumbnail url of every video, including album children, that will be described, keyed by video url."""
+    videos = {}
+    for media in media_list:
+        for item in media.children.data if media.children else [media]:
+            if item.media_type == InstagramMediaType.VIDEO.value and item.media_url:
+                videos[item.media_url] = item.thumbnail_url
+    return videos
+
+
+def _fetch_media_by_ids(
+    media_ids: list[str], access_token: str, profile: str, num_workers=8
+) -> dict[str, dict]:
+    """
+    Fetch the field profile of each media concurrently. Media that fails to fetch (e.g. deleted) is left out.
+
+    Returns:
+        dict: the fetched media json objects keyed by media id.
+    """
+    fetched_media = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            usage.submit_in_context(
+                executor, basic_display_api.get_media, media_id, access_token, profile
+            ): media_id
+            for media_id in media_ids
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                fetched_media[futures[future]] = future.result()
+            except Exception as e:
+                debug(f"Error: {e}")
+    return fetched_media
+
+
+def _list_media_by_ids(
+    media_ids: set[str], access_token: str, profile: str
+) -> dict[str, dict]:
+    """
+    Fetch the field profile of the given media by paging /me/media until all of them are found, instead of a request
+    per media. Album children are found among the children nested in their album. The media the listing misses
+    (e.g. children beyond the nested page) are fetched one by one, media that fails to fetch (e.g. deleted) is left out.
+
+    Returns:
+        dict: the fetched media json objects keyed by media id.
+    """
+    fetched_media = {}
+
+    def collect(page: list[dict]) -> bool:
+        for media in page:
+            for item in [media] + media.get("children", {}).get("data", []):
+                if item["id"] in media_ids:
+                    fetched_media[item["id"]] = item
+        return len(fetched_media) == len(media_ids)
+
+    basic_display_api.get_user_media(
+        access_token,
+        profile=profile,
+        page_size=get_settings().media_page_size,
+        max_items=None,
+        until=collect,
+    )
+    missing_media_ids = [
+        media_id for media_id in media_ids if media_id not in fetched_media
+    ]
+    if missing_media_ids:
+        fetched_media.update(
+            _fetch_media_by_ids(missing_media_ids, access_token, profile)
+        )
+    return fetched_media
+
+
+def _parse_media_list(
+    media_list: list[dict],
+) -> list[json_validation.InstagramMedia]:
+    media = json_validation.parse_json_types(
+        {"data": media_list},
+        json_validation.InstagramMediaList,
+        mode=get_settings().json_validation_mode,
+    )
+    return media.data if media else []
+
+
+def _window_end(window_start: datetime) -> datetime:
+    # The start of the next calendar month
+    return (window_start.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def _oldest_timestamp(media_list) -> Optional[datetime]:
+    # The oldest publish time (naive UTC, like publish_timestamp) of fetched media, None if any of them has no timestamp
+    timestamps = [media.get("timestamp") for media in media_list]
+    if not timestamps or not all(timestamps):
+        return None
+    return min(
+        _naive_utc(datetime.fromisoformat(timestamp)) for timestamp in timestamps
+    )
+
+
+def _naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
 def _chunk(lst, n):
     for i in range(0, len(lst), n):
         yield lst[i : i + n]
@@ -412,6 +1332,34 @@ def get_instagram_access_token(user_id: str):
     return None
 
 
+def get_user_by_user_id(user_id: str) -> Optional[User]:
+    """
+    Returns the user with the given id.
+
+    Args:
+        user_id (str)
+
+    Returns:
+        User if exists. None otherwise.
+    """
+
+    return None
+
+
+def get_user_by_instagram_user_id(instagram_user_id: str) -> Optional[User]:
+    """
+    Returns the user whose Instagram account has the given app-scoped user id (the id in the token info).
+
+    Args:
+        instagram_user_id (str)
+
+    Returns:
+        User if exists. None otherwise.
+    """
+
+    return None
+
+
 def expiry_to_datetime(expiry):
     """
     Convert expiry time in seconds to a future datetime object.
@@ -419,76 +1367,221 @@ def expiry_to_datetime(expiry):
     return datetime.now() + timedelta(seconds=expiry)
 
 
-def _helper_construct_media_from_dict(
-    media_dict: dict,
+@lru_cache(maxsize=None)
+def get_prompt_version(prompt_file: str) -> str:
+    """
+    Hash a prompt file together with the model, so stored descriptions are only reused under the prompt that generated them.
+
+    Args:
+        prompt_file (str): The path of the prompt file.
+
+    Returns:
+        str: 16 hex characters.
+    """
+    content = b""
+    if prompt_file and os.path.exists(prompt_file):
+        with open(prompt_file, "rb") as f:
+            content = f.read()
+    model = get_settings().model or ""
+    return hashlib.sha256(content + model.encode()).hexdigest()[:16]
+
+
+# Stored as the description hash of the media left undescribed (e.g. albums skipped over budget), never equal to a computed hash
+DEFERRED_DESCRIPTION_HASH = "deferred"
+
+
+def compute_description_hash(media_type: str, caption: str = None) -> str:
+    """
+    Hash the fields a media description is generated from (media type and caption).
+    Signed media URLs are left out since they change on every fetch without the media changing,
+    and album children are left out since the nested children of a listing may be truncated.
+
+    Args:
+        media_type (str): the media type.
+        caption (str): Optional. the media caption.
+
+    Returns:
+        str: a hex sha256 digest.
+    """
+    payload = json.dumps([media_type, caption])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def parse_url_expiry(*urls: str):
+    """
+    Parse the expiry of signed Instagram CDN urls, stored as a hex unix timestamp in the `oe` query parameter.
+
+    Args:
+        urls (str): the media urls, None values are ignored.
+
+    Returns:
+        datetime: the earliest expiry (naive UTC). None if no url carries an expiry.
+    """
+    expiries = []
+    for url in urls:
+        if not url:
+            continue
+        oe = parse_qs(urlparse(url).query).get("oe")
+        try:
+            expiries.append(
+                datetime.fromtimestamp(int(oe[0], 16), tz=timezone.utc).replace(
+                    tzinfo=None
+                )
+            )
+        except (TypeError, ValueError):
+            continue
+    return min(expiries) if expiries else None
+
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _is_new_or_changed_media(
+    media_dict: dict, stored_description_hashes: dict[str, str]
+) -> bool:
+    if media_dict["id"] not in stored_description_hashes:
+        return True
+    stored_hash = stored_description_hashes[media_dict["id"]]
+    if stored_hash == DEFERRED_DESCRIPTION_HASH:
+        return True
+    # Media stored before description hashes were tracked is kept as is
+    return stored_hash is not None and stored_hash != compute_description_hash(
+        media_dict.get("media_type"), media_dict.get("caption")
+    )
+
+
+def _helper_construct_media(
+    media: json_validation.InstagramMedia,
     user_id,
+    media_description=None,
+    caption=None,
     parent_media_id=None,
     album_children=None,
+    perceptual_hash=None,
+    prompt_version=None,
 ):
-    return InstagramMedia(
+    caption = caption if caption is not None else media.caption
+    return InstagramMediaRecord(
         user_id=user_id,
-        media_id=media_dict["id"],
-        publish_timestamp=datetime.fromisoformat(media_dict["timestamp"]),
-        media_type=media_dict["media_type"],
-        media_url=media_dict["media_url"],
-        media_description=media_dict.get("media_description"),
-        permalink=media_dict.get("permalink"),
-        thumbnail_url=media_dict.get("thumbnail_url"),
-        caption=media_dict.get("caption"),
+        media_id=media.id,
+        publish_timestamp=media.timestamp,
+        media_type=media.media_type,
+        media_url=media.media_url,
+        media_description=media_description,
+        description_hash=compute_description_hash(media.media_type, caption),
+        permalink=media.permalink,
+        thumbnail_url=media.thumbnail_url,
+        url_expires_at=parse_url_expiry(media.media_url, media.thumbnail_url),
+        caption=caption,
         album_children=album_children,
         parent_media_id=parent_media_id,
-        # embeddings=media_dict.get("embeddings"),
+        perceptual_hash=perceptual_hash,
+        prompt_version=prompt_version,
     )
 
 
-def get_media_description(media: json_validation.InstagramMedia) -> str:
+def get_media_description(
+    media: json_validation.InstagramMedia,
+    caption: str = None,
+    prepared_images: dict = None,
+    prepared_videos: dict = None,
+) -> str:
     """
-    Generate a media_description for an instagram media (ONLY IMAGES).
+    Generate a media_description for an instagram media (ONLY IMAGES AND VIDEOS).
+    Videos are described from their prepared frames, through the image prompt.
 
     Args:
-        media (json_validation.InstagramMedia): an instagram media json object.
+        media (json_validation.InstagramMedia): an instagram media object.
+        caption (str): Optional. The caption to use instead of the media caption (e.g. the album caption for album children).
+        prepared_images (dict): Optional. The preprocessed images keyed by media url (see media_preprocessing.prepare_images).
+        prepared_videos (dict): Optional. The preprocessed video frames keyed by media url (see media_preprocessing.prepare_videos).
 
     Returns:
         str: a text media description. None if an error occurs.
     """
 
-    if media["media_type"] == InstagramMediaType.IMAGE.value:
-        # Create a Media object
-        media_url = media["media_url"]
-        return _get_image_description(
-            image_url=media_url,
-            image_caption=media.get("caption"),
-            publish_timestamp=media.get("timestamp"),
-        )
+    if media.media_type == InstagramMediaType.IMAGE.value:
+        image_content = _image_content(media.media_url, prepared_images)
+        with usage.stage("describe_image"):
+            return _get_image_description(
+                image_url=image_content["image_url"]["url"],
+                image_caption=caption if caption is not None else media.caption,
+                publish_timestamp=media.timestamp.isoformat(),
+                detail=image_content["image_url"]["detail"],
+            )
+    elif media.media_type == InstagramMediaType.VIDEO.value:
+        frames = (prepared_videos or {}).get(media.media_url)
+        if not frames:
+            return None
+        with usage.stage("describe_video"):
+            return _get_image_description(
+                image_url=[frame.image_url for frame in frames],
+                image_caption=caption if caption is not None else media.caption,
+                publish_timestamp=media.timestamp.isoformat(),
+                detail=_budgeted_detail(frames[0].detail),
+            )
     else:
         return None
 
 
+def _image_content(image_url: str, prepared_images: dict = None, detail=None) -> dict:
+    """Build the image content part of a message, using the preprocessed image if there is one."""
+    image = (prepared_images or {}).get(image_url)
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": image.image_url if image else image_url,
+            "detail": _budgeted_detail(detail or (image.detail if image else "high")),
+        },
+    }
+
+
+def _budgeted_detail(detail: str) -> str:
+    """Lower the detail of images once the run nears its usage budget."""
+    return "low" if usage.degraded("low_detail") else detail
+
+
 def _get_image_description(
-    image_url: str, image_caption=None, publish_timestamp=None
+    image_url: Union[str, list[str]],
+    image_caption=None,
+    publish_timestamp=None,
+    detail="high",
 ) -> str:
     """
     Get a description of the image using the image URL.
 
     Args:
-        image_url (str): The URL of the image.
+        image_url (str | list[str]): The URL of the image, or an inline data url. A list of urls is described as the keyframes of a video.
         image_caption (str): Optional. The caption of the image.
+        publish_timestamp (str): Optional. The publish timestamp of the image.
+        detail (str): Optional. The detail level of the image input, "high" or "low".
 
     Returns:
         str: A text media description. None if an error occurs.
     """
-    system_message = read_prompt_file(DESCRIBE_IMAGE_PROMPT)
+    system_message = read_prompt_file(get_settings().describe_image_prompt)
 
+    image_urls = [image_url] if isinstance(image_url, str) else image_url
     image_message = {
         "role": "user",
         "content": [
             {
                 "type": "image_url",
-                "image_url": {"url": image_url, "detail": "high"},
+                "image_url": {"url": url, "detail": detail},
             }
+            for url in image_urls
         ],
     }
 
+    if len(image_urls) > 1:
+        image_message["content"].append(
+            {
+                "type": "text",
+                "text": "The images are keyframes of a video, in order.",
+            }
+        )
+
     if image_caption:
         image_message["content"].append(
             {
@@ -519,11 +1612,10 @@ def _get_image_description(
     ]
     try:
         response = call_OAI(
-            model=MODEL,
+            model=get_settings().model,
             messages=messages,
         )
-        response_message = response.choices[0].message
-        image_description = response_message.content
+        image_description = response.content
     except Exception as e:
         debug(f"Error: {e}")
         image_description = None
@@ -531,49 +1623,67 @@ def _get_image_description(
 
 
 def get_album_description(
-    album_media: InstagramMedia, album_children: list[dict]
+    album_media: json_validation.InstagramMedia,
+    album_children: list[json_validation.InstagramMedia],
+    prepared_images: dict = None,
+    prepared_videos: dict = None,
 ) -> str:
     """
     Generate a media_description for an instagram album.
+    Video children are represented by their first prepared frame.
 
     Args:
-        album_media (InstagramMedia): an instagram media object.
-        album_children (list[dict]): a list of children media objects.
+        album_media (json_validation.InstagramMedia): an instagram media object.
+        album_children (list[json_validation.InstagramMedia]): a list of children media objects.
+        prepared_images (dict): Optional. The preprocessed images keyed by media url (see media_preprocessing.prepare_images).
+        prepared_videos (dict): Optional. The preprocessed video frames keyed by media url (see media_preprocessing.prepare_videos).
 
     Returns:
         str: a text description of the album. None if an error occurs.
     """
 
+    if usage.degraded("skip_albums"):
+        usage.skip_album(album_media.id)
+        return None
+
     """Get a description of the image using the image URL."""
-    system_message = read_prompt_file(DESCRIBE_ALBUM_PROMPT)
+    system_message = read_prompt_file(get_settings().describe_album_prompt)
 
     try:
-        images = {
-            "role": "user",
-            "content": [
-                {
-                    "type": "image_url",
-                    "image_url": {"url": child["media_url"], "detail": "high"},
-                }
-                for child in album_children
-                if child["media_type"] == InstagramMediaType.IMAGE.value
-            ],
-        }
+        images = {"role": "user", "content": []}
+        for child in album_children:
+            if child.media_type == InstagramMediaType.IMAGE.value:
+                images["content"].append(
+                    _image_content(
+                        child.media_url,
+                        prepared_images,
+                        get_settings().album_image_detail,
+                    )
+                )
+            elif child.media_url in (prepared_videos or {}):
+                frame = prepared_videos[child.media_url][0]
+                images["content"].append(
+                    _image_content(
+                        frame.source_url,
+                        {frame.source_url: frame},
+                        get_settings().album_image_detail,
+                    )
+                )
 
-        if album_media.get("caption"):
+        if album_media.caption:
             images["content"].append(
                 {
                     "type": "text",
-                    "text": "Album Caption: " + album_media.get("caption"),
+                    "text": "Album Caption: " + album_media.caption,
                 }
             )
 
-        if album_media.get("publish_timestamp"):
+        if album_media.timestamp:
             images["content"].append(
                 {
                     "type": "text",
                     "text": "Album Publish Timestamp: "
-                    + album_media.get("publish_timestamp"),
+                    + album_media.timestamp.isoformat(),
                 }
             )
 
@@ -589,18 +1699,279 @@ def get_album_description(
             },
             images,
         ]
-        response = call_OAI(
-            model=MODEL,
-            messages=messages,
-        )
-        response_message = response.choices[0].message
-        image_description = response_message.content
+        with usage.stage("describe_album"):
+            response = call_OAI(
+                model=get_settings().model,
+                messages=messages,
+            )
+        image_description = response.content
     except Exception as e:
         debug(f"Error: {e}")
         image_description = None
     return image_description if image_description else None
 
 
+def get_album_description_from_children(
+    album: InstagramMediaRecord,
+    album_children: list[InstagramMediaRecord],
+    montage: media_preprocessing.PreparedImage = None,
+) -> str:
+    """
+    Generate a media_description for an instagram album from the descriptions of its children, without sending the child images again.
+
+    Args:
+        album (InstagramMediaRecord): the album media record.
+        album_children (list[InstagramMediaRecord]): the described children media records, in album order.
+        montage (media_preprocessing.PreparedImage): Optional. A thumbnail montage of the children (see media_preprocessing.build_montage).
+
+    Returns:
+        str: a text description of the album. None if no child is described or an error occurs.
+    """
+    child_descriptions = [
+        f"Album item {index} ({child.media_type}): {child.media_description}"
+        for index, child in enumerate(album_children, start=1)
+        if child.media_description
+    ]
+    if not child_descriptions:
+        return None
+    if usage.degraded("skip_albums"):
+        usage.skip_album(album.media_id)
+        return None
+
+    system_message = read_prompt_file(
+        get_settings().describe_album_from_children_prompt
+    )
+
+    album_message = {
+        "role": "user",
+        "content": [{"type": "text", "text": "\n\n".join(child_descriptions)}],
+    }
+
+    if montage:
+        album_message["content"].append(
+            {
+                "type": "image_url",
+                "image_url": {"url": montage.image_url, "detail": montage.detail},
+            }
+        )
+
+    if album.caption:
+        album_message["content"].append(
+            {
+                "type": "text",
+                "text": "Album Caption: " + album.caption,
+            }
+        )
+
+    if album.publish_timestamp:
+        album_message["content"].append(
+            {
+                "type": "text",
+                "text": "Album Publish Timestamp: "
+                + album.publish_timestamp.isoformat(),
+            }
+        )
+
+    messages = [
+        {
+            "role": "system",
+            "content": [
+                {
+                    "type": "text",
+                    "text": system_message,
+                },
+            ],
+        },
+        album_message,
+    ]
+    try:
+        with usage.stage("describe_album"):
+            response = call_OAI(
+                model=get_settings().model,
+                messages=messages,
+            )
+        album_description = response.content
+    except Exception as e:
+        debug(f"Error: {e}")
+        album_description = None
+    return album_description if album_description else None
+
+
+def fold_media_into_profile(profile: Optional[str], formatted_media: list) -> str:
+    """
+    Update the rolling profile of a user with the descriptions of their new media.
+
+    Args:
+        profile (str): The current profile. None for a new user.
+        formatted_media (list): the new media, formatted by format_crud_results.
+
+    Returns:
+        str: the updated profile. None if an error occurs.
+    """
+    system_message = read_prompt_file(get_settings().enrich_profile_prompt)
+
+    new_posts = "\n".join(
+        "- [{}] {}: {}".format(
+            media["publish_timestamp"], media["media_type"], media["description"]
+        )
+        for media in formatted_media
+    )
+    messages = [
+        {
+            "role": "system",
+            "content": [
+                {
+                    "type": "text",
+                    "text": system_message,
+                },
+            ],
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": "Current Profile: " + (profile or "(empty)"),
+                },
+                {
+                    "type": "text",
+                    "text": "New Posts:\n" + new_posts,
+                },
+            ],
+        },
+    ]
+    try:
+        with usage.stage("enrich"), tracing.span(
+            "fold_media", media=len(formatted_media)
+        ):
+            response = call_OAI(
+                model=get_settings().model,
+                messages=messages,
+            )
+        updated_profile = response.content
+    except Exception as e:
+        debug(f"Error: {e}")
+        updated_profile = None
+    return updated_profile if updated_profile else None
+
+
+def summarize_window(user_id: str, window_start: datetime) -> str:
+    """
+    Summarize the described media of a user published in the calendar month starting at window_start, folding it in batches of ENRICH_BATCH_SIZE.
+
+    Args:
+        user_id (str): The user_id of the media.
+        window_start (datetime): The start of the calendar month.
+
+    Returns:
+        str: the summary of the window. None if an error occurs.
+    """
+    with tracing.span("summarize_window", window_start=window_start.isoformat()):
+        with SessionLocal() as db:
+            media = (
+                instagram_media_crud.get_described_media_by_user_id_published_between(
+                    db, user_id, window_start, _window_end(window_start)
+                )
+            )
+            # Archived media is summarized from the descriptions in cold storage
+            archived_media = [item for item in media if item.media_description is None]
+            archived_descriptions = (
+                instagram_media_archive_crud.get_descriptions_by_user_id_media_ids(
+                    db, user_id, [item.media_id for item in archived_media]
+                )
+            )
+        # Set once the session is closed, so they are never written back
+        for item in archived_media:
+            item.media_description = archived_descriptions.get(item.media_id)
+        formatted_results = format_crud_results(media)
+
+        summary = None
+        for batch in _chunk(formatted_results, get_settings().enrich_batch_size):
+            summary = fold_media_into_profile(summary, batch)
+            if summary is None:
+                return None
+        return summary
+
+
+def reduce_window_summaries(window_summaries: list[tuple[datetime, str]]) -> str:
+    """
+    Reduce the window summaries of a user into a single profile.
+    The summaries are merged ENRICH_REDUCE_FANIN at a time, level by level, so a single call never holds more than ENRICH_REDUCE_FANIN summaries.
+
+    Args:
+        window_summaries (list[tuple[datetime, str]]): the (window_start, summary) of each window, oldest first.
+
+    Returns:
+        str: the profile. None if there is no summary or an error occurs.
+    """
+    partial_profiles = [
+        (window_start.strftime("%Y-%m"), window_start.strftime("%Y-%m"), summary)
+        for window_start, summary in window_summaries
+    ]
+    while len(partial_profiles) > 1:
+        groups = list(
+            _chunk(partial_profiles, max(2, get_settings().enrich_reduce_fanin))
+        )
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=get_settings().enrich_max_workers
+        ) as executor:
+            futures = [
+                usage.submit_in_context(executor, _reduce_profiles, group)
+                for group in groups
+            ]
+            partial_profiles = [
+                (group[0][0], group[-1][1], future.result())
+                for group, future in zip(groups, futures)
+            ]
+        if any(profile is None for _, _, profile in partial_profiles):
+            return None
+    return partial_profiles[0][2] if partial_profiles else None
+
+
+def _reduce_profiles(partial_profiles: list[tuple[str, str, str]]) -> str:
+    """Merge (first period, last period, profile) partial profiles, oldest first, into one profile. None if an error occurs."""
+    system_message = read_prompt_file(get_settings().enrich_reduce_prompt)
+
+    messages = [
+        {
+            "role": "system",
+            "content": [
+                {
+                    "type": "text",
+                    "text": system_message,
+                },
+            ],
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": (
+                        f"Period {first}: {profile}"
+                        if first == last
+                        else f"Period {first} to {last}: {profile}"
+                    ),
+                }
+                for first, last, profile in partial_profiles
+            ],
+        },
+    ]
+    try:
+        with usage.stage("enrich"), tracing.span(
+            "reduce_profiles", partial_profiles=len(partial_profiles)
+        ):
+            response = call_OAI(
+                model=get_settings().model,
+                messages=messages,
+            )
+        profile = response.content
+    except Exception as e:
+        debug(f"Error: {e}")
+        profile = None
+    return profile if profile else None
+
+
 def format_crud_results(query_results: list[InstagramMedia]) -> list:
     """
     Format the fetched media into a list of dictionaries.
@@ -611,19 +1982,20 @@ def format_crud_results(query_results: list[InstagramMedia]) -> list:
     Returns:
         list: a list of formatted media dictionaries for enriching.
     """
+    media_types = {
+        InstagramMediaType.IMAGE.value: "image",
+        InstagramMediaType.VIDEO.value: "video",
+        InstagramMediaType.CAROUSEL_ALBUM.value: "album",
+    }
     formatted_results = []
     for media in query_results:
         try:
-            if media.media_type == InstagramMediaType.IMAGE.value:
-                formatted_results.append(
-                    {
-                        "image_description": media.media_description,
-                    }
-                )
-            elif media.media_type == InstagramMediaType.CAROUSEL_ALBUM.value:
+            if media.media_type in media_types and media.media_description:
                 formatted_results.append(
                     {
-                        "album_description": media.media_description,
+                        "media_type": media_types[media.media_type],
+                        "description": media.media_description,
+                        "publish_timestamp": media.publish_timestamp.isoformat(),
                     }
                 )
         except Exception as e:
@@ -636,6 +2008,7 @@ def format_crud_results(query_results: list[InstagramMedia]) -> list:
 if __name__ == "__main__":
     engine = init_db()
     SessionLocal.configure(bind=engine)
+    AsyncSessionLocal.configure(bind=init_async_db())
 
     user = User(
         user_id="UUID",
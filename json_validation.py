@@ -1,9 +1,12 @@
-import logs
+import logging
+import random
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Union, List, Type
-from pydantic import BaseModel, ValidationError
+from functools import lru_cache
+from typing import Optional, Union, List, Type
+from pydantic import BaseModel, TypeAdapter, ValidationError
 
-logger = logs.get_logger(__name__)
+logger = logging.getLogger(__name__)
 
 
 class ShortLivedAccessToken(BaseModel):
@@ -27,32 +30,71 @@ class InstagramAuthInfo(BaseModel):
     expires_in: int
 
 
-class InstagramMedia(BaseModel):
+@dataclass(slots=True)
+class InstagramMedia:
+    # A slotted dataclass rather than a BaseModel, so trusted json can be built into it
+    # directly (see from_trusted_json) without paying for validation
     id: str
     timestamp: datetime
     media_type: str
     media_url: str
+    caption: Optional[str] = None
+    permalink: Optional[str] = None
+    thumbnail_url: Optional[str] = None
+    children: Optional["InstagramMediaChildren"] = None
+
+    @classmethod
+    def from_trusted_json(cls, json_obj: dict) -> "InstagramMedia":
+        """
+        Build an InstagramMedia from a media json object without validating it.
+        Missing optional fields are None, a missing required field raises a KeyError.
+        """
+        children = json_obj.get("children")
+        return cls(
+            json_obj["id"],
+            datetime.fromisoformat(json_obj["timestamp"]),
+            json_obj["media_type"],
+            json_obj["media_url"],
+            json_obj.get("caption"),
+            json_obj.get("permalink"),
+            json_obj.get("thumbnail_url"),
+            (
+                InstagramMediaChildren(
+                    [cls.from_trusted_json(child) for child in children["data"]]
+                )
+                if children
+                else None
+            ),
+        )
+
+
+@dataclass(slots=True)
+class InstagramMediaChildren:
+    data: List[InstagramMedia]
 
 
 class InstagramMediaList(BaseModel):
     data: List[InstagramMedia]
 
 
+JsonType = Type[
+    Union[
+        ShortLivedAccessToken,
+        LongLivedAccessToken,
+        InstagramUserProfile,
+        InstagramMedia,
+        InstagramMediaList,
+    ]
+]
+
+
 def validate_json_types(
     json_obj: dict,
-    json_type: Type[
-        Union[
-            ShortLivedAccessToken,
-            LongLivedAccessToken,
-            InstagramUserProfile,
-            InstagramMedia,
-            InstagramMediaList,
-        ]
-    ],
+    json_type: JsonType,
     logging_info_extra: dict = {},
 ):
     try:
-        json_type(**json_obj)
+        _type_adapter(json_type).validate_python(json_obj)
     except ValidationError as e:
         logger.error(
             f"JSON Decode Error: {json_obj}",
@@ -61,3 +103,80 @@ def validate_json_types(
         )
         return False
     return True
+
+
+def parse_json_types(
+    json_obj: dict,
+    json_type: Type[InstagramMediaList],
+    mode: str = "full",
+    sample_size: int = 10,
+    logging_info_extra: dict = {},
+) -> Optional[InstagramMediaList]:
+    """
+    Validate a decoded media list json object into typed InstagramMedia objects, so it is only parsed once and the typed objects can be passed downstream.
+    A media item that fails validation is logged and left out, the other items of the list are kept.
+
+    Args:
+        json_obj (dict): the decoded json object.
+        json_type: the type to validate the json object into.
+        mode (str): Optional. "full" validates every media item.
+            "sample" validates sample_size random media items, and trusts the rest unless one of them is invalid.
+            "skip" trusts every media item, for trusted high-volume paths. Items missing a required field are still left out.
+        sample_size (int): Optional. The number of media items validated in "sample" mode.
+
+    Returns:
+        InstagramMediaList: the typed media list. None if json_obj is not a media list.
+    """
+    data = json_obj.get("data") if isinstance(json_obj, dict) else None
+    if not isinstance(data, list):
+        logger.error(f"JSON Decode Error: {json_obj}", extra=logging_info_extra)
+        return None
+
+    if mode == "full":
+        try:
+            return _type_adapter(json_type).validate_python(json_obj)
+        except ValidationError:
+            # Validated again item by item, to leave out only the invalid ones
+            return json_type.model_construct(
+                data=_parse_media_items(data, True, logging_info_extra)
+            )
+
+    validate = False
+    if mode == "sample":
+        try:
+            _type_adapter(json_type).validate_python(
+                {"data": random.sample(data, min(sample_size, len(data)))}
+            )
+        except ValidationError:
+            # An invalid sample means the rest cannot be trusted either
+            validate = True
+    return json_type.model_construct(
+        data=_parse_media_items(data, validate, logging_info_extra)
+    )
+
+
+def _parse_media_items(
+    data: list, validate: bool, logging_info_extra: dict
+) -> list[InstagramMedia]:
+    media = []
+    for media_item in data:
+        try:
+            media.append(
+                _type_adapter(InstagramMedia).validate_python(media_item)
+                if validate
+                else InstagramMedia.from_trusted_json(media_item)
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            # ValidationError is a ValueError
+            logger.error(
+                f"Invalid media item, left out: {media_item}",
+                extra=logging_info_extra,
+                exc_info=e,
+            )
+    return media
+
+
+@lru_cache(maxsize=None)
+def _type_adapter(json_type: JsonType) -> TypeAdapter:
+    # Building the validator is the expensive part, so it is compiled once per type
+    return TypeAdapter(json_type)
@@ -0,0 +1,64 @@
+import importlib
+import threading
+
+"""
+Deferred imports of the heavy dependencies (SQLAlchemy and pgvector through the crud and models modules, Pydantic
+through json_validation), so that importing a module which only needs them on some paths stays cheap, e.g. a worker
+process that handles a single webhook, or a CLI printing its help.
+
+    instagram_media_crud = lazy_import("crud.instagram_media", "instagram_media_crud")
+    json_validation = lazy_import("json_validation")
+
+The returned object stands for the module, or for the attribute of the module: the module is imported on the first
+attribute access or call, and every later access goes to the imported object. Classes used with isinstance() or as
+base classes must be imported normally, annotations naming a lazy object need `from __future__ import annotations`.
+
+lazy_import(): A module, or an attribute of a module, imported on first use.
+"""
+
+
+class LazyImport:
+    """A module, or an attribute of a module, imported on first use (see lazy_import)."""
+
+    __slots__ = ("_module_name", "_attribute", "_target", "_lock")
+
+    def __init__(self, module_name: str, attribute: str = None) -> None:
+        self._module_name = module_name
+        self._attribute = attribute
+        self._target = None
+        self._lock = threading.Lock()
+
+    def _resolve(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    target = importlib.import_module(self._module_name)
+                    if self._attribute is not None:
+                        target = getattr(target, self._attribute)
+                    self._target = target
+        return self._target
+
+    def __getattr__(self, name: str):
+        return getattr(self._resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __repr__(self) -> str:
+        name = self._module_name + (f".{self._attribute}" if self._attribute else "")
+        state = "imported" if self._target is not None else "not imported"
+        return f"<lazy {name} ({state})>"
+
+
+def lazy_import(module_name: str, attribute: str = None) -> LazyImport:
+    """
+    A module, or an attribute of a module, imported on the first attribute access or call.
+
+    Args:
+        module_name (str): The module, e.g. "crud.instagram_media".
+        attribute (str): Optional. The attribute of the module to stand for, e.g. "instagram_media_crud".
+
+    Returns:
+        LazyImport: the lazy module or attribute.
+    """
+    return LazyImport(module_name, attribute)
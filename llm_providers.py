@@ -0,0 +1,444 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Iterator, Optional
+
+"""
+LLM provider layer used by utils.call_OAI to generate the media descriptions.
+
+Every provider exposes the same sync (complete), async (acomplete) and streaming (stream) calls, with a per call
+timeout, and accumulates the token usage of every call. Besides the OpenAI provider, a local deterministic fake and
+a record/replay adapter let the description pipeline be benchmarked and load-tested offline.
+
+LLMProvider: The interface of a provider.
+OpenAIProvider: Calls the OpenAI chat completions API.
+FakeLLMProvider: Returns deterministic descriptions after a simulated latency, without any network call.
+RecordReplayProvider: Records the responses of another provider to a cassette file, and replays them.
+get_provider(): Build a provider by name.
+"""
+
+PROVIDERS = ("openai", "fake", "record", "replay")
+
+
+@dataclass(slots=True)
+class LLMUsage:
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    requests: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def __add__(self, other: "LLMUsage") -> "LLMUsage":
+        return LLMUsage(
+            prompt_tokens=self.prompt_tokens + other.prompt_tokens,
+            completion_tokens=self.completion_tokens + other.completion_tokens,
+            requests=self.requests + other.requests,
+        )
+
+
+@dataclass(slots=True)
+class LLMResponse:
+    content: Optional[str]
+    model: str
+    usage: LLMUsage = field(default_factory=LLMUsage)
+    latency_seconds: float = 0.0
+
+
+class LLMProvider(ABC):
+    """
+    The interface of a provider.
+    Subclasses implement complete(), and may override acomplete() and stream() with native async and streaming calls.
+    """
+
+    def __init__(self, timeout: float = 60) -> None:
+        self.timeout = timeout
+        self.usage = LLMUsage()
+        self._usage_lock = threading.Lock()
+
+    @abstractmethod
+    def complete(
+        self, model: str, messages: list[dict], timeout: float = None
+    ) -> LLMResponse:
+        """
+        Generate a chat completion.
+
+        Args:
+            model (str): The model name.
+            messages (list[dict]): The chat messages, in the OpenAI chat completions format.
+            timeout (float): Optional. The number of seconds after which the call fails, defaults to the provider timeout.
+
+        Returns:
+            LLMResponse: The completion and its usage.
+        """
+
+    async def acomplete(
+        self, model: str, messages: list[dict], timeout: float = None
+    ) -> LLMResponse:
+        """Generate a chat completion without blocking the event loop. Defaults to running complete() in a thread."""
+        return await asyncio.to_thread(self.complete, model, messages, timeout)
+
+    def stream(
+        self, model: str, messages: list[dict], timeout: float = None
+    ) -> Iterator[str]:
+        """Generate a chat completion as a stream of text chunks. Defaults to a single chunk."""
+        response = self.complete(model, messages, timeout)
+        if response.content:
+            yield response.content
+
+    def reset_usage(self) -> LLMUsage:
+        """Return the accumulated usage and start accumulating again from zero."""
+        with self._usage_lock:
+            usage, self.usage = self.usage, LLMUsage()
+        return usage
+
+    def _record_usage(self, usage: LLMUsage) -> None:
+        with self._usage_lock:
+            self.usage = self.usage + usage
+
+
+class OpenAIProvider(LLMProvider):
+    """Calls the OpenAI chat completions API. The openai package is only imported on the first call."""
+
+    def __init__(self, timeout: float = 60, api_key: str = None) -> None:
+        super().__init__(timeout)
+        self.api_key = api_key
+        self._client = None
+        self._async_client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                from openai import OpenAI
+
+                self._client = OpenAI(api_key=self.api_key)
+            return self._client
+
+    @property
+    def async_client(self):
+        with self._client_lock:
+            if self._async_client is None:
+                from openai import AsyncOpenAI
+
+                self._async_client = AsyncOpenAI(api_key=self.api_key)
+            return self._async_client
+
+    def complete(
+        self, model: str, messages: list[dict], timeout: float = None
+    ) -> LLMResponse:
+        start = time.perf_counter()
+        completion = self.client.chat.completions.create(
+            model=model, messages=messages, timeout=timeout or self.timeout
+        )
+        return self._response(completion, model, time.perf_counter() - start)
+
+    async def acomplete(
+        self, model: str, messages: list[dict], timeout: float = None
+    ) -> LLMResponse:
+        start = time.perf_counter()
+        completion = await self.async_client.chat.completions.create(
+            model=model, messages=messages, timeout=timeout or self.timeout
+        )
+        return self._response(completion, model, time.perf_counter() - start)
+
+    def stream(
+        self, model: str, messages: list[dict], timeout: float = None
+    ) -> Iterator[str]:
+        chunks = self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            timeout=timeout or self.timeout,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        for chunk in chunks:
+            if chunk.usage:
+                self._record_usage(_usage_of(chunk.usage))
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def _response(self, completion, model: str, latency_seconds: float) -> LLMResponse:
+        usage = _usage_of(completion.usage)
+        self._record_usage(usage)
+        return LLMResponse(
+            content=completion.choices[0].message.content,
+            model=completion.model or model,
+            usage=usage,
+            latency_seconds=latency_seconds,
+        )
+
+
+class FakeLLMProvider(LLMProvider):
+    """
+    Returns deterministic descriptions after a simulated latency, without any network call.
+    The same messages always get the same content, latency and usage, so offline runs are reproducible.
+    """
+
+    # Prompt tokens billed per image part, see media_preprocessing.estimate_image_tokens
+    IMAGE_TOKENS = {"low": 85, "high": 765}
+
+    def __init__(
+        self,
+        timeout: float = 60,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        completion_tokens: int = 120,
+    ) -> None:
+        """
+        Args:
+            timeout (float): Optional. Calls whose simulated latency exceeds the timeout raise TimeoutError.
+            latency (float): Optional. The mean simulated latency of a call, in seconds.
+            latency_jitter (float): Optional. The maximum deviation from the mean latency, in seconds.
+            completion_tokens (int): Optional. The number of completion tokens of each response.
+        """
+        super().__init__(timeout)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.completion_tokens = completion_tokens
+
+    def complete(
+        self, model: str, messages: list[dict], timeout: float = None
+    ) -> LLMResponse:
+        response, latency = self._fake_response(model, messages, timeout)
+        time.sleep(latency)
+        self._record_usage(response.usage)
+        return response
+
+    async def acomplete(
+        self, model: str, messages: list[dict], timeout: float = None
+    ) -> LLMResponse:
+        response, latency = self._fake_response(model, messages, timeout)
+        await asyncio.sleep(latency)
+        self._record_usage(response.usage)
+        return response
+
+    def stream(
+        self, model: str, messages: list[dict], timeout: float = None
+    ) -> Iterator[str]:
+        response = self.complete(model, messages, timeout)
+        for word in response.content.split(" "):
+            yield word + " "
+
+    def _fake_response(
+        self, model: str, messages: list[dict], timeout: Optional[float]
+    ) -> tuple[LLMResponse, float]:
+        digest = _messages_key(model, messages)
+        rng = random.Random(digest)
+        latency = max(0.0, self.latency + rng.uniform(-1, 1) * self.latency_jitter)
+        if latency > (timeout or self.timeout):
+            raise TimeoutError(f"Fake completion timed out after {latency:.2f}s")
+
+        prompt_tokens = 0
+        for message in messages:
+            content = message["content"]
+            for part in [content] if isinstance(content, str) else content:
+                if isinstance(part, str):
+                    prompt_tokens += len(part) // 4
+                elif part["type"] == "text":
+                    prompt_tokens += len(part["text"] or "") // 4
+                elif part["type"] == "image_url":
+                    prompt_tokens += self.IMAGE_TOKENS.get(
+                        part["image_url"].get("detail", "high"), 765
+                    )
+        words = " ".join(
+            f"{rng.choice(_FAKE_WORDS)}" for _ in range(self.completion_tokens)
+        )
+        response = LLMResponse(
+            content=f"[fake {digest[:12]}] {words}",
+            model=model,
+            usage=LLMUsage(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=self.completion_tokens,
+                requests=1,
+            ),
+            latency_seconds=latency,
+        )
+        return response, latency
+
+
+class RecordReplayProvider(LLMProvider):
+    """
+    Records the responses of another provider to a JSON lines cassette file, and replays them.
+    Calls are matched on a hash of the model and messages.
+
+    Modes:
+        - "replay": only replay, unknown calls raise KeyError
+        - "record": call the wrapped provider and record every response
+        - "auto": replay known calls, record the others
+    """
+
+    def __init__(
+        self,
+        cassette_path: str,
+        provider: LLMProvider = None,
+        mode: str = "replay",
+        replay_latency: bool = False,
+        timeout: float = 60,
+    ) -> None:
+        """
+        Args:
+            cassette_path (str): The path of the cassette file.
+            provider (LLMProvider): Optional. The provider recorded from, required by the "record" and "auto" modes.
+            mode (str): Optional. "replay", "record" or "auto".
+            replay_latency (bool): Optional. Sleep for the recorded latency of each replayed call.
+            timeout (float): Optional. The timeout passed to the wrapped provider.
+        """
+        if mode not in ("replay", "record", "auto"):
+            raise ValueError(f"Unknown record/replay mode: {mode}")
+        if mode != "replay" and provider is None:
+            raise ValueError(f"A provider to record from is required in {mode} mode")
+        super().__init__(timeout)
+        self.cassette_path = cassette_path
+        self.provider = provider
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self._cassette = {}
+        self._cassette_lock = threading.Lock()
+        if mode != "record" and os.path.exists(cassette_path):
+            with open(cassette_path) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._cassette[entry["key"]] = entry
+
+    def complete(
+        self, model: str, messages: list[dict], timeout: float = None
+    ) -> LLMResponse:
+        key = _messages_key(model, messages)
+        response = self._replay(key)
+        if response is not None:
+            if self.replay_latency:
+                time.sleep(response.latency_seconds)
+        else:
+            response = self.provider.complete(model, messages, timeout or self.timeout)
+            self._record(key, response)
+        self._record_usage(response.usage)
+        return response
+
+    async def acomplete(
+        self, model: str, messages: list[dict], timeout: float = None
+    ) -> LLMResponse:
+        key = _messages_key(model, messages)
+        response = self._replay(key)
+        if response is not None:
+            if self.replay_latency:
+                await asyncio.sleep(response.latency_seconds)
+        else:
+            response = await self.provider.acomplete(
+                model, messages, timeout or self.timeout
+            )
+            self._record(key, response)
+        self._record_usage(response.usage)
+        return response
+
+    def _replay(self, key: str) -> Optional[LLMResponse]:
+        if self.mode == "record":
+            return None
+        entry = self._cassette.get(key)
+        if entry is None:
+            if self.mode == "replay":
+                raise KeyError(f"No recorded response for {key}")
+            return None
+        return LLMResponse(
+            content=entry["content"],
+            model=entry["model"],
+            usage=LLMUsage(**entry["usage"]),
+            latency_seconds=entry["latency_seconds"],
+        )
+
+    def _record(self, key: str, response: LLMResponse) -> None:
+        entry = {
+            "key": key,
+            "content": response.content,
+            "model": response.model,
+            "usage": {
+                "prompt_tokens": response.usage.prompt_tokens,
+                "completion_tokens": response.usage.completion_tokens,
+                "requests": response.usage.requests,
+            },
+            "latency_seconds": response.latency_seconds,
+        }
+        with self._cassette_lock:
+            self._cassette[key] = entry
+            with open(self.cassette_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+
+def get_provider(
+    name: str = "openai",
+    cassette_path: str = None,
+    timeout: float = 60,
+    latency: float = 0.0,
+) -> LLMProvider:
+    """
+    Build a provider by name.
+
+    Args:
+        name (str): Optional. One of PROVIDERS. "record" records OpenAI responses, "replay" replays them.
+        cassette_path (str): Optional. The cassette file of the "record" and "replay" providers.
+        timeout (float): Optional. The default timeout of each call, in seconds.
+        latency (float): Optional. The simulated latency of the "fake" provider, in seconds.
+
+    Returns:
+        LLMProvider: the provider.
+    """
+    if name == "openai":
+        return OpenAIProvider(timeout=timeout)
+    elif name == "fake":
+        return FakeLLMProvider(timeout=timeout, latency=latency)
+    elif name == "record":
+        return RecordReplayProvider(
+            cassette_path, OpenAIProvider(timeout=timeout), mode="record"
+        )
+    elif name == "replay":
+        return RecordReplayProvider(cassette_path, mode="replay", timeout=timeout)
+    raise ValueError(f"Unknown LLM provider: {name}")
+
+
+def _usage_of(usage) -> LLMUsage:
+    if usage is None:
+        return LLMUsage(requests=1)
+    return LLMUsage(
+        prompt_tokens=usage.prompt_tokens,
+        completion_tokens=usage.completion_tokens,
+        requests=1,
+    )
+
+
+def _messages_key(model: str, messages: list[dict]) -> str:
+    return hashlib.sha256(
+        json.dumps([model, messages], sort_keys=True).encode()
+    ).hexdigest()
+
+
+_FAKE_WORDS = (
+    "a",
+    "photo",
+    "of",
+    "friends",
+    "at",
+    "the",
+    "beach",
+    "sunset",
+    "city",
+    "coffee",
+    "dog",
+    "hiking",
+    "trail",
+    "concert",
+    "dinner",
+    "with",
+    "family",
+    "in",
+    "park",
+    "smiling",
+)
@@ -0,0 +1,483 @@
+import base64
+import concurrent.futures
+import io
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+from dataclasses import dataclass
+from time import monotonic, perf_counter
+from typing import Optional
+import basic_display_api
+import perceptual_hash
+
+"""
+Image download and preprocessing stage, run before the media descriptions are generated.
+
+Instagram media urls point at full resolution JPEG/HEIC files, which the model provider downloads and bills at
+high detail. This stage downloads the images concurrently, downscales and re-encodes them locally in a process
+pool, and returns for each image what to send to the model according to the policy:
+
+    - "original": the CDN url at high detail (no preprocessing)
+    - "low": the CDN url at low detail (no preprocessing)
+    - "inline": a downscaled inline JPEG at high detail
+    - "inline_low": a downscaled inline JPEG at low detail
+
+Videos are described through the same image path, from a few keyframes extracted with ffmpeg (when it is installed)
+in a small bounded pool, or from their thumbnail:
+
+    - "keyframes": up to max_frames keyframes of the first max_videos videos, extracted within a per-sync deadline,
+      the thumbnail for the rest
+    - "thumbnail": the thumbnail of every video
+    - "off": videos are not described
+
+prepare_images(): Download and preprocess a list of image urls according to the policy.
+prepare_videos(): Extract and preprocess the frames of a list of videos according to the policy.
+build_montage(): Tile prepared images into a single small inline image.
+estimate_image_tokens(): Estimate the prompt tokens of an image input.
+summarize_prepared_images(): Sum the token, byte and latency savings of prepared images.
+"""
+
+IMAGE_POLICIES = ("original", "low", "inline", "inline_low")
+VIDEO_POLICIES = ("keyframes", "thumbnail", "off")
+
+# Tokens billed per image input: a fixed base, plus one per 512px tile at high detail
+BASE_IMAGE_TOKENS = 85
+TILE_IMAGE_TOKENS = 170
+
+
+@dataclass(slots=True)
+class PreparedImage:
+    source_url: str
+    # The url sent to the model, either source_url or an inline data url
+    image_url: str
+    detail: str
+    original_size: Optional[tuple] = None
+    prepared_size: Optional[tuple] = None
+    original_bytes: Optional[int] = None
+    prepared_bytes: Optional[int] = None
+    download_seconds: float = 0.0
+    process_seconds: float = 0.0
+    # The dhash of the image, see perceptual_hash.dhash
+    perceptual_hash: Optional[str] = None
+
+    @property
+    def original_tokens(self) -> Optional[int]:
+        # What the image cost before preprocessing: the full resolution image at high detail
+        if self.original_size is None:
+            return None
+        return estimate_image_tokens(*self.original_size, detail="high")
+
+    @property
+    def prepared_tokens(self) -> Optional[int]:
+        size = self.prepared_size or self.original_size
+        if size is None:
+            return BASE_IMAGE_TOKENS if self.detail == "low" else None
+        return estimate_image_tokens(*size, detail=self.detail)
+
+
+def estimate_image_tokens(width: int, height: int, detail: str = "high") -> int:
+    """
+    Estimate the prompt tokens of an image input.
+    At high detail the image is scaled to fit 2048x2048, then its shortest side to 768px, and billed per 512px tile.
+
+    Args:
+        width (int): The image width in pixels.
+        height (int): The image height in pixels.
+        detail (str): Optional. "high" or "low".
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    if detail == "low":
+        return BASE_IMAGE_TOKENS
+
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return BASE_IMAGE_TOKENS + TILE_IMAGE_TOKENS * tiles
+
+
+def prepare_images(
+    image_urls: list[str],
+    policy: str = "inline",
+    target_size: int = 512,
+    quality: int = 85,
+    download_workers: int = 8,
+    process_workers: int = 4,
+) -> dict[str, PreparedImage]:
+    """
+    Download and preprocess a list of image urls according to the policy.
+    Images that fail to download or decode fall back to their CDN url.
+
+    Args:
+        image_urls (list[str]): The image urls, duplicates are prepared once.
+        policy (str): Optional. One of IMAGE_POLICIES.
+        target_size (int): Optional. The longest side, in pixels, of the downscaled images.
+        quality (int): Optional. The JPEG quality of the re-encoded images.
+        download_workers (int): Optional. The number of concurrent downloads.
+        process_workers (int): Optional. The number of processes used to downscale the images. 0 downscales in the calling thread.
+
+    Returns:
+        dict: The prepared images keyed by their source url.
+    """
+    if policy not in IMAGE_POLICIES:
+        raise ValueError(f"Unknown image policy: {policy}")
+
+    image_urls = list(dict.fromkeys(url for url in image_urls if url))
+    detail = "low" if policy in ("low", "inline_low") else "high"
+    prepared_images = {
+        url: PreparedImage(source_url=url, image_url=url, detail=detail)
+        for url in image_urls
+    }
+    if policy in ("original", "low") or not image_urls:
+        return prepared_images
+
+    downloads = _download_images(image_urls, download_workers)
+
+    if process_workers > 0 and len(downloads) > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(process_workers, len(downloads))
+        ) as executor:
+            futures = {
+                executor.submit(_downscale, content, target_size, quality): url
+                for url, (content, _) in downloads.items()
+            }
+            processed = {}
+            for future in concurrent.futures.as_completed(futures):
+                processed[futures[future]] = _result_or_none(future)
+    else:
+        processed = {
+            url: _call_or_none(_downscale, content, target_size, quality)
+            for url, (content, _) in downloads.items()
+        }
+
+    for url, (content, download_seconds) in downloads.items():
+        image = prepared_images[url]
+        image.original_bytes = len(content)
+        image.download_seconds = download_seconds
+        if processed.get(url) is None:
+            continue
+        jpeg, original_size, prepared_size, image_hash, process_seconds = processed[url]
+        image.image_url = "data:image/jpeg;base64," + base64.b64encode(jpeg).decode()
+        image.original_size = original_size
+        image.prepared_size = prepared_size
+        image.prepared_bytes = len(jpeg)
+        image.perceptual_hash = image_hash
+        image.process_seconds = process_seconds
+
+    return prepared_images
+
+
+def prepare_videos(
+    videos: dict[str, Optional[str]],
+    policy: str = "keyframes",
+    image_policy: str = "inline",
+    target_size: int = 512,
+    max_frames: int = 3,
+    frame_interval: float = 3.0,
+    max_videos: int = 10,
+    workers: int = 2,
+    timeout: float = 30,
+    deadline: Optional[float] = None,
+) -> dict[str, list[PreparedImage]]:
+    """
+    Extract and preprocess the frames of a list of videos according to the policy.
+    Keyframe extraction is capped to max_videos videos, run by at most workers single threaded ffmpeg processes,
+    and stopped once deadline seconds have passed. Videos whose extraction is skipped, cut by the deadline or fails fall back to their thumbnail.
+
+    Args:
+        videos (dict): The thumbnail url of each video url, most recent video first.
+        policy (str): Optional. One of VIDEO_POLICIES.
+        image_policy (str): Optional. The IMAGE_POLICIES policy the thumbnails are prepared with.
+        target_size (int): Optional. The longest side, in pixels, of the frames.
+        max_frames (int): Optional. The maximum number of keyframes per video.
+        frame_interval (float): Optional. The minimum number of seconds between two keyframes.
+        max_videos (int): Optional. The maximum number of videos to extract keyframes from.
+        workers (int): Optional. The number of concurrent ffmpeg processes.
+        timeout (float): Optional. The number of seconds after which the extraction of a video is abandoned.
+        deadline (float): Optional. The number of seconds after which the remaining extractions are abandoned. None is no deadline.
+
+    Returns:
+        dict: The prepared frames, in order, keyed by video url. Videos without any frame are left out.
+    """
+    if policy not in VIDEO_POLICIES:
+        raise ValueError(f"Unknown video policy: {policy}")
+    if policy == "off" or not videos:
+        return {}
+
+    detail = "low" if image_policy in ("low", "inline_low") else "high"
+    extract_urls = []
+    if policy == "keyframes" and shutil.which("ffmpeg"):
+        extract_urls = list(videos)[:max_videos]
+
+    prepared_videos = {}
+    deadline_at = monotonic() + deadline if deadline is not None else None
+    if extract_urls:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(workers, len(extract_urls))
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _extract_keyframes,
+                    url,
+                    target_size,
+                    max_frames,
+                    frame_interval,
+                    timeout,
+                    deadline_at,
+                ): url
+                for url in extract_urls
+            }
+            for future in concurrent.futures.as_completed(futures):
+                url = futures[future]
+                frames = (
+                    _prepared_frame(url, index, content, target_size, detail)
+                    for index, content in enumerate(_result_or_none(future) or [])
+                )
+                prepared_videos[url] = [frame for frame in frames if frame is not None]
+
+    thumbnail_urls = {
+        url: thumbnail_url
+        for url, thumbnail_url in videos.items()
+        if thumbnail_url and not prepared_videos.get(url)
+    }
+    thumbnails = prepare_images(
+        list(thumbnail_urls.values()),
+        policy=image_policy,
+        target_size=target_size,
+    )
+    for url, thumbnail_url in thumbnail_urls.items():
+        prepared_videos[url] = [thumbnails[thumbnail_url]]
+
+    return {url: frames for url, frames in prepared_videos.items() if frames}
+
+
+def build_montage(
+    images: list[PreparedImage],
+    size: int = 512,
+    detail: str = "low",
+    quality: int = 85,
+) -> Optional[PreparedImage]:
+    """
+    Tile prepared images into a single small inline image, in a square grid that fits size x size.
+    Only inline images can be tiled, the others are left out.
+
+    Args:
+        images (list[PreparedImage]): The images, in order.
+        size (int): Optional. The side, in pixels, of the montage.
+        detail (str): Optional. The detail level the montage is sent at.
+        quality (int): Optional. The JPEG quality of the montage.
+
+    Returns:
+        PreparedImage: The montage. None if none of the images is inline.
+    """
+    from PIL import Image
+
+    start = perf_counter()
+    contents = [
+        base64.b64decode(image.image_url.split(",", 1)[1])
+        for image in images
+        if image is not None and image.image_url.startswith("data:")
+    ]
+    if not contents:
+        return None
+
+    columns = math.ceil(math.sqrt(len(contents)))
+    rows = math.ceil(len(contents) / columns)
+    cell = size // columns
+    montage = Image.new("RGB", (cell * columns, cell * rows), "white")
+    for index, content in enumerate(contents):
+        with Image.open(io.BytesIO(content)) as tile:
+            tile = tile.convert("RGB")
+            tile.thumbnail((cell, cell), Image.Resampling.LANCZOS)
+            row, column = divmod(index, columns)
+            montage.paste(
+                tile,
+                (
+                    column * cell + (cell - tile.width) // 2,
+                    row * cell + (cell - tile.height) // 2,
+                ),
+            )
+    output = io.BytesIO()
+    montage.save(output, format="JPEG", quality=quality, optimize=True)
+    jpeg = output.getvalue()
+    return PreparedImage(
+        source_url="montage",
+        image_url="data:image/jpeg;base64," + base64.b64encode(jpeg).decode(),
+        detail=detail,
+        original_size=montage.size,
+        prepared_size=montage.size,
+        original_bytes=sum(len(content) for content in contents),
+        prepared_bytes=len(jpeg),
+        process_seconds=perf_counter() - start,
+    )
+
+
+def summarize_prepared_images(prepared_images) -> dict:
+    """
+    Sum the token, byte and latency savings of prepared images.
+
+    Args:
+        prepared_images (Iterable[PreparedImage]): The prepared images.
+
+    Returns:
+        dict: The totals before and after preprocessing. Images whose original size is unknown are not counted in the token totals.
+    """
+    summary = {
+        "images": 0,
+        "original_tokens": 0,
+        "prepared_tokens": 0,
+        "original_bytes": 0,
+        "prepared_bytes": 0,
+        "download_seconds": 0.0,
+        "process_seconds": 0.0,
+    }
+    for image in prepared_images:
+        summary["images"] += 1
+        if image.original_tokens is not None and image.prepared_tokens is not None:
+            summary["original_tokens"] += image.original_tokens
+            summary["prepared_tokens"] += image.prepared_tokens
+        if image.prepared_bytes is not None:
+            summary["original_bytes"] += image.original_bytes
+            summary["prepared_bytes"] += image.prepared_bytes
+        summary["download_seconds"] += image.download_seconds
+        summary["process_seconds"] += image.process_seconds
+    summary["saved_tokens"] = summary["original_tokens"] - summary["prepared_tokens"]
+    return summary
+
+
+def _download_images(image_urls: list[str], max_workers: int) -> dict[str, tuple]:
+    """Download the images concurrently over the pooled session. Failed downloads are left out."""
+
+    def download(url):
+        start = perf_counter()
+        response = basic_display_api.get_session().get(url, timeout=30)
+        response.raise_for_status()
+        return response.content, perf_counter() - start
+
+    downloads = {}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(max_workers, len(image_urls))
+    ) as executor:
+        futures = {executor.submit(download, url): url for url in image_urls}
+        for future in concurrent.futures.as_completed(futures):
+            result = _result_or_none(future)
+            if result is not None:
+                downloads[futures[future]] = result
+    return downloads
+
+
+def _downscale(content: bytes, target_size: int, quality: int) -> tuple:
+    """Downscale an image so its longest side is at most target_size, re-encode it as JPEG and hash it. Runs in a worker process."""
+    from PIL import Image
+
+    try:
+        # HEIC support is optional
+        from pillow_heif import register_heif_opener
+
+        register_heif_opener()
+    except ImportError:
+        pass
+
+    start = perf_counter()
+    with Image.open(io.BytesIO(content)) as image:
+        original_size = image.size
+        image = image.convert("RGB")
+        image.thumbnail((target_size, target_size), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+        image_hash = perceptual_hash.dhash(image)
+    return (
+        output.getvalue(),
+        original_size,
+        image.size,
+        image_hash,
+        perf_counter() - start,
+    )
+
+
+def _extract_keyframes(
+    video_url: str,
+    target_size: int,
+    max_frames: int,
+    frame_interval: float,
+    timeout: float,
+    deadline_at: Optional[float] = None,
+) -> list[bytes]:
+    """Extract up to max_frames keyframes, at least frame_interval seconds apart, as JPEG. Only keyframes are decoded."""
+    if deadline_at is not None:
+        # Queued past the deadline, or cut at the deadline when it comes first
+        timeout = min(timeout, deadline_at - monotonic())
+        if timeout <= 0:
+            return []
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run(
+            [
+                "ffmpeg",
+                "-nostdin",
+                "-loglevel",
+                "error",
+                "-threads",
+                "1",
+                "-skip_frame",
+                "nokey",
+                "-i",
+                video_url,
+                "-an",
+                "-vf",
+                f"select='isnan(prev_selected_t)+gte(t-prev_selected_t,{frame_interval})',"
+                f"scale={target_size}:{target_size}:force_original_aspect_ratio=decrease",
+                "-fps_mode",
+                "vfr",
+                "-frames:v",
+                str(max_frames),
+                os.path.join(directory, "frame_%02d.jpg"),
+            ],
+            check=True,
+            timeout=timeout,
+            capture_output=True,
+        )
+        frames = []
+        for name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, name), "rb") as f:
+                frames.append(f.read())
+        return frames
+
+
+def _prepared_frame(
+    video_url: str, index: int, content: bytes, target_size: int, detail: str
+) -> Optional[PreparedImage]:
+    """Hash and re-encode an extracted keyframe into an inline image. None if it cannot be decoded."""
+    processed = _call_or_none(_downscale, content, target_size, 85)
+    if processed is None:
+        return None
+    jpeg, original_size, prepared_size, image_hash, process_seconds = processed
+    return PreparedImage(
+        source_url=f"{video_url}#frame={index}",
+        image_url="data:image/jpeg;base64," + base64.b64encode(jpeg).decode(),
+        detail=detail,
+        original_size=original_size,
+        prepared_size=prepared_size,
+        original_bytes=len(content),
+        prepared_bytes=len(jpeg),
+        process_seconds=process_seconds,
+        perceptual_hash=image_hash,
+    )
+
+
+def _result_or_none(future):
+    try:
+        return future.result()
+    except Exception:
+        return None
+
+
+def _call_or_none(function, *args):
+    try:
+        return function(*args)
+    except Exception:
+        return None
@@ -0,0 +1,278 @@
+import argparse
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+from crud.instagram_media import instagram_media_crud
+from settings import get_settings
+from utils import SessionLocal, init_db
+
+"""
+Managed storage of the instagram_media table at scale: partitioning, and retention of old descriptions and embeddings.
+
+Partitioning (PostgreSQL declarative partitioning), a one-off migration of the existing table:
+
+    - "user_hash": PARTITION BY HASH (user_id) into MEDIA_PARTITIONS partitions. Every per-user query (the sync
+      lookups, the timeline, the windows, the purge) only reads the user's partition, and each partition is vacuumed
+      and indexed on its own. The primary key becomes (id, user_id), media_user_uc is unchanged.
+    - "publish_month": PARTITION BY RANGE (publish_timestamp), a partition per calendar month, plus a default
+      partition. Old months are never written again, so they stay vacuumed, and retention only touches old
+      partitions. The primary key becomes (id, publish_timestamp), and media_user_uc (the upsert conflict target)
+      becomes (media_id, user_id, publish_timestamp), the publish time of a media never changes. The partitions of
+      the next months are created ahead by ensure_month_partitions(), run it from the maintenance job.
+
+The migration renames the table to instagram_media_unpartitioned, creates the partitioned table with the same
+columns, and copies the rows over. Drop instagram_media_unpartitioned once the copy is verified.
+
+Retention (MEDIA_RETENTION_MODE), for media published more than MEDIA_RETENTION_DAYS ago:
+
+    - "cold": the descriptions and embeddings are moved to instagram_media_archive, and the row keeps only what the
+      syncs need (ids, urls, caption, description_hash). Window summaries are summarized again from the archive.
+    - "drop": the descriptions and embeddings are deleted. The cached window summaries of those months are kept.
+    - "off": nothing is archived.
+
+The archived rows are marked with archived_at, they are not described again by the syncs.
+
+PARTITION_SCHEMES, RETENTION_MODES: The partitioning schemes and retention modes.
+partition_statements(): The statements migrating instagram_media to a partitioning scheme.
+month_partition_statement(): The statement creating the partition of a month.
+get_partition_key(): The partition key of instagram_media, if it is partitioned.
+ensure_month_partitions(): Create the partitions of the next months.
+apply_retention(): Archive or drop the descriptions and embeddings of old media, in batches.
+"""
+
+PARTITION_SCHEMES = ("none", "user_hash", "publish_month")
+RETENTION_MODES = ("off", "cold", "drop")
+TABLE = "instagram_media"
+UNPARTITIONED_TABLE = "instagram_media_unpartitioned"
+
+logger = logging.getLogger(__name__)
+
+
+def partition_statements(
+    scheme: str,
+    partitions: Optional[int] = None,
+    first_month: Optional[datetime] = None,
+    last_month: Optional[datetime] = None,
+) -> list[str]:
+    """
+    Build the statements migrating the unpartitioned instagram_media table to a partitioning scheme, to run in a single transaction.
+
+    Args:
+        scheme (str): "user_hash" or "publish_month" (see PARTITION_SCHEMES).
+        partitions (int): Optional. The number of partitions of "user_hash", MEDIA_PARTITIONS by default.
+        first_month (datetime): Optional. The first month with a partition ("publish_month"), e.g. of the oldest media.
+        last_month (datetime): Optional. The last month with a partition ("publish_month"). Defaults to first_month.
+
+    Returns:
+        list[str]: the SQL statements.
+    """
+    if scheme not in PARTITION_SCHEMES[1:]:
+        raise ValueError(f"Unknown partitioning scheme: {scheme}")
+    partitions = partitions or get_settings().media_partitions
+    if scheme == "user_hash":
+        partition_method, partition_column = "HASH", "user_id"
+    else:
+        partition_method, partition_column = "RANGE", "publish_timestamp"
+    unique_columns = "media_id, user_id" + (
+        ", publish_timestamp" if scheme == "publish_month" else ""
+    )
+
+    statements = [
+        # Free the names of the constraints and indexes for the partitioned table
+        f"ALTER TABLE {TABLE} RENAME TO {UNPARTITIONED_TABLE}",
+        f"ALTER TABLE {UNPARTITIONED_TABLE} RENAME CONSTRAINT {TABLE}_pkey TO {UNPARTITIONED_TABLE}_pkey",
+        f"ALTER TABLE {UNPARTITIONED_TABLE} RENAME CONSTRAINT media_user_uc TO {UNPARTITIONED_TABLE}_media_user_uc",
+        f"ALTER INDEX IF EXISTS ix_{TABLE}_url_expires_at RENAME TO ix_{UNPARTITIONED_TABLE}_url_expires_at",
+        f"CREATE TABLE {TABLE} (LIKE {UNPARTITIONED_TABLE} INCLUDING DEFAULTS) PARTITION BY {partition_method} ({partition_column})",
+        # The id keeps its sequence, which must outlive the unpartitioned table
+        f"ALTER SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id",
+        f"ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_pkey PRIMARY KEY (id, {partition_column})",
+        f"ALTER TABLE {TABLE} ADD CONSTRAINT media_user_uc UNIQUE ({unique_columns})",
+        f"CREATE INDEX ix_{TABLE}_url_expires_at ON {TABLE} (url_expires_at)",
+        f"CREATE INDEX ix_{TABLE}_user_id_publish_timestamp ON {TABLE} (user_id, publish_timestamp)",
+    ]
+    if scheme == "user_hash":
+        statements += [
+            f"CREATE TABLE {TABLE}_p{remainder:02d} PARTITION OF {TABLE} "
+            f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"
+            for remainder in range(partitions)
+        ]
+    else:
+        statements += [
+            month_partition_statement(month)
+            for month in _months(first_month, last_month or first_month)
+        ]
+        # Catches the media published out of the range of the monthly partitions
+        statements.append(f"CREATE TABLE {TABLE}_default PARTITION OF {TABLE} DEFAULT")
+    statements.append(f"INSERT INTO {TABLE} SELECT * FROM {UNPARTITIONED_TABLE}")
+    return statements
+
+
+def month_partition_statement(month: datetime) -> str:
+    """The statement creating the partition of the calendar month of month, if it does not exist."""
+    start = month.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = (start + timedelta(days=32)).replace(day=1)
+    return (
+        f"CREATE TABLE IF NOT EXISTS {TABLE}_y{start:%Y}m{start:%m} PARTITION OF {TABLE} "
+        f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+    )
+
+
+def get_partition_key(db: Session) -> Optional[str]:
+    """The partition key of instagram_media, e.g. "HASH (user_id)". None if the table is not partitioned."""
+    return db.execute(
+        text("SELECT pg_get_partkeydef(to_regclass(:table))"), {"table": TABLE}
+    ).scalar()
+
+
+def ensure_month_partitions(db: Session, months_ahead: Optional[int] = None) -> int:
+    """
+    Create the partitions of the current month and of the next months_ahead months (MEDIA_PARTITION_MONTHS_AHEAD by
+    default), when instagram_media is partitioned by month.
+    The partition of a month whose rows were already caught by the default partition is not created (and logged), the rows
+    must be moved out of the default partition first.
+
+    Returns:
+        int: the number of months that have a partition, 0 if the table is not partitioned by month.
+    """
+    if get_partition_key(db) != "RANGE (publish_timestamp)":
+        return 0
+    if months_ahead is None:
+        months_ahead = get_settings().media_partition_months_ahead
+    this_month = datetime.now(timezone.utc).replace(tzinfo=None)
+    months = 0
+    for month in _months(this_month, this_month + timedelta(days=31 * months_ahead)):
+        try:
+            with db.begin_nested():
+                db.execute(text(month_partition_statement(month)))
+            months += 1
+        except DBAPIError as e:
+            logger.error(f"Failed to create the partition of {month:%Y-%m}: {e}")
+    return months
+
+
+def apply_retention(
+    mode: Optional[str] = None,
+    retention_days: Optional[int] = None,
+    batch_size: Optional[int] = None,
+    batch_pause: Optional[float] = None,
+) -> int:
+    """
+    Archive ("cold") or drop ("drop") the descriptions and embeddings of the media published more than retention_days ago.
+    Each batch is its own short transaction, and concurrent syncs skip the rows being archived. The arguments left to None
+    are those of the settings (MEDIA_RETENTION_* variables).
+
+    Args:
+        mode (str): Optional. "off", "cold" or "drop" (see RETENTION_MODES).
+        retention_days (int): Optional. The age, in days, of the media whose descriptions and embeddings are archived.
+        batch_size (int): Optional. The number of rows archived per transaction.
+        batch_pause (float): Optional. Seconds to pause between batches, to leave room for other writers.
+
+    Returns:
+        int: the number of archived rows.
+    """
+    settings = get_settings()
+    mode = mode or settings.media_retention_mode
+    if mode not in RETENTION_MODES:
+        raise ValueError(f"Unknown retention mode: {mode}")
+    if mode == "off":
+        return 0
+    retention_days = retention_days or settings.media_retention_days
+    batch_size = batch_size or settings.media_retention_batch_size
+    if batch_pause is None:
+        batch_pause = settings.media_retention_batch_pause
+    published_before = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(
+        days=retention_days
+    )
+    archived = 0
+    while True:
+        with SessionLocal() as db:
+            batch = instagram_media_crud.archive_media_batch(
+                db, published_before, batch_size, keep_archive=mode == "cold"
+            )
+            db.commit()
+        archived += batch
+        if batch < batch_size:
+            return archived
+        if batch_pause:
+            time.sleep(batch_pause)
+
+
+def _months(first_month: Optional[datetime], last_month: Optional[datetime]):
+    # The first day of each calendar month from first_month to last_month, both included
+    if first_month is None:
+        return
+    month = first_month.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    while month <= last_month:
+        yield month
+        month = (month + timedelta(days=32)).replace(day=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Partition instagram_media, and run its maintenance."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    partition = commands.add_parser(
+        "partition", help="migrate instagram_media to a partitioning scheme"
+    )
+    settings = get_settings()
+    partition.add_argument(
+        "--scheme",
+        choices=PARTITION_SCHEMES[1:],
+        default=settings.media_partition_scheme,
+    )
+    partition.add_argument("--partitions", type=int, default=settings.media_partitions)
+    partition.add_argument(
+        "--apply", action="store_true", help="run the statements, print them otherwise"
+    )
+    commands.add_parser(
+        "maintain",
+        help="create the partitions of the next months and apply the retention policy",
+    )
+    commands.add_parser("status", help="print the partition key of instagram_media")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    SessionLocal.configure(bind=init_db())
+    if args.command == "partition":
+        with SessionLocal() as db:
+            if get_partition_key(db) is not None:
+                parser.error(f"{TABLE} is already partitioned")
+            first_month, last_month = db.execute(
+                text(
+                    f"SELECT min(publish_timestamp), max(publish_timestamp) FROM {TABLE}"
+                )
+            ).one()
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            statements = partition_statements(
+                args.scheme,
+                args.partitions,
+                first_month=first_month or now,
+                last_month=now
+                + timedelta(days=31 * settings.media_partition_months_ahead),
+            )
+            if not args.apply:
+                print(";\n".join(statements) + ";")
+                return
+            for statement in statements:
+                db.execute(text(statement))
+            db.commit()
+            logger.info(f"Partitioned {TABLE}: {get_partition_key(db)}")
+    elif args.command == "maintain":
+        with SessionLocal() as db:
+            months = ensure_month_partitions(db)
+            db.commit()
+        archived = apply_retention()
+        logger.info(f"{months} month partitions ahead, archived {archived} media")
+    else:
+        with SessionLocal() as db:
+            print(get_partition_key(db) or "not partitioned")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,641 @@
+import argparse
+import base64
+import io
+import json
+import random
+import secrets
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlencode, urlparse
+
+"""
+A local mock of the Instagram Basic Display API, serving a synthetic account for deterministic load and fault testing.
+
+Point basic_display_api at it with INSTAGRAM_GRAPH_API_URL and INSTAGRAM_API_URL (or with
+settings.configure(instagram_graph_api_url=..., instagram_api_url=...)), and every call of the client runs against it
+with no network:
+
+    /me                         the profile of the account
+    /me/media                   the media, newest first, with cursor paging (limit, after, before)
+    /{id}                       a media item or album child
+    /{id}/children              the children of an album, with cursor paging
+    /access_token               exchange a short-lived token for a long-lived one
+    /refresh_access_token       refresh a long-lived token
+    /oauth/access_token (POST)  exchange an authorization code for a short-lived token
+    /cdn/{id}.jpg               the image of a media item, a distinct synthetic JPEG per media
+
+The fields parameter is honored, including nested edges such as children{id,media_type}, and responses and
+errors are shaped like the Graph API's. Requests can be delayed, throttled with 429s (with a Retry-After
+header), and failed with 5xx at a given rate, or failed deterministically with fail_next(). Tokens issued by
+the mock expire after their lifetime, and any token can be expired early with expire_token(), after which
+requests fail with the OAuthException (code 190) of an expired session. The mock counts the calls and the
+response statuses, and measures the latency of every endpoint.
+
+MockGraphAPI: The mock server, started in a background thread (or used as a context manager).
+synthetic_media(): Generate the media of a synthetic account.
+project(): Project a media item onto a Graph API fields expression.
+
+    python mock_graph_api.py --media 500 --port 8000 --throttle-rate 0.05 --error-rate 0.01 --latency 0.1
+"""
+
+CDN_URL = "https://scontent-yyz1-1.cdninstagram.com/v/t51.29350-15/{id}_n.jpg?_nc_cat=103&ccb=1-7&_nc_sid=18de74&_nc_ohc=ZcL6GGr5qWMQ7kNvgHwX1DC&_nc_ht=scontent-yyz1-1.cdninstagram.com&edm=ANo9K5cEAAAA&oh=00_AYBRSXAkpkdhCwiR1QAWG3WCQPFqRHPRIQwOkgoeR6tRKQ&oe=66715A7B"
+
+# Signed CDN urls of the account expire in 3 days
+URL_EXPIRY_SECONDS = 3 * 24 * 3600
+# Lifetimes of the tokens issued by the mock, as documented for the Basic Display API
+SHORT_LIVED_TOKEN_SECONDS = 3600
+LONG_LIVED_TOKEN_SECONDS = 60 * 24 * 3600
+
+DEFAULT_PAGE_SIZE = 25  # Page size of /me/media and /{id}/children without a limit
+MAX_PAGE_SIZE = 100  # Larger limits are capped, like the Graph API does
+
+
+def synthetic_media(n, carousel_ratio=0.3, video_ratio=0.1, seed=0):
+    """
+    Generate the media of a synthetic account, shaped like the fixtures in crud/test_instagram_media.py
+    (signed CDN urls, captions, carousel children), newest first.
+
+    Args:
+        n (int): The number of media items.
+        carousel_ratio (float): Optional. The fraction of carousel albums.
+        video_ratio (float): Optional. The fraction of videos.
+        seed (int): Optional. The seed of the generator.
+
+    Returns:
+        list[dict]: The media items, with the full field profile.
+    """
+    rng = random.Random(seed)
+    media = []
+    for i in range(n):
+        media_id = str(18000000000000000 + i)
+        roll = rng.random()
+        media_type = (
+            "CAROUSEL_ALBUM"
+            if roll < carousel_ratio
+            else "VIDEO" if roll < carousel_ratio + video_ratio else "IMAGE"
+        )
+        item = {
+            "id": media_id,
+            "caption": " ".join(
+                rng.choice(["sunset", "friends", "coffee", "#travel", "home"])
+                for _ in range(rng.randint(3, 30))
+            ),
+            "media_type": media_type,
+            "media_url": CDN_URL.format(id=media_id),
+            "permalink": f"https://www.instagram.com/p/{media_id}/",
+            "timestamp": "2024-06-11T20:59:45+0000",
+            "username": "benchmark_user",
+        }
+        if media_type == "VIDEO":
+            item["thumbnail_url"] = CDN_URL.format(id=media_id + "_thumb")
+        if media_type == "CAROUSEL_ALBUM":
+            item["children"] = {
+                "data": [
+                    {
+                        "id": f"{media_id}{c}",
+                        "media_type": "IMAGE",
+                        "media_url": CDN_URL.format(id=f"{media_id}{c}"),
+                        "permalink": f"https://www.instagram.com/p/{media_id}{c}/",
+                        "timestamp": item["timestamp"],
+                    }
+                    for c in range(rng.randint(2, 10))
+                ]
+            }
+        media.append(item)
+    return media
+
+
+def project(item, fields):
+    """Project a media item onto a Graph API fields expression, e.g. "id,children{id}"."""
+    projected = {}
+    depth, start, names = 0, 0, []
+    for i, char in enumerate(fields + ","):
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+        elif char == "," and depth == 0:
+            names.append(fields[start:i])
+            start = i + 1
+    for name in names:
+        if "{" in name:
+            key, nested = name[:-1].split("{", 1)
+            if key in item:
+                projected[key] = {
+                    "data": [project(child, nested) for child in item[key]["data"]]
+                }
+        elif name in item:
+            projected[name] = item[name]
+    return projected
+
+
+class MockGraphAPI:
+    def __init__(
+        self,
+        media: int = 100,
+        carousel_ratio: float = 0.3,
+        video_ratio: float = 0.1,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        retry_after: int = 1,
+        max_page_size: int = MAX_PAGE_SIZE,
+        nested_children_limit: Optional[int] = None,
+        client_secret: Optional[str] = None,
+        strict_tokens: bool = False,
+        seed: int = 0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ) -> None:
+        """
+        Args:
+            media (int): Optional. The number of media items of the account.
+            carousel_ratio (float): Optional. The fraction of carousel albums.
+            video_ratio (float): Optional. The fraction of videos.
+            latency (float): Optional. The delay of every response, in seconds.
+            latency_jitter (float): Optional. A random extra delay of up to this many seconds.
+            error_rate (float): Optional. The fraction of requests answered with a 500 or a 503.
+            throttle_rate (float): Optional. The fraction of requests answered with a 429.
+            retry_after (int): Optional. The Retry-After seconds of the 429 responses.
+            max_page_size (int): Optional. The largest page served, larger limits are capped.
+            nested_children_limit (int): Optional. Truncate the children nested in /me/media to this many,
+                with a next page, so the client has to resolve them from /{id}/children.
+            client_secret (str): Optional. The client secret the token endpoints require, any by default.
+            strict_tokens (bool): Optional. Reject tokens the mock did not issue (see issue_token()).
+            seed (int): Optional. The seed of the account and of the injected faults.
+            host (str): Optional. The interface to listen on.
+            port (int): Optional. The port to listen on, 0 picks a free one.
+        """
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.max_page_size = max_page_size
+        self.nested_children_limit = nested_children_limit
+        self.client_secret = client_secret
+        self.strict_tokens = strict_tokens
+        self.user_id = str(17841400000000000 + seed)
+        self.username = "benchmark_user"
+        self.calls = Counter()
+        self.statuses = Counter()
+        self.request_seconds = []
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._images = {}
+        self._tokens = {}  # token -> expiry timestamp
+        self._failures = deque()  # scripted (status, endpoint) failures
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+        self.url = f"http://{host}:{self._server.server_port}"
+
+        expiry = format(int(time.time()) + URL_EXPIRY_SECONDS, "x")
+        self.media = synthetic_media(media, carousel_ratio, video_ratio, seed)
+        self.media_by_id = {}
+        for item in self.media:
+            for entry in [item] + item.get("children", {}).get("data", []):
+                entry["media_url"] = f"{self.url}/cdn/{entry['id']}.jpg?oe={expiry}"
+                if "thumbnail_url" in entry:
+                    entry["thumbnail_url"] = (
+                        f"{self.url}/cdn/{entry['id']}_thumb.jpg?oe={expiry}"
+                    )
+                self.media_by_id[entry["id"]] = entry
+
+    def start(self) -> str:
+        """Serve in a background thread, and return the base url."""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "MockGraphAPI":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.statuses.clear()
+            self.request_seconds.clear()
+
+    def issue_token(self, lifetime: float = LONG_LIVED_TOKEN_SECONDS) -> str:
+        """Issue a token valid for lifetime seconds."""
+        with self._lock:
+            token = "IG" + secrets.token_urlsafe(32)
+            self._tokens[token] = time.time() + lifetime
+        return token
+
+    def expire_token(self, token: str) -> None:
+        """Expire a token now, whether or not the mock issued it."""
+        with self._lock:
+            self._tokens[token] = time.time() - 1
+
+    def fail_next(self, status: int, count: int = 1, endpoint: str = None) -> None:
+        """
+        Answer the next requests with an error, regardless of the fault rates.
+
+        Args:
+            status (int): The status of the errors, e.g. 429, 500 or 503.
+            count (int): Optional. The number of requests to fail.
+            endpoint (str): Optional. Only fail requests to this endpoint (e.g. "me/media"), any by default.
+        """
+        with self._lock:
+            self._failures.extend([(status, endpoint)] * count)
+
+    def token_error(self, token: Optional[str]) -> Optional[dict]:
+        """The OAuthException of an invalid token, None if it is valid."""
+        if not token:
+            return _oauth_error("An active access token must be used.", 2500)
+        with self._lock:
+            expires_at = self._tokens.get(token)
+        if expires_at is None:
+            if self.strict_tokens:
+                return _oauth_error("Invalid OAuth access token.", 190)
+            return None
+        if expires_at <= time.time():
+            return _oauth_error(
+                "Error validating access token: Session has expired.", 190, 463
+            )
+        return None
+
+    def injected_fault(self, endpoint: str) -> Optional[int]:
+        """The status of the fault injected into a request to an endpoint, None if it is not failed."""
+        with self._lock:
+            for i, (status, failed_endpoint) in enumerate(self._failures):
+                if failed_endpoint in (None, endpoint):
+                    del self._failures[i]
+                    return status
+            roll = self._rng.random()
+            if roll < self.throttle_rate:
+                return 429
+            if roll < self.throttle_rate + self.error_rate:
+                return self._rng.choice((500, 503))
+        return None
+
+    def delay(self) -> float:
+        with self._lock:
+            return self.latency + self._rng.random() * self.latency_jitter
+
+    def _record(self, endpoint: str, status: int, seconds: float) -> None:
+        with self._lock:
+            self.calls[endpoint] += 1
+            self.statuses[status] += 1
+            self.request_seconds.append(seconds)
+
+    def image(self, name: str) -> bytes:
+        """A distinct JPEG per media, so near-duplicate detection does not collapse the account."""
+        with self._lock:
+            if name in self._images:
+                return self._images[name]
+        from PIL import Image
+
+        rng = random.Random(name)
+        pixels = Image.frombytes(
+            "RGB", (16, 20), bytes(rng.randrange(256) for _ in range(16 * 20 * 3))
+        )
+        output = io.BytesIO()
+        pixels.resize((1080, 1350), Image.Resampling.BILINEAR).save(
+            output, format="JPEG", quality=85
+        )
+        with self._lock:
+            self._images[name] = output.getvalue()
+            return self._images[name]
+
+
+def _handler(api: MockGraphAPI):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self._handle(self.path, {})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            form = parse_qs(self.rfile.read(length).decode())
+            self._handle(self.path, {key: values[0] for key, values in form.items()})
+
+        def _handle(self, path, form):
+            start = time.perf_counter()
+            url = urlparse(path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            query.update(form)
+            parts = [part for part in url.path.split("/") if part]
+            endpoint = _endpoint(self.command, parts)
+
+            delay = api.delay()
+            if delay:
+                time.sleep(delay)
+            status = api.injected_fault(endpoint)
+            if status == 429:
+                self._send_json(
+                    429,
+                    _error("Application request limit reached", "OAuthException", 4),
+                    {"Retry-After": str(api.retry_after)},
+                )
+            elif status is not None:
+                self._send_json(
+                    status,
+                    _error("An unexpected error has occurred.", "OAuthException", 2),
+                )
+            else:
+                status = self._route(endpoint, parts, query)
+            api._record(endpoint, status, time.perf_counter() - start)
+
+        def _route(self, endpoint, parts, query):
+            if endpoint == "cdn":
+                return self._send(
+                    200, api.image(parts[1].rsplit(".", 1)[0]), "image/jpeg"
+                )
+            if endpoint == "oauth/access_token":
+                return self._short_lived_token(query)
+            if endpoint == "unknown":
+                return self._send_json(
+                    404, _error("Unknown path components", "IGApiException", 100)
+                )
+
+            error = api.token_error(query.get("access_token"))
+            if error is not None:
+                return self._send_json(400, error)
+
+            if endpoint == "access_token":
+                return self._long_lived_token(query, "ig_exchange_token")
+            if endpoint == "refresh_access_token":
+                return self._long_lived_token(query, "ig_refresh_token")
+            if endpoint == "me":
+                profile = {
+                    "id": api.user_id,
+                    "username": api.username,
+                    "account_type": "PERSONAL",
+                    "media_count": len(api.media),
+                }
+                return self._send_json(200, self._project(profile, query))
+            if endpoint == "me/media":
+                return self._page(f"{api.url}/me/media", api.media, query)
+            if parts[0] not in api.media_by_id:
+                return self._send_json(
+                    400,
+                    _error(
+                        f"Unsupported get request. Object with ID '{parts[0]}' does not exist",
+                        "IGApiException",
+                        100,
+                        33,
+                    ),
+                )
+            media = api.media_by_id[parts[0]]
+            if endpoint == "children":
+                return self._page(
+                    f"{api.url}/{parts[0]}/children",
+                    media.get("children", {"data": []})["data"],
+                    query,
+                )
+            return self._send_json(200, self._project(media, query))
+
+        def _short_lived_token(self, query):
+            if (
+                self.command != "POST"
+                or query.get("grant_type") != "authorization_code"
+            ):
+                return self._send_json(
+                    400, _error("Invalid grant_type", "OAuthException", 101)
+                )
+            if error := self._client_secret_error(query):
+                return self._send_json(400, error)
+            if not query.get("code"):
+                return self._send_json(
+                    400, _error("Missing authorization code", "OAuthException", 100)
+                )
+            token = api.issue_token(SHORT_LIVED_TOKEN_SECONDS)
+            return self._send_json(
+                200, {"access_token": token, "user_id": int(api.user_id)}
+            )
+
+        def _long_lived_token(self, query, grant_type):
+            if query.get("grant_type") != grant_type:
+                return self._send_json(
+                    400, _error("Invalid grant_type", "OAuthException", 101)
+                )
+            if grant_type == "ig_exchange_token" and (
+                error := self._client_secret_error(query)
+            ):
+                return self._send_json(400, error)
+            token = api.issue_token(LONG_LIVED_TOKEN_SECONDS)
+            return self._send_json(
+                200,
+                {
+                    "access_token": token,
+                    "token_type": "bearer",
+                    "expires_in": LONG_LIVED_TOKEN_SECONDS,
+                },
+            )
+
+        def _client_secret_error(self, query):
+            if (
+                api.client_secret is not None
+                and query.get("client_secret") != api.client_secret
+            ):
+                return _error("Error validating client secret.", "OAuthException", 1)
+            return None
+
+        def _project(self, item, query):
+            if "fields" not in query:
+                return {"id": item["id"]}
+            projected = project(item, query["fields"])
+            children = projected.get("children")
+            limit = api.nested_children_limit
+            if (
+                children is not None
+                and limit is not None
+                and len(children["data"]) > limit
+            ):
+                children["data"] = children["data"][:limit]
+                children_query = {
+                    "fields": query["fields"].split("children{", 1)[1].split("}", 1)[0],
+                    "access_token": query.get("access_token", ""),
+                    "limit": limit,
+                    "after": _cursor(limit - 1),
+                }
+                children["paging"] = {
+                    "next": f"{api.url}/{item['id']}/children?{urlencode(children_query)}"
+                }
+            return projected
+
+        def _page(self, url, items, query):
+            limit = min(int(query.get("limit", DEFAULT_PAGE_SIZE)), api.max_page_size)
+            try:
+                if "after" in query:
+                    offset = _offset(query["after"]) + 1
+                elif "before" in query:
+                    offset = max(0, _offset(query["before"]) - limit)
+                else:
+                    offset = 0
+            except ValueError:
+                return self._send_json(
+                    400, _error("Invalid cursor", "IGApiException", 100)
+                )
+            data = [
+                self._project(item, query) for item in items[offset : offset + limit]
+            ]
+            page = {"data": data}
+            if data:
+                first, last = offset, offset + len(data) - 1
+                page["paging"] = {
+                    "cursors": {"before": _cursor(first), "after": _cursor(last)}
+                }
+                base_query = {
+                    key: value
+                    for key, value in query.items()
+                    if key not in ("after", "before")
+                }
+                if last + 1 < len(items):
+                    page["paging"][
+                        "next"
+                    ] = f"{url}?{urlencode({**base_query, 'after': _cursor(last)})}"
+                if first > 0:
+                    page["paging"][
+                        "previous"
+                    ] = f"{url}?{urlencode({**base_query, 'before': _cursor(first)})}"
+            return self._send_json(200, page)
+
+        def _send_json(self, status, body, headers=None):
+            return self._send(
+                status, json.dumps(body).encode(), "application/json", headers
+            )
+
+        def _send(self, status, body, content_type, headers=None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+            return status
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def _endpoint(method: str, parts: list[str]) -> str:
+    if parts[:1] == ["cdn"]:
+        return "cdn"
+    if parts == ["oauth", "access_token"]:
+        return "oauth/access_token"
+    if method != "GET":
+        return "unknown"
+    if parts == ["me"]:
+        return "me"
+    if parts == ["me", "media"]:
+        return "me/media"
+    if parts in (["access_token"], ["refresh_access_token"]):
+        return parts[0]
+    if len(parts) == 2 and parts[1] == "children":
+        return "children"
+    return "media" if len(parts) == 1 else "unknown"
+
+
+def _cursor(offset: int) -> str:
+    # Opaque cursors, like the Graph API's, pointing at an item of the list
+    return base64.urlsafe_b64encode(f"offset:{offset}".encode()).decode()
+
+
+def _offset(cursor: str) -> int:
+    try:
+        prefix, offset = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+    except Exception:
+        raise ValueError(cursor)
+    if prefix != "offset":
+        raise ValueError(cursor)
+    return int(offset)
+
+
+def _error(message, error_type, code, subcode=None):
+    error = {"message": message, "type": error_type, "code": code}
+    if subcode is not None:
+        error["error_subcode"] = subcode
+    error["fbtrace_id"] = "mock"
+    return {"error": error}
+
+
+def _oauth_error(message, code, subcode=None):
+    return _error(message, "OAuthException", code, subcode)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve a mock Instagram Basic Display API locally."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--media", type=int, default=100, help="media items in the account"
+    )
+    parser.add_argument("--carousel-ratio", type=float, default=0.3)
+    parser.add_argument("--video-ratio", type=float, default=0.1)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--latency-jitter", type=float, default=0.0, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 5xx")
+    parser.add_argument(
+        "--throttle-rate", type=float, default=0.0, help="fraction of 429s"
+    )
+    parser.add_argument("--retry-after", type=int, default=1, help="seconds")
+    parser.add_argument("--max-page-size", type=int, default=MAX_PAGE_SIZE)
+    parser.add_argument(
+        "--nested-children-limit",
+        type=int,
+        default=None,
+        help="truncate the children nested in /me/media to this many",
+    )
+    parser.add_argument(
+        "--token-lifetime",
+        type=float,
+        default=LONG_LIVED_TOKEN_SECONDS,
+        help="lifetime, in seconds, of the printed token",
+    )
+    parser.add_argument("--strict-tokens", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    api = MockGraphAPI(
+        media=args.media,
+        carousel_ratio=args.carousel_ratio,
+        video_ratio=args.video_ratio,
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        max_page_size=args.max_page_size,
+        nested_children_limit=args.nested_children_limit,
+        strict_tokens=args.strict_tokens,
+        seed=args.seed,
+        host=args.host,
+        port=args.port,
+    )
+    token = api.issue_token(args.token_lifetime)
+    print(f"Serving {args.media} media at {api.url}")
+    print(f"INSTAGRAM_GRAPH_API_URL={api.url} INSTAGRAM_API_URL={api.url}")
+    print(f"Access token: {token}")
+    try:
+        api._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        api._server.server_close()
+        print(f"Calls: {dict(api.calls)}, statuses: {dict(api.statuses)}")
+
+
+if __name__ == "__main__":
+    main()
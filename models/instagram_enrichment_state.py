@@ -0,0 +1,31 @@
+from datetime import datetime
+from sqlalchemy import DateTime, Integer, String, func, TEXT
+from typing import Optional
+from sqlalchemy.orm import mapped_column, Mapped
+
+
+class InstagramEnrichmentState():
+    __tablename__ = "instagram_enrichment_state"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime, nullable=False, server_default=func.now()
+    )
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime, nullable=False, server_default=func.now(), onupdate=func.now()
+    )
+
+    user_id: Mapped[str] = mapped_column(String(255), nullable=False, unique=True)
+
+    # Rolling profile of the user, built from the descriptions of their media
+    profile: Mapped[Optional[str]] = mapped_column(TEXT, nullable=True)
+    # Number of media folded into the profile
+    media_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # (instagram_media.described_at, instagram_media.id) of the last media folded into the profile, only media described after it is folded next
+    last_described_at: Mapped[Optional[datetime]] = mapped_column(
+        DateTime, nullable=True
+    )
+    last_media_row_id: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # Hash of the prompt and model the profile was built with
+    prompt_version: Mapped[Optional[str]] = mapped_column(String(16), nullable=True)
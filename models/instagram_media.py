@@ -1,6 +1,6 @@
 from datetime import datetime
 from sqlalchemy import DateTime, ForeignKey, Integer, String, func, TEXT, JSON
-from pgvector.sqlalchemy import Vector
+from pgvector.sqlalchemy import BIT, HALFVEC, Vector
 from typing import List, Optional
 from sqlalchemy.orm import mapped_column, Mapped
 from models.types.instagram_media_type import InstagramMediaType
@@ -32,8 +32,32 @@ class InstagramMedia():
     thumbnail_url: Mapped[str] = mapped_column(TEXT, nullable=True)
     caption: Mapped[str] = mapped_column(TEXT, nullable=True)
     album_children: Mapped[dict] = mapped_column(JSON, nullable=True)  # id:media_id
+    # Earliest `oe=` expiry of the signed media_url/thumbnail_url
+    url_expires_at: Mapped[Optional[datetime]] = mapped_column(
+        DateTime, nullable=True, index=True
+    )
+    # When the urls were last checked by a refresh, so unchanged urls and unknown expiries are not refetched on every run
+    url_checked_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
 
     # Data extracted from media
     parent_media_id: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
     media_description: Mapped[str] = mapped_column(TEXT, nullable=True)
+    # When media_description was last set (by the upsert, only when it changes), the enrichment folds the media described after its watermark
+    described_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    # Hash of the fields the description was generated from (see compute_description_hash)
+    description_hash: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    # dhash of the image the description was generated from (see perceptual_hash.dhash)
+    perceptual_hash: Mapped[Optional[str]] = mapped_column(String(16), nullable=True)
+    # Hash of the prompt and model the description was generated with
+    prompt_version: Mapped[Optional[str]] = mapped_column(String(16), nullable=True)
+    # One column per embedding storage mode, only those of EMBEDDING_STORAGE are set (see embedding_storage)
     embeddings: Mapped[Optional[List[float]]] = mapped_column(Vector(1536))
+    embeddings_half: Mapped[Optional[List[float]]] = mapped_column(
+        HALFVEC(1536), nullable=True
+    )
+    embeddings_binary: Mapped[Optional[str]] = mapped_column(BIT(1536), nullable=True)
+    embeddings_reduced: Mapped[Optional[List[float]]] = mapped_column(
+        Vector(256), nullable=True
+    )
+    # When the retention policy moved the description and embeddings out (see media_storage.apply_retention)
+    archived_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
@@ -0,0 +1,27 @@
+from datetime import datetime
+from sqlalchemy import DateTime, Integer, String, func, TEXT
+from pgvector.sqlalchemy import Vector
+from typing import List, Optional
+from sqlalchemy.orm import mapped_column, Mapped
+from sqlalchemy import UniqueConstraint
+
+
+class InstagramMediaArchive():
+    __tablename__ = "instagram_media_archive"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+
+    __table_args__ = (
+        UniqueConstraint("media_id", "user_id", name="media_archive_user_uc"),
+    )
+
+    # When the description and embeddings were moved out of instagram_media
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime, nullable=False, server_default=func.now()
+    )
+
+    user_id: Mapped[str] = mapped_column(String(255), nullable=False)
+    media_id: Mapped[str] = mapped_column(String(255), nullable=False)
+    publish_timestamp: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    media_description: Mapped[Optional[str]] = mapped_column(TEXT, nullable=True)
+    embeddings: Mapped[Optional[List[float]]] = mapped_column(Vector(1536))
@@ -0,0 +1,30 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Optional
+
+
+@dataclass(slots=True)
+class InstagramMediaRecord:
+    """
+    In-flight representation of a processed Instagram media item.
+    It is passed through the pipeline instead of ORM objects and is only turned into a row when it is bulk written.
+    """
+
+    user_id: str
+    media_id: str
+    publish_timestamp: datetime
+    media_type: str
+    media_url: str
+    permalink: Optional[str] = None
+    thumbnail_url: Optional[str] = None
+    url_expires_at: Optional[datetime] = None
+    caption: Optional[str] = None
+    album_children: Optional[List[dict]] = None
+    parent_media_id: Optional[str] = None
+    media_description: Optional[str] = None
+    description_hash: Optional[str] = None
+    perceptual_hash: Optional[str] = None
+    prompt_version: Optional[str] = None
+    embeddings: Optional[List[float]] = None
+    # A new description of archived media makes it current again
+    archived_at: Optional[datetime] = None
@@ -0,0 +1,30 @@
+from datetime import datetime
+from sqlalchemy import DateTime, Integer, String, func, TEXT
+from typing import Optional
+from sqlalchemy.orm import mapped_column, Mapped
+
+
+class InstagramPurgeJob():
+    __tablename__ = "instagram_purge_job"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime, nullable=False, server_default=func.now()
+    )
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime, nullable=False, server_default=func.now(), onupdate=func.now()
+    )
+
+    # Returned to Instagram by the data deletion callback, to look the job up from the status endpoint
+    confirmation_code: Mapped[str] = mapped_column(
+        String(32), nullable=False, unique=True
+    )
+    user_id: Mapped[str] = mapped_column(String(255), nullable=False, index=True)
+    # "deauth" or "delete"
+    reason: Mapped[str] = mapped_column(String(16), nullable=False)
+    # "pending", "running", "done" or "failed"
+    status: Mapped[str] = mapped_column(String(16), nullable=False, default="pending")
+    # Number of instagram_media rows deleted so far
+    deleted_media: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    error: Mapped[Optional[str]] = mapped_column(TEXT, nullable=True)
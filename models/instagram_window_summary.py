@@ -0,0 +1,32 @@
+from datetime import datetime
+from sqlalchemy import DateTime, Integer, String, func, TEXT
+from typing import Optional
+from sqlalchemy.orm import mapped_column, Mapped
+from sqlalchemy import UniqueConstraint
+
+
+class InstagramWindowSummary():
+    __tablename__ = "instagram_window_summary"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "window_start", name="window_summary_user_uc"),
+    )
+
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime, nullable=False, server_default=func.now()
+    )
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime, nullable=False, server_default=func.now(), onupdate=func.now()
+    )
+
+    user_id: Mapped[str] = mapped_column(String(255), nullable=False)
+    # Start of the calendar month of publish_timestamp the summary covers
+    window_start: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    summary: Mapped[Optional[str]] = mapped_column(TEXT, nullable=True)
+    # The window is summarized again once its media count or last media row id changes
+    media_count: Mapped[int] = mapped_column(Integer, nullable=False)
+    last_media_row_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    # Hash of the prompt and model the summary was built with
+    prompt_version: Mapped[Optional[str]] = mapped_column(String(16), nullable=True)
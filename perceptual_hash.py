@@ -0,0 +1,130 @@
+import threading
+from typing import Optional
+
+"""
+Perceptual hashing of images, used to reuse the description of near-duplicate images instead of describing them again.
+
+dhash(): Compute the 64-bit difference hash of a PIL image.
+hamming_distance(): Count the differing bits of two perceptual hashes.
+PerceptualHashIndex: A thread-safe index of described images by perceptual hash, and by the context (prompt version,
+    caption) they were described in.
+"""
+
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+
+def dhash(image) -> str:
+    """
+    Compute the 64-bit difference hash of a PIL image.
+    The image is reduced to a 9x8 grayscale thumbnail, and each bit records whether a pixel is brighter than its right neighbour,
+    so the hash survives re-encoding, resizing and small color changes.
+
+    Args:
+        image (PIL.Image.Image): The image.
+
+    Returns:
+        str: The hash as 16 hex characters.
+    """
+    from PIL import Image
+
+    pixels = list(
+        image.convert("L")
+        .resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.LANCZOS)
+        .getdata()
+    )
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return f"{value:016x}"
+
+
+def hamming_distance(hash_a: str, hash_b: str) -> int:
+    """Count the differing bits of two perceptual hashes."""
+    return (int(hash_a, 16) ^ int(hash_b, 16)).bit_count()
+
+
+class PerceptualHashIndex:
+    """
+    A thread-safe index of described images by perceptual hash.
+    Descriptions are only matched under the context they were generated in, e.g. the prompt version and the hash of
+    the caption sent with the image, since the description depends on both.
+
+    The hashes are split into max_distance + 1 bands: two hashes within max_distance bits of each other have at least
+    one identical band, so a lookup only compares the hashes sharing a band with it rather than every indexed hash.
+    """
+
+    def __init__(self, max_distance: int = 4) -> None:
+        self.max_distance = max_distance
+        bands = min(max_distance + 1, HASH_BITS)
+        # (shift, mask) of each band of the hash
+        bounds = [HASH_BITS * band // bands for band in range(bands + 1)]
+        self._bands = [
+            (start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])
+        ]
+        self._entries = {}  # context: {perceptual_hash int: description}
+        self._buckets = {}  # context: {(band, band value): {perceptual_hash int}}
+        self._lock = threading.Lock()
+
+    def add(self, perceptual_hash: str, context: str, description: str) -> None:
+        if not perceptual_hash or not description:
+            return
+        value = int(perceptual_hash, 16)
+        with self._lock:
+            self._entries.setdefault(context, {})[value] = description
+            buckets = self._buckets.setdefault(context, {})
+            for key in self._band_keys(value):
+                buckets.setdefault(key, set()).add(value)
+
+    def lookup(self, perceptual_hash: str, context: str) -> Optional[str]:
+        """Return the description of the closest indexed image within max_distance. None if there is none."""
+        if not perceptual_hash:
+            return None
+        value = int(perceptual_hash, 16)
+        with self._lock:
+            entries = self._entries.get(context, {})
+            if value in entries:
+                return entries[value]
+            buckets = self._buckets.get(context, {})
+            candidates = set().union(
+                *(buckets.get(key, ()) for key in self._band_keys(value))
+            )
+            best = None
+            best_distance = self.max_distance + 1
+            for indexed_value in candidates:
+                distance = (value ^ indexed_value).bit_count()
+                if distance < best_distance:
+                    best, best_distance = entries[indexed_value], distance
+            return best
+
+    def discard(self, perceptual_hashes: list[str]) -> int:
+        """Remove the descriptions indexed under any of the perceptual hashes, in every context. Returns the number removed."""
+        values = {int(perceptual_hash, 16) for perceptual_hash in perceptual_hashes}
+        removed = 0
+        with self._lock:
+            for context, entries in self._entries.items():
+                buckets = self._buckets[context]
+                for value in values & entries.keys():
+                    del entries[value]
+                    for key in self._band_keys(value):
+                        buckets[key].discard(value)
+                    removed += 1
+        return removed
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(entries) for entries in self._entries.values())
+
+    def _band_keys(self, value: int) -> list[tuple[int, int]]:
+        return [
+            (band, (value >> shift) & mask)
+            for band, (shift, mask) in enumerate(self._bands)
+        ]
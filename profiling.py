@@ -0,0 +1,166 @@
+import contextvars
+import cProfile
+import os
+import pstats
+import re
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional
+
+"""
+Opt-in profiling of the pipeline runs, one profile per stage.
+
+    - "cprofile": a deterministic profile of each stage, written as a pstats file (open it with snakeviz, or
+      pstats.Stats). The thread running the stage is profiled, and so are the threads it starts (the thread
+      pools of construct_instagram_media), which are merged into the same file.
+    - "sampling": every thread is sampled at an interval, and the samples of each stage are written as collapsed
+      stacks ("thread;frame;frame count" lines), the input of flamegraph.pl and speedscope. Threads blocked on
+      the network or a lock show up with the frame they are waiting in.
+    - "off": nothing is profiled. stage() then only reads a context variable, so the hooks can stay in place.
+
+RunProfiler: Profiles the stages of a run and writes their profiles.
+profile(): Make a profiler the current one.
+stage(): Profile the block as a stage of the current profiler (if any).
+"""
+
+PROFILE_MODES = ("off", "cprofile", "sampling")
+
+current_profiler: contextvars.ContextVar[Optional["RunProfiler"]] = (
+    contextvars.ContextVar("current_profiler", default=None)
+)
+
+
+class RunProfiler:
+    """Profiles the stages of a run, writing a profile per stage to the output directory."""
+
+    def __init__(
+        self,
+        run_id: str,
+        mode: str = "cprofile",
+        output_dir: str = "profiles",
+        interval: float = 0.005,
+    ) -> None:
+        """
+        Args:
+            run_id (str): The prefix of the profile files of the run.
+            mode (str): Optional. "cprofile" or "sampling" (see PROFILE_MODES).
+            output_dir (str): Optional. The directory the profiles are written to.
+            interval (float): Optional. The sampling interval, in seconds, of the "sampling" mode.
+        """
+        if mode not in PROFILE_MODES[1:]:
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.run_id = run_id
+        self.mode = mode
+        self.output_dir = output_dir
+        self.interval = interval
+        self.paths = []
+
+    @contextmanager
+    def stage(self, name: str):
+        """Profile the block, and write its profile as the profile of the stage."""
+        profile = _CProfile() if self.mode == "cprofile" else _Sampler(self.interval)
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            os.makedirs(self.output_dir, exist_ok=True)
+            extension = "pstats" if self.mode == "cprofile" else "collapsed"
+            path = os.path.join(self.output_dir, f"{self.run_id}-{name}.{extension}")
+            profile.write(path)
+            self.paths.append(path)
+
+
+@contextmanager
+def profile(profiler: Optional[RunProfiler]):
+    """Make a profiler the current one within the block. None disables profiling."""
+    token = current_profiler.set(profiler)
+    try:
+        yield profiler
+    finally:
+        current_profiler.reset(token)
+
+
+@contextmanager
+def stage(name: str):
+    """Profile the block as a stage of the current profiler. A no-op when no profiler is current."""
+    profiler = current_profiler.get()
+    if profiler is None:
+        yield
+        return
+    with profiler.stage(name):
+        yield
+
+
+class _CProfile:
+    """A cProfile of the current thread and of the threads started while it runs."""
+
+    def __init__(self) -> None:
+        self._profiles = [cProfile.Profile()]
+        self._lock = threading.Lock()
+
+    def _profile_thread(self, frame, event, arg) -> None:
+        # Called once by each new thread, the thread's own profiler then replaces this hook
+        thread_profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(thread_profile)
+        thread_profile.enable()
+
+    def start(self) -> None:
+        threading.setprofile(self._profile_thread)
+        self._profiles[0].enable()
+
+    def stop(self) -> None:
+        self._profiles[0].disable()
+        threading.setprofile(None)
+
+    def write(self, path: str) -> None:
+        with self._lock:
+            stats = pstats.Stats(*self._profiles)
+        stats.dump_stats(path)
+
+
+class _Sampler:
+    """Samples the stacks of every thread at an interval, from a background thread."""
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._sample, name="profiling-sampler", daemon=True
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def _sample(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                # Fold the workers of a pool together, e.g. ThreadPoolExecutor-3_1 into ThreadPoolExecutor
+                stack.append(
+                    re.sub(r"-\d+(_\d+)?$", "", names.get(thread_id, str(thread_id)))
+                )
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path: str) -> None:
+        with open(path, "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
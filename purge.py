@@ -0,0 +1,239 @@
+import base64
+import concurrent.futures
+import hashlib
+import hmac
+import json
+import logging
+import secrets
+import time
+from typing import Optional
+import instagram_processor
+import usage
+from crud.instagram_enrichment_state import instagram_enrichment_state_crud
+from crud.instagram_media import instagram_media_crud
+from crud.instagram_media_archive import instagram_media_archive_crud
+from crud.instagram_purge_job import instagram_purge_job_crud
+from crud.instagram_window_summary import instagram_window_summary_crud
+from utils import SessionLocal
+
+"""
+Asynchronous purges of a user's Instagram data, for the deauthorization and data deletion callbacks.
+
+The callbacks only record a purge job and return its confirmation code, the job runs in the background:
+
+    - the user's instagram_media rows (with their descriptions and embeddings) are deleted in batches of
+      PURGE_BATCH_SIZE, each in its own short transaction, so a heavy user does not lock the table
+    - the descriptions and embeddings of the user's media in cold storage (instagram_media_archive), in batches too
+    - the window summaries and the enrichment state (the cached profile) of the user are deleted
+    - the in-process caches are invalidated: the descriptions of the user's images in the global perceptual hash
+      index, and the rolled up usage of the user
+
+The progress of a job is stored in instagram_purge_job, so it can be polled from the status endpoint, and jobs
+interrupted by a restart are resumed by PurgeQueue.resume(), keeping the count of media already deleted.
+
+A purge does not stop the user's data from being ingested again: a sync already running, and the PollingScheduler (in
+its own process, until it reloads) can store the user's media after the purge. The callbacks drop the events of the
+user pending in the webhook coalescer, and a deauthorized token can no longer fetch media, but a data deletion
+request from a user who is still authorized needs the user removed from the scheduler too.
+
+parse_signed_request(): Verify and decode the signed_request of a callback.
+purge_user_data(): Delete every row and cached entry of a user.
+PurgeQueue: Records purge jobs and runs them in the background.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def parse_signed_request(signed_request: str, app_secret: str) -> Optional[dict]:
+    """
+    Verify and decode the signed_request posted to the deauthorization and data deletion callbacks.
+
+    Args:
+        signed_request (str): "<base64url signature>.<base64url json payload>".
+        app_secret (str): The app secret the request is signed with (HMAC-SHA256 of the encoded payload).
+
+    Returns:
+        dict: the payload, including the user_id of the app-scoped Instagram user. None if the signature is invalid.
+    """
+    if not signed_request or not app_secret:
+        return None
+    try:
+        encoded_signature, encoded_payload = signed_request.split(".", 1)
+        signature = _base64url_decode(encoded_signature)
+        payload = json.loads(_base64url_decode(encoded_payload))
+    except (ValueError, TypeError):
+        return None
+    expected = hmac.new(
+        app_secret.encode(), encoded_payload.encode(), hashlib.sha256
+    ).digest()
+    if not hmac.compare_digest(expected, signature) or not isinstance(payload, dict):
+        return None
+    if str(payload.get("algorithm", "")).upper() != "HMAC-SHA256":
+        return None
+    return payload
+
+
+def purge_user_data(
+    user_id: str,
+    confirmation_code: Optional[str] = None,
+    batch_size: int = 1000,
+    batch_pause: float = 0.0,
+    deleted_media: int = 0,
+) -> int:
+    """
+    Delete every row and cached entry of a user. Safe to run again on a partly purged user.
+
+    Args:
+        user_id (str): The user whose data is purged.
+        confirmation_code (str): Optional. The purge job to record the progress on.
+        batch_size (int): Optional. The number of media rows deleted per transaction.
+        batch_pause (float): Optional. Seconds to pause between batches, to leave room for other writers.
+        deleted_media (int): Optional. The number of media rows deleted by an earlier, interrupted run of the job.
+
+    Returns:
+        int: the number of media rows deleted, including deleted_media.
+    """
+    with SessionLocal() as db:
+        perceptual_hashes = instagram_media_crud.get_perceptual_hashes_by_user_id(
+            db, user_id
+        )
+
+    while True:
+        with SessionLocal() as db:
+            deleted = instagram_media_crud.delete_media_batch_by_user_id(
+                db, user_id, batch_size
+            )
+            deleted_media += deleted
+            if confirmation_code:
+                instagram_purge_job_crud.update_job(
+                    db, confirmation_code, deleted_media=deleted_media
+                )
+            db.commit()
+        if deleted < batch_size:
+            break
+        if batch_pause:
+            time.sleep(batch_pause)
+
+    while True:
+        with SessionLocal() as db:
+            deleted = instagram_media_archive_crud.delete_archive_batch_by_user_id(
+                db, user_id, batch_size
+            )
+            db.commit()
+        if deleted < batch_size:
+            break
+        if batch_pause:
+            time.sleep(batch_pause)
+
+    with SessionLocal() as db:
+        instagram_window_summary_crud.delete_summaries_by_user_id(db, user_id)
+        instagram_enrichment_state_crud.delete_state_by_user_id(db, user_id)
+        db.commit()
+
+    instagram_processor._global_perceptual_hash_index().discard(perceptual_hashes)
+    usage.forget_user(user_id)
+    return deleted_media
+
+
+class PurgeQueue:
+    """Records purge jobs in the database and runs them in the background."""
+
+    def __init__(
+        self, batch_size: int = 1000, batch_pause: float = 0.0, max_workers: int = 1
+    ) -> None:
+        """
+        Args:
+            batch_size (int): Optional. The number of media rows deleted per transaction.
+            batch_pause (float): Optional. Seconds to pause between batches.
+            max_workers (int): Optional. The maximum number of jobs run at once.
+        """
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="purge"
+        )
+
+    def enqueue(self, user_id: Optional[str], reason: str) -> str:
+        """
+        Record a purge job and run it in the background.
+
+        Args:
+            user_id (str): The user to purge. None for an Instagram user with no data here, whose job is recorded as done.
+            reason (str): "deauth" or "delete".
+
+        Returns:
+            str: the confirmation code of the job.
+        """
+        confirmation_code = secrets.token_hex(8)
+        with SessionLocal() as db:
+            instagram_purge_job_crud.create_job(
+                db,
+                confirmation_code,
+                user_id or "",
+                reason,
+                status="pending" if user_id else "done",
+            )
+            db.commit()
+        if user_id:
+            self._executor.submit(self.run_job, confirmation_code, user_id)
+        return confirmation_code
+
+    def resume(self) -> int:
+        """Run again the jobs that were pending or running when the process stopped. Returns the number of jobs resumed."""
+        with SessionLocal() as db:
+            jobs = [
+                (job.confirmation_code, job.user_id, job.deleted_media or 0)
+                for job in instagram_purge_job_crud.get_unfinished_jobs(db)
+            ]
+        for confirmation_code, user_id, deleted_media in jobs:
+            self._executor.submit(
+                self.run_job, confirmation_code, user_id, deleted_media
+            )
+        return len(jobs)
+
+    def run_job(
+        self, confirmation_code: str, user_id: str, deleted_media: int = 0
+    ) -> None:
+        self._update(confirmation_code, status="running")
+        try:
+            deleted_media = purge_user_data(
+                user_id,
+                confirmation_code=confirmation_code,
+                batch_size=self.batch_size,
+                batch_pause=self.batch_pause,
+                deleted_media=deleted_media,
+            )
+        except Exception as e:
+            logger.error(f"Failed to purge the data of {user_id}: {e}")
+            self._update(confirmation_code, status="failed", error=str(e))
+            return
+        self._update(confirmation_code, status="done", deleted_media=deleted_media)
+
+    def status(self, confirmation_code: str) -> Optional[dict]:
+        """The status of a job. None if there is no job with this confirmation code."""
+        with SessionLocal() as db:
+            job = instagram_purge_job_crud.get_job_by_confirmation_code(
+                db, confirmation_code
+            )
+            if job is None:
+                return None
+            return {
+                "confirmation_code": job.confirmation_code,
+                "reason": job.reason,
+                "status": job.status,
+                "deleted_media": job.deleted_media,
+                "created_at": job.created_at.isoformat(),
+                "updated_at": job.updated_at.isoformat(),
+            }
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    def _update(self, confirmation_code: str, **fields) -> None:
+        with SessionLocal() as db:
+            instagram_purge_job_crud.update_job(db, confirmation_code, **fields)
+            db.commit()
+
+
+def _base64url_decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
@@ -0,0 +1,466 @@
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import math
+import random
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable, Optional
+import basic_display_api
+import instagram_processor
+from lazy_imports import lazy_import
+from settings import get_settings
+
+instagram_media_crud = lazy_import("crud.instagram_media", "instagram_media_crud")
+SessionLocal = lazy_import("utils", "SessionLocal")
+
+"""
+Polling of the users' accounts, scheduled from each user's posting cadence.
+
+Instead of syncing every user on a fixed trigger, each user is checked when a new post is likely:
+
+    - the posting interval of a user is learned from the publish_timestamp of their recent posts
+      (instagram_media_crud.get_posting_cadences), then updated from the posts found by each check
+    - a check is a single cheap call (the newest media id and timestamp, the "ids_only" field profile with a page
+      of one), and the full sync (InstagramProcesser.run) only runs when it found a post newer than the last one
+    - the next check of an active user is due after a fraction (SCHEDULER_CHECK_RATIO) of their posting interval,
+      every check that finds nothing doubles the delay, up to SCHEDULER_MAX_INTERVAL, so dormant accounts are
+      checked less and less often. An account that has been dormant for a while when it is loaded starts backed off.
+    - every check and sync spends from a global budget of API calls per hour, shared by the whole fleet. The checks
+      that are due when the budget is spent wait for it to refill, the most overdue first.
+
+PollingScheduler.notify() checks a user right away, e.g. when something else (a webhook) hinted at a new post.
+
+UserSchedule: The learned cadence and the next check of a user.
+estimate_interval(): Estimate a posting interval from a user's recent posts.
+ApiBudget: A token bucket of API calls.
+PollingScheduler: Schedules the checks of every user, and syncs the users with new posts.
+probe_newest_post(): Get the publish time of the newest post of a user, in a single API call.
+sync_user(): Run a sync of a user.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Number of recent posts the posting interval is learned from
+CADENCE_RECENT_POSTS = 20
+# Weight of the interval since the previous post in the learned interval
+CADENCE_SMOOTHING = 0.3
+# Estimated API calls of a sync with new posts (a page of /me/media, the children of an album, a token refresh)
+SYNC_API_CALLS = 3
+
+
+@dataclass(slots=True)
+class UserSchedule:
+    user_id: str
+    # Learned seconds between two posts
+    interval: float
+    # Unix time of the newest known post, None if the user has none
+    last_post_at: Optional[float] = None
+    next_check_at: float = 0.0
+    # Consecutive checks that found no new post, the exponent of the backoff
+    empty_checks: int = 0
+
+
+def estimate_interval(
+    post_count: int,
+    first_published: Optional[datetime],
+    last_published: Optional[datetime],
+    default_interval: Optional[float] = None,
+) -> float:
+    """
+    Estimate the posting interval of a user, the mean interval between their recent posts.
+
+    Args:
+        post_count (int): The number of recent posts.
+        first_published (datetime): The publish time of the oldest of them.
+        last_published (datetime): The publish time of the newest of them.
+        default_interval (float): Optional. The interval of a user with less than two posts, SCHEDULER_DEFAULT_INTERVAL
+            by default.
+
+    Returns:
+        float: the interval, in seconds.
+    """
+    if post_count < 2 or first_published is None or last_published is None:
+        if default_interval is None:
+            return get_settings().scheduler_default_interval
+        return default_interval
+    return (last_published - first_published).total_seconds() / (post_count - 1)
+
+
+class ApiBudget:
+    """A token bucket of API calls, refilled at a fixed rate."""
+
+    def __init__(
+        self,
+        calls_per_hour: float,
+        burst: Optional[float] = None,
+        now: Optional[float] = None,
+    ) -> None:
+        """
+        Args:
+            calls_per_hour (float): The rate the budget refills at.
+            burst (float): Optional. The most calls that can be saved up. Defaults to a minute of calls, at least one sync.
+            now (float): Optional. The unix time the budget starts full at.
+        """
+        self.rate = calls_per_hour / 3600
+        self.capacity = burst or max(calls_per_hour / 60, 1 + SYNC_API_CALLS)
+        self.tokens = self.capacity
+        self.updated_at = time.time() if now is None else now
+
+    def try_spend(self, calls: float, now: float) -> bool:
+        """Spend the calls if the budget holds them. Returns False, spending nothing, otherwise."""
+        self._refill(now)
+        if self.tokens < calls:
+            return False
+        self.tokens -= calls
+        return True
+
+    def spend(self, calls: float, now: float) -> None:
+        """Spend the calls even if the budget does not hold them, the later calls then wait for the debt to be refilled."""
+        self._refill(now)
+        self.tokens -= calls
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = max(self.updated_at, now)
+
+
+class PollingScheduler:
+    """Schedules the checks of every user from their posting cadence, and syncs the users whose check found a new post."""
+
+    def __init__(
+        self,
+        probe: Callable[[str], Optional[float]],
+        sync: Callable[[str], None],
+        budget: Optional[ApiBudget] = None,
+        min_interval: Optional[float] = None,
+        max_interval: Optional[float] = None,
+        default_interval: Optional[float] = None,
+        check_ratio: Optional[float] = None,
+        jitter: float = 0.1,
+        max_workers: Optional[int] = None,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        """
+        Args:
+            probe (Callable): Called with a user id, returns the unix publish time of the user's newest post (None if they have none).
+                A single API call, see probe_newest_post().
+            sync (Callable): Called with the id of a user with a new post, syncs the user (see sync_user()).
+            budget (ApiBudget): Optional. The global budget of API calls, unlimited if None.
+            min_interval (float): Optional. The shortest delay, in seconds, between two checks of a user.
+            max_interval (float): Optional. The longest delay, in seconds, between two checks of a user, however dormant.
+            default_interval (float): Optional. The posting interval of a user with less than two posts.
+            check_ratio (float): Optional. The delay of the first check after a post, as a fraction of the posting interval.
+            jitter (float): Optional. The random fraction added to each delay, so the checks of users loaded together spread out.
+            max_workers (int): Optional. The maximum number of syncs run at once. 0 runs the syncs inline.
+            clock (Callable): Optional. Returns the current unix time.
+
+        The intervals, check_ratio and max_workers left to None are those of the settings (SCHEDULER_* variables).
+        """
+        settings = get_settings()
+        self.probe = probe
+        self.sync = sync
+        self.budget = budget
+        self.min_interval = _or_default(min_interval, settings.scheduler_min_interval)
+        self.max_interval = _or_default(max_interval, settings.scheduler_max_interval)
+        self.default_interval = _or_default(
+            default_interval, settings.scheduler_default_interval
+        )
+        self.check_ratio = _or_default(check_ratio, settings.scheduler_check_ratio)
+        max_workers = _or_default(max_workers, settings.scheduler_max_workers)
+        self.jitter = jitter
+        self.clock = clock
+        self.stats = Counter()
+        self.schedules = {}  # user id: UserSchedule
+        # (next_check_at, sequence, user id) of every scheduled check, stale entries are skipped
+        self._queue = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._syncing = set()
+        self._executor = (
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="scheduler"
+            )
+            if max_workers
+            else None
+        )
+
+    def add_user(
+        self,
+        user_id: str,
+        interval: Optional[float] = None,
+        last_post_at: Optional[float] = None,
+    ) -> UserSchedule:
+        """
+        Schedule the first check of a user. A user already scheduled keeps their schedule.
+
+        Args:
+            user_id (str): The user.
+            interval (float): Optional. The posting interval of the user (see estimate_interval()). Defaults to default_interval.
+            last_post_at (float): Optional. The unix publish time of the user's newest stored post.
+
+        Returns:
+            UserSchedule: the schedule of the user.
+        """
+        if user_id in self.schedules:
+            return self.schedules[user_id]
+        now = self.clock()
+        schedule = UserSchedule(
+            user_id,
+            self._clamp(interval or self.default_interval),
+            last_post_at=last_post_at,
+        )
+        if last_post_at is None:
+            schedule.next_check_at = now
+        else:
+            # Dormant for longer than the posting interval: start backed off, as if the missed checks had run
+            dormant_for = now - last_post_at
+            if dormant_for > schedule.interval:
+                schedule.empty_checks = int(math.log2(dormant_for / schedule.interval))
+            schedule.next_check_at = max(
+                now, last_post_at + schedule.interval * self.check_ratio
+            )
+            if schedule.empty_checks:
+                schedule.next_check_at = now + self._delay(schedule) * random.random()
+        self.schedules[user_id] = schedule
+        self._push(schedule)
+        return schedule
+
+    def load(self, db, recent: int = CADENCE_RECENT_POSTS) -> int:
+        """
+        Schedule every user with stored media that is not scheduled yet, from the cadence of their recent posts.
+
+        Returns:
+            int: the number of users added.
+        """
+        added = 0
+        for (
+            user_id,
+            post_count,
+            first_published,
+            last_published,
+        ) in instagram_media_crud.get_posting_cadences(
+            db, recent=recent, exclude_user_ids=list(self.schedules)
+        ):
+            if user_id in self.schedules:
+                continue
+            self.add_user(
+                user_id,
+                estimate_interval(
+                    post_count, first_published, last_published, self.default_interval
+                ),
+                # publish_timestamp is stored as naive UTC
+                last_post_at=last_published.replace(tzinfo=timezone.utc).timestamp(),
+            )
+            added += 1
+        return added
+
+    def remove_user(self, user_id: str) -> None:
+        self.schedules.pop(user_id, None)
+
+    def notify(self, user_id: str) -> None:
+        """Check the user right away, and reset their backoff."""
+        schedule = self.schedules.get(user_id) or self.add_user(user_id)
+        schedule.empty_checks = 0
+        schedule.next_check_at = self.clock()
+        self._push(schedule)
+
+    def next_check_at(self) -> Optional[float]:
+        """The unix time of the next due check, None if no user is scheduled."""
+        self._drop_stale()
+        return self._queue[0][0] if self._queue else None
+
+    def run_due(self, now: Optional[float] = None) -> list[str]:
+        """
+        Check every user whose check is due (while the budget lasts), and sync the users with a new post.
+
+        Args:
+            now (float): Optional. The current unix time, defaults to the clock.
+
+        Returns:
+            list[str]: the ids of the users synced.
+        """
+        now = self.clock() if now is None else now
+        synced = []
+        while True:
+            self._drop_stale()
+            if not self._queue or self._queue[0][0] > now:
+                break
+            if self.budget is not None and not self.budget.try_spend(1, now):
+                # The remaining checks wait for the budget, they stay first in the queue
+                self.stats["deferred"] += sum(
+                    1
+                    for schedule in self.schedules.values()
+                    if schedule.next_check_at <= now
+                )
+                break
+            _, _, user_id = heapq.heappop(self._queue)
+            schedule = self.schedules[user_id]
+            self.stats["checks"] += 1
+            try:
+                newest_post_at = self.probe(user_id)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Failed to check {user_id} for new posts: {e}")
+                newest_post_at = None
+            if newest_post_at is not None and (
+                schedule.last_post_at is None or newest_post_at > schedule.last_post_at
+            ):
+                self._learn(schedule, newest_post_at)
+                if self._start_sync(user_id, now):
+                    synced.append(user_id)
+            elif (
+                schedule.last_post_at is None
+                or now - schedule.last_post_at > schedule.interval
+            ):
+                # Only overdue users back off, before that they are checked at the pace of their posting interval
+                schedule.empty_checks += 1
+            schedule.next_check_at = now + self._delay(schedule)
+            self._push(schedule)
+        return synced
+
+    def run_forever(
+        self,
+        stop: threading.Event,
+        poll_seconds: Optional[float] = None,
+        reload_seconds: Optional[float] = None,
+    ) -> None:
+        """Load the users from the database every reload_seconds, and run the due checks every poll_seconds, until stop is set."""
+        settings = get_settings()
+        poll_seconds = _or_default(poll_seconds, settings.scheduler_poll_seconds)
+        reload_seconds = _or_default(reload_seconds, settings.scheduler_reload_seconds)
+        loaded_at = None
+        while not stop.is_set():
+            if loaded_at is None or self.clock() - loaded_at >= reload_seconds:
+                with SessionLocal() as db:
+                    added = self.load(db)
+                loaded_at = self.clock()
+                logger.info(
+                    f"Scheduled {added} new users, {len(self.schedules)} in total"
+                )
+            self.run_due()
+            stop.wait(poll_seconds)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def _learn(self, schedule: UserSchedule, newest_post_at: float) -> None:
+        # The interval since the previous post (which may be several posts ago) updates the learned interval
+        if schedule.last_post_at is not None:
+            schedule.interval = self._clamp(
+                (1 - CADENCE_SMOOTHING) * schedule.interval
+                + CADENCE_SMOOTHING * (newest_post_at - schedule.last_post_at)
+            )
+        schedule.last_post_at = newest_post_at
+        schedule.empty_checks = 0
+
+    def _start_sync(self, user_id: str, now: float) -> bool:
+        with self._lock:
+            if user_id in self._syncing:
+                # The running sync may not see the new post, check again at the next check
+                self.stats["skipped_syncs"] += 1
+                return False
+            self._syncing.add(user_id)
+        if self.budget is not None:
+            self.budget.spend(SYNC_API_CALLS, now)
+        self.stats["syncs"] += 1
+        if self._executor is None:
+            self._sync(user_id)
+        else:
+            self._executor.submit(self._sync, user_id)
+        return True
+
+    def _sync(self, user_id: str) -> None:
+        try:
+            self.sync(user_id)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Failed to sync {user_id}: {e}")
+        finally:
+            with self._lock:
+                self._syncing.discard(user_id)
+
+    def _delay(self, schedule: UserSchedule) -> float:
+        delay = self._clamp(schedule.interval * self.check_ratio)
+        delay = min(self.max_interval, delay * 2 ** min(schedule.empty_checks, 32))
+        return delay * (1 + self.jitter * random.random())
+
+    def _clamp(self, interval: float) -> float:
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def _push(self, schedule: UserSchedule) -> None:
+        heapq.heappush(
+            self._queue,
+            (schedule.next_check_at, next(self._sequence), schedule.user_id),
+        )
+
+    def _drop_stale(self) -> None:
+        # Entries of removed users, and of users scheduled again since
+        while self._queue:
+            next_check_at, _, user_id = self._queue[0]
+            schedule = self.schedules.get(user_id)
+            if schedule is not None and schedule.next_check_at == next_check_at:
+                return
+            heapq.heappop(self._queue)
+
+
+def _or_default(value, default):
+    return default if value is None else value
+
+
+def probe_newest_post(user_id: str) -> Optional[float]:
+    """
+    Get the publish time of the newest post of a user, with a single call to /me/media (the ids_only fields, a page of one).
+
+    Returns:
+        float: the unix publish time of the newest post. None if the user has no post or no active token.
+    """
+    token = instagram_processor.get_instagram_access_token(user_id)
+    if not token:
+        return None
+    media = basic_display_api.get_user_media(
+        token.auth_info["access_token"], profile="ids_only", page_size=1, max_items=1
+    )
+    data = (media or {}).get("data") or []
+    if not data:
+        return None
+    return datetime.strptime(data[0]["timestamp"], "%Y-%m-%dT%H:%M:%S%z").timestamp()
+
+
+def sync_user(user_id: str) -> None:
+    """
+    Run a sync of a user, which fetches and processes their new media.
+    The user is looked up with instagram_processor.get_user_by_user_id, a stub of the user store (which is not part of this
+    repository) that always returns None: until it is implemented, no user is synced and the scheduler only probes.
+    """
+    user = instagram_processor.get_user_by_user_id(user_id)
+    if user is None:
+        return
+    instagram_processor.InstagramProcesser(user).run()
+
+
+if __name__ == "__main__":
+    from utils import AsyncSessionLocal, init_async_db, init_db
+
+    logging.basicConfig(level=logging.INFO)
+    SessionLocal.configure(bind=init_db())
+    AsyncSessionLocal.configure(bind=init_async_db())
+    api_budget_per_hour = get_settings().scheduler_api_budget_per_hour
+    scheduler = PollingScheduler(
+        probe_newest_post,
+        sync_user,
+        budget=ApiBudget(api_budget_per_hour) if api_budget_per_hour else None,
+    )
+    try:
+        scheduler.run_forever(threading.Event())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.close()
@@ -0,0 +1,178 @@
+import pytest
+import basic_display_api
+from mock_graph_api import MAX_PAGE_SIZE, MockGraphAPI
+from settings import override_settings
+
+TEST_CLIENT_SECRET = "test_client_secret"
+
+
+@pytest.fixture
+def mock_api():
+    with MockGraphAPI(
+        media=150, carousel_ratio=0.5, client_secret=TEST_CLIENT_SECRET
+    ) as api, override_settings(
+        instagram_graph_api_url=api.url, instagram_api_url=api.url
+    ):
+        yield api
+
+
+@pytest.fixture
+def token(mock_api):
+    return mock_api.issue_token()
+
+
+def test_token_flow(mock_api):
+    short_lived = basic_display_api.get_short_access_token(
+        "client_id", TEST_CLIENT_SECRET, "https://localhost/callback", "code"
+    )
+    assert short_lived["user_id"] == int(mock_api.user_id)
+
+    long_lived = basic_display_api.exchange_for_long_lived_token(
+        short_lived["access_token"], TEST_CLIENT_SECRET
+    )
+    assert long_lived["expires_in"] > 3600
+
+    refreshed = basic_display_api.refresh_access_token(long_lived["access_token"])
+    assert refreshed["access_token"] != long_lived["access_token"]
+    assert basic_display_api.get_user_profile(refreshed["access_token"])["id"] == (
+        mock_api.user_id
+    )
+
+    with pytest.raises(Exception, match="client secret"):
+        basic_display_api.exchange_for_long_lived_token(
+            short_lived["access_token"], "wrong_secret"
+        )
+
+
+def test_get_user_profile(mock_api, token):
+    profile = basic_display_api.get_user_profile(token)
+    assert profile["username"] == mock_api.username
+    assert profile["media_count"] == 150
+
+
+def test_get_user_media_paging(mock_api, token):
+    result = basic_display_api.get_user_media(token, page_size=7, max_items=1000)
+    assert [media["id"] for media in result["data"]] == [
+        media["id"] for media in mock_api.media
+    ]
+    assert mock_api.calls["me/media"] == 22
+    assert "next" not in result["paging"]
+
+
+def test_get_user_media_max_items(mock_api, token):
+    result = basic_display_api.get_user_media(token, page_size=10, max_items=25)
+    assert len(result["data"]) == 30
+    assert mock_api.calls["me/media"] == 3
+
+
+def test_get_user_media_until(mock_api, token):
+    wanted = mock_api.media[23]["id"]
+    result = basic_display_api.get_user_media(
+        token,
+        page_size=10,
+        max_items=None,
+        until=lambda page: any(media["id"] == wanted for media in page),
+    )
+    assert len(result["data"]) == 30
+    assert mock_api.calls["me/media"] == 3
+
+
+def test_get_user_media_until_without_paging():
+    # An account without media is listed without paging, the page is still passed to until
+    pages = []
+    with MockGraphAPI(media=0) as api, override_settings(
+        instagram_graph_api_url=api.url
+    ):
+        result = basic_display_api.get_user_media(
+            api.issue_token(), until=lambda page: pages.append(page)
+        )
+    assert "paging" not in result
+    assert pages == [[]]
+
+
+def test_get_user_media_page_size_is_capped(token):
+    result = basic_display_api.get_user_media(token, page_size=1000, max_items=1)
+    assert len(result["data"]) == MAX_PAGE_SIZE
+
+
+def test_get_user_media_field_profile(token):
+    result = basic_display_api.get_user_media(token, profile="ids_only", page_size=5)
+    assert set(result["data"][0]) == {"id", "timestamp"}
+
+
+def test_resolve_carousel_children(mock_api, token):
+    mock_api.nested_children_limit = 2
+    media = basic_display_api.get_user_media(token, page_size=100)["data"]
+    truncated = [
+        item
+        for item in media
+        if item["media_type"] == "CAROUSEL_ALBUM"
+        and "next" in item["children"].get("paging", {})
+    ]
+    assert truncated
+
+    resolved = basic_display_api.resolve_carousel_children(media, token)
+    assert resolved == len(truncated)
+    for item in truncated:
+        assert [child["id"] for child in item["children"]["data"]] == [
+            child["id"]
+            for child in mock_api.media_by_id[item["id"]]["children"]["data"]
+        ]
+
+
+def test_resolve_carousel_children_logs_failures(mock_api, token, caplog):
+    mock_api.nested_children_limit = 2
+    media = basic_display_api.get_user_media(token, page_size=100)["data"]
+    album = next(
+        item
+        for item in media
+        if item["media_type"] == "CAROUSEL_ALBUM"
+        and "next" in item["children"].get("paging", {})
+    )
+    nested_children = album["children"]
+    mock_api.fail_next(500, endpoint="children")
+
+    assert basic_display_api.resolve_carousel_children([album], token) == 0
+    # The album keeps its nested children, and the failure is logged with the album id
+    assert album["children"] is nested_children
+    assert album["id"] in caplog.text
+
+
+def test_get_media(mock_api, token):
+    media = mock_api.media[3]
+    result = basic_display_api.get_media(media["id"], token, profile="refresh")
+    assert result["media_url"] == media["media_url"]
+
+    with pytest.raises(Exception, match="does not exist"):
+        basic_display_api.get_media("missing", token)
+
+
+def test_expired_token(mock_api, token):
+    mock_api.expire_token(token)
+    with pytest.raises(Exception, match="Session has expired"):
+        basic_display_api.get_user_media(token)
+
+
+def test_injected_faults(mock_api, token):
+    mock_api.fail_next(429)
+    with pytest.raises(Exception, match="request limit"):
+        basic_display_api.get_user_profile(token)
+
+    mock_api.fail_next(503, endpoint="me/media")
+    assert basic_display_api.get_user_profile(token)["id"] == mock_api.user_id
+    with pytest.raises(Exception, match="unexpected error"):
+        basic_display_api.get_user_media(token)
+
+    assert mock_api.statuses == {429: 1, 200: 1, 503: 1}
+
+
+def test_injected_fault_rate(mock_api, token):
+    mock_api.error_rate = 0.5
+    failures = 0
+    for _ in range(20):
+        try:
+            basic_display_api.get_user_profile(token)
+        except Exception:
+            failures += 1
+    assert 0 < failures < 20
+    assert mock_api.statuses[500] + mock_api.statuses[503] == failures
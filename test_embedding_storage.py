@@ -0,0 +1,46 @@
+import math
+import pytest
+import embedding_storage
+
+
+@pytest.mark.parametrize(
+    "mode, columns",
+    [
+        ("full", {"embeddings"}),
+        ("halfvec", {"embeddings_half"}),
+        ("binary", {"embeddings_binary", "embeddings_half"}),
+        ("reduced", {"embeddings_reduced"}),
+    ],
+)
+def test_encode(mode, columns):
+    values = embedding_storage.encode([0.5, -0.25] * 768, mode)
+    assert set(values) == set(embedding_storage.EMBEDDING_COLUMNS)
+    # Only the columns of the mode are set, the others are cleared
+    assert {column for column, value in values.items() if value is not None} == columns
+    assert set(embedding_storage.STORAGE_MODE_COLUMNS[mode]) == columns
+    assert embedding_storage.encode(None, mode) == dict.fromkeys(
+        embedding_storage.EMBEDDING_COLUMNS
+    )
+
+
+def test_binary_and_reduced_encodings():
+    embedding = [0.5, -0.25, 0.0, 2.0] * 384
+    values = embedding_storage.encode(embedding, "binary")
+    assert values["embeddings_binary"] == "1001" * 384
+    assert values["embeddings_half"] == embedding
+
+    reduced = embedding_storage.encode(embedding, "reduced")["embeddings_reduced"]
+    assert len(reduced) == embedding_storage.REDUCED_DIMENSIONS
+    assert math.isclose(math.sqrt(sum(value * value for value in reduced)), 1.0)
+    assert reduced[3] / reduced[0] == pytest.approx(4.0)
+
+    with pytest.raises(ValueError):
+        embedding_storage.encode(embedding, "int8")
+
+
+def test_index_statement():
+    assert embedding_storage.index_statement("binary") == (
+        "CREATE INDEX IF NOT EXISTS ix_instagram_media_embeddings_binary_hnsw "
+        "ON instagram_media USING hnsw (embeddings_binary bit_hamming_ops)"
+    )
+    assert "halfvec_cosine_ops" in embedding_storage.index_statement("halfvec")
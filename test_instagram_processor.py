@@ -0,0 +1,195 @@
+from types import SimpleNamespace
+import pytest
+import basic_display_api
+import instagram_processor
+import llm_providers
+import usage
+import utils
+from mock_graph_api import MockGraphAPI
+from models.user import User
+from settings import override_settings
+
+
+class FakeSession:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def commit(self):
+        pass
+
+
+class FakeMediaCrud:
+    """Keeps the media records of the user in memory, keyed by media_id."""
+
+    def __init__(self):
+        self.media = {}
+
+    def get_n_most_recent_media_by_user_id_media_type(self, db, user_id, n=10):
+        return list(self.media.values())[:n]
+
+    def get_media_ids_by_user_id_description_hash(self, db, user_id, description_hash):
+        return [
+            media.media_id
+            for media in self.media.values()
+            if media.description_hash == description_hash
+            and media.parent_media_id is None
+        ]
+
+    def get_description_hashes_by_user_id_media_ids(
+        self, db, user_id, media_ids, published_since=None
+    ):
+        return {
+            media_id: self.media[media_id].description_hash
+            for media_id in media_ids
+            if media_id in self.media
+        }
+
+    def get_described_perceptual_hashes_by_user_id(
+        self, db, user_id, prompt_version, description_hashes
+    ):
+        return []
+
+    def bulk_upsert_media(self, db, data, embedding_storage="full"):
+        for media in data:
+            self.media[media.media_id] = media
+        return len(data)
+
+
+@pytest.fixture
+def media_crud(monkeypatch):
+    media_crud = FakeMediaCrud()
+    monkeypatch.setattr(instagram_processor, "instagram_media_crud", media_crud)
+    monkeypatch.setattr(instagram_processor, "SessionLocal", FakeSession)
+    monkeypatch.setattr(
+        instagram_processor,
+        "get_instagram_access_token",
+        lambda user_id: SimpleNamespace(auth_info={"access_token": "test_token"}),
+    )
+    monkeypatch.setattr(utils, "llm_provider", llm_providers.FakeLLMProvider())
+    return media_crud
+
+
+@pytest.fixture
+def mock_api():
+    with MockGraphAPI(media=30, carousel_ratio=0.2, video_ratio=0) as api:
+        yield api
+
+
+def helper_sync(processor, max_images=None):
+    # The stages of run() that store the media, within a tracked run
+    tracker = usage.UsageTracker(
+        "test_user_id", usage.UsageBudget(max_images=max_images)
+    )
+    media_data = processor.fetch_data()
+    with usage.track(tracker):
+        processor.save_data_to_db(processor.extract_and_preprocess(media_data))
+    return tracker
+
+
+def test_deferred_media_are_described_by_the_next_sync(media_crud, mock_api):
+    with override_settings(
+        instagram_graph_api_url=mock_api.url,
+        instagram_api_url=mock_api.url,
+        media_page_size=5,
+        media_max_items=None,
+    ):
+        processor = instagram_processor.InstagramProcesser(
+            User(user_id="test_user_id", email="test@example.com", name="test")
+        )
+        budgeted = helper_sync(processor, max_images=5)
+        media_ids = [media["id"] for media in mock_api.media]
+        # Over budget, the media is stored undescribed as deferred
+        assert budgeted.deferred_media_ids
+        assert set(media_ids) <= set(media_crud.media)
+        for media_id in budgeted.deferred_media_ids:
+            assert media_crud.media[media_id].media_description is None
+            assert media_crud.media[media_id].description_hash == (
+                instagram_processor.DEFERRED_DESCRIPTION_HASH
+            )
+
+        # The incremental sync lists the account until every deferred media is found, wherever it is
+        incremental = helper_sync(processor)
+        assert not incremental.deferred_media_ids
+        for media_id in media_ids:
+            assert media_crud.media[media_id].description_hash != (
+                instagram_processor.DEFERRED_DESCRIPTION_HASH
+            )
+            assert media_crud.media[media_id].media_description
+
+        # Nothing is left to describe, the listing stops at the first page
+        listed_pages = mock_api.calls["me/media"]
+        assert processor.fetch_data() == []
+        assert mock_api.calls["me/media"] == listed_pages + 1
+
+        # Media deferred on the oldest page are found past the newest pages, all stored and unchanged
+        for media_id in media_ids[-2:]:
+            media_crud.media[media_id].media_description = None
+            media_crud.media[media_id].description_hash = (
+                instagram_processor.DEFERRED_DESCRIPTION_HASH
+            )
+        assert [media.id for media in processor.fetch_data()] == media_ids[-2:]
+
+
+def test_duplicate_of_a_deferred_image_is_deferred(media_crud, mock_api, monkeypatch):
+    # Each model call takes long enough for the budget to be checked by both workers before it is reached
+    monkeypatch.setattr(
+        utils, "llm_provider", llm_providers.FakeLLMProvider(latency=0.2)
+    )
+    with override_settings(
+        instagram_graph_api_url=mock_api.url, instagram_api_url=mock_api.url
+    ):
+        first, duplicated, last = [
+            media
+            for media in basic_display_api.get_user_media("test_token")["data"]
+            if media["media_type"] == "IMAGE"
+        ][:3]
+        # The same image under another url, with the same caption
+        duplicate = {
+            **duplicated,
+            "id": "duplicate_id",
+            "media_url": f"{duplicated['media_url']}&copy=1",
+        }
+        # Two workers: the first describes an image, which uses the budget, then defers the duplicated image,
+        # while the second takes the duplicate, whose description is copied once every worker is done
+        tracker = usage.UsageTracker("test_user_id", usage.UsageBudget(max_images=1))
+        with usage.track(tracker):
+            media_objs = instagram_processor.construct_instagram_media(
+                "test_user_id",
+                instagram_processor._parse_media_list(
+                    [first, duplicated, duplicate, last]
+                ),
+                num_workers=2,
+            )
+
+    media = {media.media_id: media for media in media_objs}
+    assert media[first["id"]].media_description
+    for media_id in (duplicated["id"], "duplicate_id"):
+        assert media[media_id].media_description is None
+        assert media[media_id].description_hash == (
+            instagram_processor.DEFERRED_DESCRIPTION_HASH
+        )
+    assert set(tracker.deferred_media_ids) == {duplicated["id"], "duplicate_id"}
+
+
+def test_run_rolls_up_usage_without_media_to_store(media_crud, mock_api, monkeypatch):
+    def extract_and_preprocess(media_data):
+        # Spends tokens, then filters every media out
+        utils.call_OAI("gpt-4o", [{"role": "user", "content": "Describe the media."}])
+        return []
+
+    usage.forget_user("test_user_id")
+    with override_settings(
+        instagram_graph_api_url=mock_api.url, instagram_api_url=mock_api.url
+    ):
+        processor = instagram_processor.InstagramProcesser(
+            User(user_id="test_user_id", email="test@example.com", name="test")
+        )
+        monkeypatch.setattr(processor, "extract_and_preprocess", extract_and_preprocess)
+        assert processor.run() is None
+    try:
+        assert usage.usage_by_user()["test_user_id"]["requests"] == 1
+    finally:
+        usage.forget_user("test_user_id")
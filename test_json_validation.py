@@ -0,0 +1,40 @@
+import pytest
+import json_validation
+from mock_graph_api import synthetic_media
+
+
+@pytest.mark.parametrize("mode", ["full", "sample", "skip"])
+def test_parse_json_types_leaves_out_invalid_items(mode, caplog):
+    valid, invalid = synthetic_media(2)
+    del invalid["media_url"]
+
+    media = json_validation.parse_json_types(
+        {"data": [valid, invalid]}, json_validation.InstagramMediaList, mode=mode
+    )
+
+    assert [item.id for item in media.data] == [valid["id"]]
+    assert invalid["id"] in caplog.text
+
+
+@pytest.mark.parametrize("mode", ["full", "sample", "skip"])
+def test_parse_json_types(mode):
+    data = synthetic_media(30, carousel_ratio=0.5)
+
+    media = json_validation.parse_json_types(
+        {"data": data}, json_validation.InstagramMediaList, mode=mode
+    )
+
+    assert [item.id for item in media.data] == [item["id"] for item in data]
+    albums = [item for item in media.data if item.children]
+    assert albums
+    assert all(
+        isinstance(child, json_validation.InstagramMedia)
+        for album in albums
+        for child in album.children.data
+    )
+    assert (
+        json_validation.parse_json_types(
+            {"error": "not a list"}, json_validation.InstagramMediaList, mode=mode
+        )
+        is None
+    )
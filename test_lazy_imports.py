@@ -0,0 +1,16 @@
+import sys
+from lazy_imports import lazy_import
+
+
+def test_lazy_import(monkeypatch):
+    monkeypatch.delitem(sys.modules, "colorsys", raising=False)
+    rgb_to_hsv = lazy_import("colorsys", "rgb_to_hsv")
+    colorsys = lazy_import("colorsys")
+    assert "colorsys" not in sys.modules
+    assert "not imported" in repr(rgb_to_hsv)
+
+    # The first call imports the module, and the attribute stands for it afterwards
+    assert rgb_to_hsv(1.0, 0.0, 0.0) == (0.0, 1.0, 1.0)
+    assert "colorsys" in sys.modules
+    assert "(imported)" in repr(rgb_to_hsv)
+    assert colorsys.hsv_to_rgb(0.0, 1.0, 1.0) == (1.0, 0.0, 0.0)
@@ -0,0 +1,93 @@
+import asyncio
+import pytest
+import llm_providers
+
+TEST_MESSAGES = [
+    {"role": "system", "content": "Describe the image."},
+    {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": "Image Caption: A day at the beach"},
+            {
+                "type": "image_url",
+                "image_url": {"url": "https://example.com/a.jpg", "detail": "low"},
+            },
+        ],
+    },
+]
+
+
+def test_fake_provider_is_deterministic():
+    provider = llm_providers.FakeLLMProvider(latency=0.01, latency_jitter=0.005)
+    response = provider.complete("gpt-4o", TEST_MESSAGES)
+    # The same messages get the same content, usage and latency, from another provider instance too
+    again = llm_providers.FakeLLMProvider(latency=0.01, latency_jitter=0.005).complete(
+        "gpt-4o", TEST_MESSAGES
+    )
+    assert again == response
+    assert asyncio.run(provider.acomplete("gpt-4o", TEST_MESSAGES)) == response
+    assert "".join(provider.stream("gpt-4o", TEST_MESSAGES)).strip() == (
+        response.content
+    )
+
+    assert response.model == "gpt-4o"
+    assert response.usage.completion_tokens == 120
+    assert response.usage.prompt_tokens == (
+        len("Describe the image.") // 4
+        + len("Image Caption: A day at the beach") // 4
+        + llm_providers.FakeLLMProvider.IMAGE_TOKENS["low"]
+    )
+    assert 0.005 <= response.latency_seconds <= 0.015
+
+    # Other messages get another response
+    other = provider.complete("gpt-4o", TEST_MESSAGES[:1])
+    assert other.content != response.content
+
+    assert provider.reset_usage().requests == 4
+    assert provider.usage == llm_providers.LLMUsage()
+
+
+def test_fake_provider_timeout():
+    provider = llm_providers.FakeLLMProvider(timeout=0.01, latency=1)
+    with pytest.raises(TimeoutError):
+        provider.complete("gpt-4o", TEST_MESSAGES)
+
+
+def test_record_replay_round_trip(tmp_path):
+    cassette_path = str(tmp_path / "cassette.jsonl")
+    fake = llm_providers.FakeLLMProvider()
+    recorder = llm_providers.RecordReplayProvider(cassette_path, fake, mode="record")
+    recorded = recorder.complete("gpt-4o", TEST_MESSAGES)
+    assert fake.usage.requests == 1
+
+    replayer = llm_providers.RecordReplayProvider(cassette_path, mode="replay")
+    assert replayer.complete("gpt-4o", TEST_MESSAGES) == recorded
+    assert asyncio.run(replayer.acomplete("gpt-4o", TEST_MESSAGES)) == recorded
+    assert replayer.usage.requests == 2
+
+    # A call that was not recorded
+    with pytest.raises(KeyError):
+        replayer.complete("gpt-4o-mini", TEST_MESSAGES)
+
+    # In auto mode the miss is recorded, then replayed without calling the provider again
+    auto = llm_providers.RecordReplayProvider(cassette_path, fake, mode="auto")
+    missed = auto.complete("gpt-4o-mini", TEST_MESSAGES)
+    assert fake.usage.requests == 2
+    assert auto.complete("gpt-4o-mini", TEST_MESSAGES) == missed
+    assert fake.usage.requests == 2
+    assert (
+        llm_providers.RecordReplayProvider(cassette_path).complete(
+            "gpt-4o-mini", TEST_MESSAGES
+        )
+        == missed
+    )
+
+
+def test_get_provider(tmp_path):
+    assert isinstance(llm_providers.get_provider("fake"), llm_providers.FakeLLMProvider)
+    with pytest.raises(ValueError, match="required"):
+        llm_providers.RecordReplayProvider(
+            str(tmp_path / "cassette.jsonl"), mode="auto"
+        )
+    with pytest.raises(ValueError, match="Unknown LLM provider"):
+        llm_providers.get_provider("other")
@@ -0,0 +1,78 @@
+from datetime import datetime
+import re
+import pytest
+import instagram_processor
+import media_storage
+
+
+def test_partition_statements_user_hash():
+    statements = media_storage.partition_statements("user_hash", partitions=4)
+    assert (
+        statements[0]
+        == "ALTER TABLE instagram_media RENAME TO instagram_media_unpartitioned"
+    )
+    assert (
+        "CREATE TABLE instagram_media (LIKE instagram_media_unpartitioned INCLUDING DEFAULTS) PARTITION BY HASH (user_id)"
+        in statements
+    )
+    assert (
+        "ALTER TABLE instagram_media ADD CONSTRAINT media_user_uc UNIQUE (media_id, user_id)"
+        in statements
+    )
+    assert [statement for statement in statements if "PARTITION OF" in statement] == [
+        f"CREATE TABLE instagram_media_p{remainder:02d} PARTITION OF instagram_media FOR VALUES WITH (MODULUS 4, REMAINDER {remainder})"
+        for remainder in range(4)
+    ]
+    # The rows are copied once every partition exists
+    assert statements[-1] == (
+        "INSERT INTO instagram_media SELECT * FROM instagram_media_unpartitioned"
+    )
+
+
+def test_partition_statements_publish_month():
+    statements = media_storage.partition_statements(
+        "publish_month",
+        first_month=datetime(2023, 11, 20),
+        last_month=datetime(2024, 2, 3),
+    )
+    # The upsert conflict target holds the partition key
+    assert (
+        "ALTER TABLE instagram_media ADD CONSTRAINT media_user_uc UNIQUE (media_id, user_id, publish_timestamp)"
+        in statements
+    )
+    assert [
+        re.search(r"TABLE (?:IF NOT EXISTS )?(\w+) PARTITION OF", statement).group(1)
+        for statement in statements
+        if "PARTITION OF" in statement
+    ] == [
+        "instagram_media_y2023m11",
+        "instagram_media_y2023m12",
+        "instagram_media_y2024m01",
+        "instagram_media_y2024m02",
+        "instagram_media_default",
+    ]
+    assert media_storage.month_partition_statement(datetime(2023, 12, 31, 23)) == (
+        "CREATE TABLE IF NOT EXISTS instagram_media_y2023m12 PARTITION OF instagram_media "
+        "FOR VALUES FROM ('2023-12-01') TO ('2024-01-01')"
+    )
+
+    with pytest.raises(ValueError):
+        media_storage.partition_statements("none")
+
+
+def test_apply_retention_off():
+    assert media_storage.apply_retention("off") == 0
+    with pytest.raises(ValueError):
+        media_storage.apply_retention("archive")
+
+
+def test_oldest_timestamp_is_naive_utc():
+    # Compared to publish_timestamp, a naive UTC column, to prune the older partitions
+    assert instagram_processor._oldest_timestamp(
+        [
+            {"timestamp": "2024-06-11T20:59:45+0000"},
+            {"timestamp": "2024-06-01T01:30:00+0200"},
+        ]
+    ) == datetime(2024, 5, 31, 23, 30)
+    assert instagram_processor._oldest_timestamp([{"timestamp": None}]) is None
+    assert instagram_processor._oldest_timestamp([]) is None
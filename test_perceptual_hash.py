@@ -0,0 +1,116 @@
+import random
+from PIL import Image, ImageDraw
+import perceptual_hash
+
+
+def helper_image(size=(256, 192), color=(200, 80, 40)):
+    image = Image.new("RGB", size, (20, 40, 60))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle(
+        (size[0] // 4, size[1] // 4, size[0] * 3 // 4, size[1] * 3 // 4), fill=color
+    )
+    draw.ellipse((0, 0, size[0] // 3, size[1] // 3), fill=(250, 250, 250))
+    return image
+
+
+def test_dhash():
+    image = helper_image()
+    image_hash = perceptual_hash.dhash(image)
+    assert len(image_hash) == 16
+    int(image_hash, 16)
+
+    # Resizing, re-encoding to grayscale and small color changes keep the hash close
+    assert (
+        perceptual_hash.hamming_distance(
+            image_hash, perceptual_hash.dhash(image.resize((128, 96)))
+        )
+        <= 4
+    )
+    assert (
+        perceptual_hash.hamming_distance(
+            image_hash, perceptual_hash.dhash(image.convert("L"))
+        )
+        <= 4
+    )
+    assert (
+        perceptual_hash.hamming_distance(
+            image_hash, perceptual_hash.dhash(helper_image(color=(205, 85, 40)))
+        )
+        <= 4
+    )
+    # A different image is far away
+    assert (
+        perceptual_hash.hamming_distance(
+            image_hash,
+            perceptual_hash.dhash(image.transpose(Image.Transpose.ROTATE_180)),
+        )
+        > 4
+    )
+
+
+def test_hamming_distance():
+    assert perceptual_hash.hamming_distance("0000000000000000", "0000000000000000") == 0
+    assert perceptual_hash.hamming_distance("0000000000000000", "0000000000000003") == 2
+    assert (
+        perceptual_hash.hamming_distance("ffffffffffffffff", "0000000000000000") == 64
+    )
+
+
+def test_perceptual_hash_index():
+    index = perceptual_hash.PerceptualHashIndex(max_distance=4)
+    index.add("0f0f0f0f0f0f0f0f", "v1:caption_a", "A sunset")
+    # Not indexed without a description
+    index.add("00ff00ff00ff00ff", "v1:caption_a", None)
+    assert len(index) == 1
+
+    assert index.lookup("0f0f0f0f0f0f0f0f", "v1:caption_a") == "A sunset"
+    # Within max_distance
+    assert index.lookup("0f0f0f0f0f0f0f00", "v1:caption_a") == "A sunset"
+    # Beyond max_distance
+    assert index.lookup("0f0f0f0f0f0f0000", "v1:caption_a") is None
+    # Described in another context (prompt version or caption)
+    assert index.lookup("0f0f0f0f0f0f0f0f", "v1:caption_b") is None
+    assert index.lookup("0f0f0f0f0f0f0f0f", "v2:caption_a") is None
+    assert index.lookup(None, "v1:caption_a") is None
+
+    # The closest indexed hash wins
+    index.add("0f0f0f0f0f0f0f07", "v1:caption_a", "A closer sunset")
+    assert index.lookup("0f0f0f0f0f0f0f03", "v1:caption_a") == "A closer sunset"
+
+    index.add("0f0f0f0f0f0f0f0f", "v1:caption_b", "A captioned sunset")
+    assert index.discard(["0f0f0f0f0f0f0f0f"]) == 2
+    assert len(index) == 1
+    assert index.lookup("0f0f0f0f0f0f0f0f", "v1:caption_b") is None
+    assert index.lookup("0f0f0f0f0f0f0f0f", "v1:caption_a") == "A closer sunset"
+
+    index.clear()
+    assert len(index) == 0
+    assert index.lookup("0f0f0f0f0f0f0f07", "v1:caption_a") is None
+
+
+def test_perceptual_hash_index_matches_linear_scan():
+    # The band buckets find every indexed hash within max_distance, like comparing against each of them
+    rng = random.Random(0)
+    index = perceptual_hash.PerceptualHashIndex(max_distance=6)
+    indexed = [f"{rng.getrandbits(64):016x}" for _ in range(200)]
+    for position, image_hash in enumerate(indexed):
+        index.add(image_hash, "v1", str(position))
+
+    for image_hash in indexed[:50]:
+        value = int(image_hash, 16)
+        for _ in range(5):
+            for bit in rng.sample(range(64), rng.randint(0, 8)):
+                value ^= 1 << bit
+            query = f"{value:016x}"
+            distances = sorted(
+                perceptual_hash.hamming_distance(query, candidate)
+                for candidate in indexed
+            )
+            found = index.lookup(query, "v1")
+            if distances[0] <= 6:
+                assert (
+                    perceptual_hash.hamming_distance(query, indexed[int(found)])
+                    == distances[0]
+                )
+            else:
+                assert found is None
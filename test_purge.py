@@ -0,0 +1,245 @@
+import base64
+import hashlib
+import hmac
+import json
+from datetime import datetime
+from types import SimpleNamespace
+import pytest
+import instagram_processor
+import purge
+import usage
+
+TEST_APP_SECRET = "test_app_secret"
+
+
+def helper_signed_request(payload: dict, secret: str = TEST_APP_SECRET) -> str:
+    encoded_payload = (
+        base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+    )
+    signature = hmac.new(
+        secret.encode(), encoded_payload.encode(), hashlib.sha256
+    ).digest()
+    encoded_signature = base64.urlsafe_b64encode(signature).decode().rstrip("=")
+    return f"{encoded_signature}.{encoded_payload}"
+
+
+def test_parse_signed_request():
+    payload = {
+        "algorithm": "HMAC-SHA256",
+        "issued_at": 1718139585,
+        "user_id": "17841400000000000",
+    }
+    assert (
+        purge.parse_signed_request(helper_signed_request(payload), TEST_APP_SECRET)
+        == payload
+    )
+
+
+def test_parse_signed_request_rejects_invalid_requests():
+    payload = {"algorithm": "HMAC-SHA256", "user_id": "17841400000000000"}
+    for signed_request in (
+        helper_signed_request(payload, "other_secret"),
+        helper_signed_request({**payload, "algorithm": "none"}),
+        helper_signed_request(payload)[:-2],
+        "not a signed request",
+        "",
+        None,
+    ):
+        assert purge.parse_signed_request(signed_request, TEST_APP_SECRET) is None
+
+
+class FakePurgeJobCrud:
+    """Keeps the purge jobs in memory, with the history of their status."""
+
+    def __init__(self):
+        self.jobs = {}
+        self.statuses = {}
+
+    def create_job(self, db, confirmation_code, user_id, reason, status="pending"):
+        job = SimpleNamespace(
+            confirmation_code=confirmation_code,
+            user_id=user_id,
+            reason=reason,
+            status=status,
+            deleted_media=0,
+            error=None,
+            created_at=datetime(2024, 6, 12),
+            updated_at=datetime(2024, 6, 12),
+        )
+        self.jobs[confirmation_code] = job
+        self.statuses[confirmation_code] = [status]
+        return job
+
+    def get_job_by_confirmation_code(self, db, confirmation_code):
+        return self.jobs.get(confirmation_code)
+
+    def get_unfinished_jobs(self, db):
+        return [
+            job for job in self.jobs.values() if job.status in ("pending", "running")
+        ]
+
+    def update_job(self, db, confirmation_code, **fields):
+        vars(self.jobs[confirmation_code]).update(fields)
+        if "status" in fields:
+            self.statuses[confirmation_code].append(fields["status"])
+        return 1
+
+
+class FakeSession:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def commit(self):
+        pass
+
+
+@pytest.fixture
+def purge_jobs(monkeypatch):
+    purge_job_crud = FakePurgeJobCrud()
+    monkeypatch.setattr(purge, "instagram_purge_job_crud", purge_job_crud)
+    monkeypatch.setattr(purge, "SessionLocal", FakeSession)
+    return purge_job_crud
+
+
+def test_purge_queue_status_transitions(purge_jobs, monkeypatch):
+    purged = []
+
+    def purge_user_data(user_id, confirmation_code, **kwargs):
+        purged.append(user_id)
+        if user_id == "failing_user_id":
+            raise RuntimeError("db down")
+        return 3
+
+    monkeypatch.setattr(purge, "purge_user_data", purge_user_data)
+    queue = purge.PurgeQueue()
+    done_code = queue.enqueue("test_user_id", "delete")
+    failed_code = queue.enqueue("failing_user_id", "deauth")
+    # An Instagram user with no data here
+    nothing_code = queue.enqueue(None, "deauth")
+    queue.close()
+
+    assert purged == ["test_user_id", "failing_user_id"]
+    assert purge_jobs.statuses[done_code] == ["pending", "running", "done"]
+    assert purge_jobs.statuses[failed_code] == ["pending", "running", "failed"]
+    assert purge_jobs.statuses[nothing_code] == ["done"]
+    assert queue.status(done_code) == {
+        "confirmation_code": done_code,
+        "reason": "delete",
+        "status": "done",
+        "deleted_media": 3,
+        "created_at": "2024-06-12T00:00:00",
+        "updated_at": "2024-06-12T00:00:00",
+    }
+    assert purge_jobs.jobs[failed_code].error == "db down"
+    assert queue.status("unknown") is None
+
+
+def test_purge_queue_resume_keeps_deleted_media(purge_jobs, monkeypatch):
+    resumed = []
+
+    def purge_user_data(user_id, confirmation_code, deleted_media=0, **kwargs):
+        resumed.append((user_id, deleted_media))
+        return deleted_media + 2
+
+    monkeypatch.setattr(purge, "purge_user_data", purge_user_data)
+    # Interrupted by a restart after deleting 1000 media rows
+    purge_jobs.create_job(None, "interrupted", "test_user_id", "delete", "running")
+    purge_jobs.update_job(None, "interrupted", deleted_media=1000)
+    purge_jobs.create_job(None, "pending", "another_user_id", "deauth")
+    purge_jobs.create_job(None, "finished", "done_user_id", "delete", "done")
+
+    queue = purge.PurgeQueue()
+    assert queue.resume() == 2
+    queue.close()
+
+    assert resumed == [("test_user_id", 1000), ("another_user_id", 0)]
+    assert purge_jobs.jobs["interrupted"].status == "done"
+    assert purge_jobs.jobs["interrupted"].deleted_media == 1002
+    assert purge_jobs.jobs["pending"].deleted_media == 2
+
+
+class FakeUserRowsCrud:
+    """Keeps the rows of a table in memory, by user."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.batches = []
+
+    def delete_batch(self, db, user_id, batch_size):
+        user_rows = [row for row in self.rows if row["user_id"] == user_id]
+        for row in user_rows[:batch_size]:
+            self.rows.remove(row)
+        self.batches.append(min(len(user_rows), batch_size))
+        return self.batches[-1]
+
+    def delete_by_user_id(self, db, user_id):
+        self.rows[:] = [row for row in self.rows if row["user_id"] != user_id]
+
+    def get_perceptual_hashes_by_user_id(self, db, user_id):
+        return [
+            row["perceptual_hash"]
+            for row in self.rows
+            if row["user_id"] == user_id and row["perceptual_hash"]
+        ]
+
+    delete_media_batch_by_user_id = delete_batch
+    delete_archive_batch_by_user_id = delete_batch
+    delete_summaries_by_user_id = delete_by_user_id
+    delete_state_by_user_id = delete_by_user_id
+
+
+def test_purge_user_data(purge_jobs, monkeypatch):
+    media_crud = FakeUserRowsCrud(
+        [
+            {"user_id": "test_user_id", "perceptual_hash": f"0f0f0f0f0f0f0f0{i}"}
+            for i in range(5)
+        ]
+        + [{"user_id": "other_user_id", "perceptual_hash": "ffffffffffffffff"}]
+    )
+    archive_crud = FakeUserRowsCrud(
+        [{"user_id": "test_user_id"}] * 2 + [{"user_id": "other_user_id"}]
+    )
+    summary_crud = FakeUserRowsCrud(
+        [{"user_id": "test_user_id"}, {"user_id": "other_user_id"}]
+    )
+    state_crud = FakeUserRowsCrud([{"user_id": "test_user_id"}])
+    monkeypatch.setattr(purge, "instagram_media_crud", media_crud)
+    monkeypatch.setattr(purge, "instagram_media_archive_crud", archive_crud)
+    monkeypatch.setattr(purge, "instagram_window_summary_crud", summary_crud)
+    monkeypatch.setattr(purge, "instagram_enrichment_state_crud", state_crud)
+    forgotten = []
+    monkeypatch.setattr(usage, "forget_user", forgotten.append)
+
+    index = instagram_processor._global_perceptual_hash_index()
+    index.add("0f0f0f0f0f0f0f00", "v1:caption", "A sunset")
+    index.add("ffffffffffffffff", "v1:caption", "Another user's sunset")
+    # Interrupted by a restart after deleting 1000 media rows
+    purge_jobs.create_job(None, "interrupted", "test_user_id", "delete", "running")
+    try:
+        deleted_media = purge.purge_user_data(
+            "test_user_id",
+            confirmation_code="interrupted",
+            batch_size=2,
+            deleted_media=1000,
+        )
+        assert index.lookup("0f0f0f0f0f0f0f00", "v1:caption") is None
+        assert index.lookup("ffffffffffffffff", "v1:caption") == "Another user's sunset"
+    finally:
+        index.clear()
+
+    # Deleted until a batch is smaller than batch_size
+    assert media_crud.batches == [2, 2, 1]
+    assert archive_crud.batches == [2, 0]
+    assert deleted_media == 1005
+    assert purge_jobs.jobs["interrupted"].deleted_media == 1005
+    # The rows of other users are kept
+    assert media_crud.rows == [
+        {"user_id": "other_user_id", "perceptual_hash": "ffffffffffffffff"}
+    ]
+    assert archive_crud.rows == [{"user_id": "other_user_id"}]
+    assert summary_crud.rows == [{"user_id": "other_user_id"}]
+    assert state_crud.rows == []
+    assert forgotten == ["test_user_id"]
@@ -0,0 +1,153 @@
+from datetime import datetime, timedelta
+import scheduler
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+class FakeClock:
+    def __init__(self, now: float = 1_700_000_000.0) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def helper_scheduler(clock, newest_posts, synced, **kwargs):
+    return scheduler.PollingScheduler(
+        probe=lambda user_id: newest_posts.get(user_id),
+        sync=synced.append,
+        min_interval=HOUR,
+        max_interval=7 * DAY,
+        default_interval=DAY,
+        check_ratio=0.5,
+        jitter=0,
+        max_workers=0,
+        clock=clock,
+        **kwargs,
+    )
+
+
+def test_estimate_interval():
+    first = datetime(2024, 6, 1)
+    assert scheduler.estimate_interval(5, first, first + timedelta(days=8)) == 2 * DAY
+    assert scheduler.estimate_interval(1, first, first, default_interval=DAY) == DAY
+    assert scheduler.estimate_interval(0, None, None, default_interval=DAY) == DAY
+
+
+def test_syncs_only_users_with_a_new_post():
+    clock = FakeClock()
+    newest_posts = {"active": clock.now - HOUR, "quiet": clock.now - 3 * DAY}
+    synced = []
+    polling = helper_scheduler(clock, newest_posts, synced)
+    polling.add_user("active", interval=DAY, last_post_at=clock.now - HOUR)
+    polling.add_user("quiet", interval=DAY, last_post_at=clock.now - 3 * DAY)
+
+    # The active user is first checked half a posting interval after their last post
+    assert polling.schedules["active"].next_check_at == clock.now + 11 * HOUR
+
+    clock.now += 12 * HOUR
+    newest_posts["active"] = clock.now - 10
+    assert polling.run_due() == ["active"]
+    assert polling.stats["syncs"] == 1
+
+    # Nothing new: not synced again
+    clock.now += DAY
+    assert polling.run_due() == []
+    assert synced == ["active"]
+
+
+def test_backs_off_dormant_users():
+    clock = FakeClock()
+    synced = []
+    polling = helper_scheduler(clock, {"dormant": clock.now - 90 * DAY}, synced)
+    schedule = polling.add_user(
+        "dormant", interval=DAY, last_post_at=clock.now - 90 * DAY
+    )
+    # Dormant for 90 posting intervals when loaded
+    assert schedule.empty_checks == 6
+
+    delays = []
+    for _ in range(4):
+        clock.now = schedule.next_check_at
+        polling.run_due()
+        delays.append(schedule.next_check_at - clock.now)
+    assert delays == [7 * DAY] * 4
+    assert synced == []
+
+    # A notification resets the backoff
+    polling.notify("dormant")
+    assert schedule.next_check_at == clock.now
+    assert schedule.empty_checks == 0
+
+
+def test_learns_the_posting_interval():
+    clock = FakeClock()
+    newest_posts = {"user": clock.now}
+    synced = []
+    polling = helper_scheduler(clock, newest_posts, synced)
+    schedule = polling.add_user("user", interval=DAY, last_post_at=clock.now)
+
+    for _ in range(10):
+        clock.now += 4 * HOUR
+        newest_posts["user"] = clock.now
+        polling.run_due(now=max(clock.now, schedule.next_check_at))
+    assert schedule.interval < 6 * HOUR
+    assert len(synced) == 10
+
+
+def test_stays_within_the_api_budget():
+    clock = FakeClock()
+    synced = []
+    polling = helper_scheduler(
+        clock,
+        {},
+        synced,
+        budget=scheduler.ApiBudget(calls_per_hour=60, burst=10, now=clock.now),
+    )
+    for i in range(30):
+        polling.add_user(f"user_{i}")
+
+    polling.run_due()
+    assert polling.stats["checks"] == 10
+    assert polling.stats["deferred"] == 20
+
+    # A minute later, one more call
+    clock.now += 60
+    polling.run_due()
+    assert polling.stats["checks"] == 11
+
+
+class FakeMediaCrud:
+    def __init__(self, cadences):
+        self.cadences = cadences
+        self.excluded = []
+
+    def get_posting_cadences(self, db, recent=20, exclude_user_ids=None):
+        self.excluded.append(sorted(exclude_user_ids or []))
+        return [
+            cadence
+            for cadence in self.cadences
+            if cadence[0] not in (exclude_user_ids or [])
+        ]
+
+
+def test_load_schedules_unscheduled_users(monkeypatch):
+    clock = FakeClock()
+    last_published = datetime(2023, 11, 14, 22, 13, 20)  # clock.now, naive UTC
+    media_crud = FakeMediaCrud(
+        [
+            ("scheduled", 3, last_published - timedelta(days=2), last_published),
+            ("new", 3, last_published - timedelta(hours=8), last_published),
+        ]
+    )
+    monkeypatch.setattr(scheduler, "instagram_media_crud", media_crud)
+    polling = helper_scheduler(clock, {}, [])
+    polling.add_user("scheduled")
+
+    assert polling.load(db=None) == 1
+    assert media_crud.excluded == [["scheduled"]]
+    schedule = polling.schedules["new"]
+    assert schedule.interval == 4 * HOUR
+    # The naive publish time is read as UTC, whatever the local timezone
+    assert schedule.last_post_at == clock.now
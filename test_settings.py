@@ -0,0 +1,81 @@
+import os
+import subprocess
+import sys
+import pytest
+import settings
+
+# Cumulative import time of instagram_processor, in microseconds, well above the ~80ms it takes with deferred imports
+IMPORT_TIME_BUDGET_US = 250_000
+# Imported on first use only, never by importing the pipeline
+DEFERRED_MODULES = (
+    "sqlalchemy",
+    "pgvector",
+    "pydantic",
+    "requests",
+    "dotenv",
+    "numpy",
+    "PIL",
+    "openai",
+)
+
+
+def test_from_env():
+    loaded = settings.Settings.from_env(
+        {
+            "MEDIA_PAGE_SIZE": "50",
+            "LLM_TIMEOUT": "2.5",
+            "DEBUG": "true",
+            "ALBUM_IMAGE_DETAIL": "",
+            "MODEL": "gpt-4o",
+            "UNRELATED": "x",
+        }
+    )
+    assert loaded.media_page_size == 50
+    assert loaded.llm_timeout == 2.5
+    assert loaded.debug is True
+    assert loaded.album_image_detail is None
+    assert loaded.model == "gpt-4o"
+    # The variables that are not set keep their defaults
+    assert loaded.media_max_items == settings.Settings().media_max_items
+    assert settings.Settings.from_env({"DEBUG": "0"}).debug is False
+
+    with pytest.raises(ValueError, match="MEDIA_PAGE_SIZE"):
+        settings.Settings.from_env({"MEDIA_PAGE_SIZE": "many"})
+
+
+def test_override_settings(monkeypatch):
+    monkeypatch.setattr(settings, "_settings", settings.Settings())
+    with settings.override_settings(media_page_size=5) as overridden:
+        assert overridden.media_page_size == 5
+        assert settings.get_settings() is overridden
+    assert settings.get_settings().media_page_size == 20
+
+    settings.reset_settings()
+    assert settings._settings is None
+
+
+def test_import_defers_heavy_modules_and_configuration(tmp_path):
+    # A .env file in the working directory must not be read by importing the pipeline
+    (tmp_path / ".env").write_text('MEDIA_PAGE_SIZE = "7"\n')
+    code = (
+        "import sys, instagram_processor, settings\n"
+        "print(settings._settings is None)\n"
+        f"print(sorted(m for m in {DEFERRED_MODULES!r} if m in sys.modules))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=tmp_path,
+        env={**os.environ, "PYTHONPATH": os.path.dirname(os.path.abspath(__file__))},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.splitlines() == ["True", "[]"]
+
+    # -X importtime lines: "import time: self [us] | cumulative | imported package"
+    cumulative = next(
+        int(line.split("|")[1])
+        for line in result.stderr.splitlines()
+        if line.split("|")[-1].strip() == "instagram_processor"
+    )
+    assert cumulative < IMPORT_TIME_BUDGET_US
@@ -0,0 +1,197 @@
+import asyncio
+import concurrent.futures
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import instagram_processor
+import tracing
+import usage
+
+
+class RecordingExporter:
+    def __init__(self):
+        self.traces = []
+
+    def export(self, spans):
+        self.traces.append(spans)
+
+
+@pytest.fixture
+def exporter():
+    recording_exporter = RecordingExporter()
+    tracing.set_exporter(recording_exporter)
+    yield recording_exporter
+    tracing.set_exporter(None)
+
+
+def test_span_nesting(exporter):
+    with tracing.span("instagram.run", run_id="run", user_id="user") as root:
+        with tracing.span("fetch_data", page_index=None) as child:
+            tracing.set_attributes(pages=2, skipped=None)
+            tracing.event("Fetched Images: 20")
+        with pytest.raises(ValueError):
+            with tracing.span("save_data_to_db"):
+                raise ValueError("db down")
+        # The trace is exported once its root span ends
+        assert exporter.traces == []
+
+    [spans] = exporter.traces
+    assert [span.name for span in spans] == [
+        "fetch_data",
+        "save_data_to_db",
+        "instagram.run",
+    ]
+    assert {span.trace_id for span in spans} == {root.trace_id}
+    assert root.parent_id is None
+    assert child.parent_id == root.span_id
+    # The run_id and user_id are inherited, None attributes are left out
+    assert child.attributes["run_id"] == "run"
+    assert child.attributes["user_id"] == "user"
+    assert child.attributes["pages"] == 2
+    assert "page_index" not in child.attributes
+    assert "skipped" not in child.attributes
+    assert [name for _, name, _ in child.events] == ["Fetched Images: 20"]
+    assert spans[1].error == "ValueError: db down"
+    assert root.start_ns <= child.start_ns <= child.end_ns <= root.end_ns
+    assert tracing.current_span.get() is None
+
+
+def test_span_propagation(exporter):
+    def describe(media_id):
+        with tracing.span("describe_media", media_id=media_id) as span:
+            return span.parent_id, threading.current_thread().name
+
+    async def describe_async():
+        with tracing.span("describe_media_async") as span:
+            return span.parent_id, span.attributes["task.name"]
+
+    with tracing.span("instagram.run", run_id="run") as root:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="worker"
+        ) as executor:
+            in_context = usage.submit_in_context(executor, describe, "1").result()
+            # Submitted without the context, the work starts a trace of its own
+            outside = executor.submit(describe, "2").result()
+        task_parent, task_name = asyncio.run(describe_async())
+
+    assert in_context[0] == root.span_id
+    assert in_context[1].startswith("worker")
+    assert outside[0] is None
+    assert task_parent == root.span_id
+    assert task_name
+
+    run_trace = next(
+        spans for spans in exporter.traces if spans[-1].name == "instagram.run"
+    )
+    assert {span.name for span in run_trace} == {
+        "describe_media",
+        "describe_media_async",
+        "instagram.run",
+    }
+    assert all(span.attributes["run_id"] == "run" for span in run_trace)
+
+
+def test_span_disabled():
+    tracing.set_exporter(None)
+    with tracing.span("instagram.run") as span:
+        assert span is None
+        assert not tracing.recording()
+        tracing.event("not recorded")
+
+
+def test_file_export_shape(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    tracing.set_exporter(tracing.get_exporter("file", path=str(path)))
+    try:
+        with tracing.span("instagram.run", user_id="user", retries=2, ratio=0.5):
+            with tracing.span("fetch_data", incremental=True):
+                tracing.event("page", page_index=1)
+    finally:
+        tracing.set_exporter(None)
+
+    [line] = path.read_text().splitlines()
+    [resource_spans] = json.loads(line)["resourceSpans"]
+    assert resource_spans["resource"]["attributes"] == [
+        {"key": "service.name", "value": {"stringValue": tracing.SERVICE_NAME}}
+    ]
+    [scope_spans] = resource_spans["scopeSpans"]
+    assert scope_spans["scope"] == {"name": "tracing"}
+    child, root = scope_spans["spans"]
+
+    assert root["name"] == "instagram.run"
+    assert "parentSpanId" not in root
+    assert child["parentSpanId"] == root["spanId"]
+    assert child["traceId"] == root["traceId"]
+    assert len(root["traceId"]) == 32 and len(root["spanId"]) == 16
+    assert int(root["startTimeUnixNano"]) <= int(root["endTimeUnixNano"])
+    assert root["status"] == {"code": 1}
+    attributes = {
+        attribute["key"]: attribute["value"] for attribute in root["attributes"]
+    }
+    assert attributes["user_id"] == {"stringValue": "user"}
+    assert attributes["retries"] == {"intValue": "2"}
+    assert attributes["ratio"] == {"doubleValue": 0.5}
+    assert {"key": "incremental", "value": {"boolValue": True}} in child["attributes"]
+    [event] = child["events"]
+    assert event["name"] == "page"
+    assert event["attributes"] == [{"key": "page_index", "value": {"intValue": "1"}}]
+
+
+def test_otlp_http_export():
+    requests_received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            requests_received.append(
+                (self.path, self.headers["Content-Type"], json.loads(body))
+            )
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    tracing.set_exporter(
+        tracing.get_exporter(
+            "otlp", endpoint=f"http://127.0.0.1:{server.server_port}/v1/traces"
+        )
+    )
+    try:
+        with tracing.span("instagram.run"):
+            pass
+    finally:
+        tracing.set_exporter(None)
+        server.shutdown()
+        server.server_close()
+
+    [(path, content_type, body)] = requests_received
+    assert path == "/v1/traces"
+    assert content_type == "application/json"
+    [span] = body["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert span["name"] == "instagram.run"
+
+
+def test_debug_events_redact_tokens(exporter, capsys):
+    # Without a span nothing is recorded
+    instagram_processor.debug("Short-lived token:", {"access_token": "secret"})
+
+    with tracing.span("authorize") as span:
+        instagram_processor.debug(
+            "Short-lived token:", {"access_token": "IGQVJshort", "user_id": 1}
+        )
+        instagram_processor.debug(
+            "Error: 400 Client Error for url: https://graph.instagram.com/access_token"
+            "?grant_type=ig_exchange_token&client_secret=appsecret&access_token=IGQVJlong"
+        )
+
+    messages = [name for _, name, _ in span.events]
+    assert messages == [
+        "Short-lived token: {'access_token': '<redacted>', 'user_id': 1}",
+        "Error: 400 Client Error for url: https://graph.instagram.com/access_token"
+        "?grant_type=ig_exchange_token&client_secret=<redacted>&access_token=<redacted>",
+    ]
+    assert "IGQVJ" not in capsys.readouterr().out
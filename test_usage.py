@@ -0,0 +1,114 @@
+import concurrent.futures
+import pytest
+import usage
+from llm_providers import LLMResponse, LLMUsage
+
+
+def helper_response(prompt_tokens=100, completion_tokens=20):
+    return LLMResponse(
+        content="A description",
+        model="gpt-4o",
+        usage=LLMUsage(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            requests=1,
+        ),
+    )
+
+
+@pytest.mark.parametrize(
+    "total_tokens,level",
+    [
+        (0, "none"),
+        (799, "none"),
+        (800, "low_detail"),
+        (900, "skip_albums"),
+        (1000, "defer"),
+        (5000, "defer"),
+    ],
+)
+def test_usage_budget_degradation(total_tokens, level):
+    budget = usage.UsageBudget(max_tokens=1000)
+    assert budget.degradation(usage.StageUsage(prompt_tokens=total_tokens)) == level
+
+
+def test_usage_budget_uses_the_most_spent_limit():
+    budget = usage.UsageBudget(max_tokens=1000, max_images=10)
+    assert budget.degradation(usage.StageUsage(prompt_tokens=100, images=9)) == (
+        "skip_albums"
+    )
+    # Without limits the budget is never reached
+    assert usage.UsageBudget().degradation(usage.StageUsage(images=10**6)) == "none"
+
+
+def test_usage_tracker_totals():
+    tracker = usage.UsageTracker("test_user_id", prompt_price=2.5, completion_price=10)
+    tracker.record("describe_image", helper_response(), images=1)
+    tracker.record("describe_image", helper_response(), images=1)
+    tracker.record("describe_album", helper_response(200, 40))
+
+    assert tracker.stages["describe_image"] == usage.StageUsage(
+        prompt_tokens=200,
+        completion_tokens=40,
+        requests=2,
+        images=2,
+        cost=pytest.approx((200 * 2.5 + 40 * 10) / 1_000_000),
+    )
+    totals = tracker.totals()
+    assert (totals.total_tokens, totals.requests, totals.images) == (480, 3, 2)
+    assert totals.cost == pytest.approx((400 * 2.5 + 80 * 10) / 1_000_000)
+
+    tracker.finish()
+    assert usage.usage_by_user()["test_user_id"]["requests"] == 3
+    usage.forget_user("test_user_id")
+    assert "test_user_id" not in usage.usage_by_user()
+
+
+def test_degraded_and_skipped_albums():
+    # Outside of a tracked run
+    assert not usage.degraded("low_detail")
+    assert usage.skipped_album_ids() == []
+    assert usage.deferred_media_ids() == []
+
+    tracker = usage.UsageTracker("test_user_id", usage.UsageBudget(max_images=10))
+    with usage.track(tracker):
+        usage.record_response(
+            helper_response(),
+            [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "image_url", "image_url": {"url": "a"}}
+                        for _ in range(9)
+                    ],
+                }
+            ],
+        )
+        assert usage.degraded("low_detail")
+        assert usage.degraded("skip_albums")
+        assert not usage.degraded("defer")
+        usage.skip_album("album_id")
+        assert usage.skipped_album_ids() == ["album_id"]
+        usage.defer("media_id")
+        assert usage.deferred_media_ids() == ["media_id"]
+    assert usage.current_tracker.get() is None
+    assert tracker.as_dict()["degradation"] == "skip_albums"
+
+
+def test_submit_in_context():
+    tracker = usage.UsageTracker("test_user_id")
+
+    def describe():
+        usage.record_response(helper_response(), [{"role": "user", "content": ""}])
+        return usage.current_stage.get()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        with usage.track(tracker), usage.stage("describe_image"):
+            in_context = usage.submit_in_context(executor, describe).result()
+            # Work submitted directly runs outside of the run
+            outside = executor.submit(describe).result()
+
+    assert in_context == "describe_image"
+    assert outside == "other"
+    assert list(tracker.stages) == ["describe_image"]
+    assert tracker.stages["describe_image"].requests == 1
@@ -0,0 +1,171 @@
+import hashlib
+import hmac
+import json
+import threading
+import time
+import webhooks
+
+TEST_APP_SECRET = "test_app_secret"
+
+TEST_NOTIFICATION = {
+    "object": "instagram",
+    "entry": [
+        {
+            "id": "17841400000000000",
+            "time": 1718139585,
+            "changes": [
+                {"field": "media", "value": {"media_id": "18024887825474332"}},
+                {"field": "media", "value": {"id": "18030813908042291"}},
+            ],
+        },
+        {
+            "id": "17841400000000001",
+            "time": 1718139585,
+            "changes": [{"field": "media"}],
+        },
+        {"changes": [{"field": "media", "value": {"media_id": "1"}}]},
+    ],
+}
+
+
+def helper_sign(body: bytes, secret: str = TEST_APP_SECRET) -> str:
+    return "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def test_verify_signature():
+    body = json.dumps(TEST_NOTIFICATION).encode()
+    assert webhooks.verify_signature(body, helper_sign(body), TEST_APP_SECRET)
+    assert not webhooks.verify_signature(
+        body + b" ", helper_sign(body), TEST_APP_SECRET
+    )
+    assert not webhooks.verify_signature(
+        body, helper_sign(body, "other_secret"), TEST_APP_SECRET
+    )
+    assert not webhooks.verify_signature(body, None, TEST_APP_SECRET)
+    assert not webhooks.verify_signature(body, helper_sign(body), "")
+
+
+def test_parse_notification():
+    events = webhooks.parse_notification(TEST_NOTIFICATION)
+    assert events == [
+        webhooks.WebhookEvent("17841400000000000", "media", "18024887825474332"),
+        webhooks.WebhookEvent("17841400000000000", "media", "18030813908042291"),
+        webhooks.WebhookEvent("17841400000000001", "media", None),
+    ]
+    assert webhooks.parse_notification({}) == []
+    # Valid JSON that is not a notification object
+    assert webhooks.parse_notification([TEST_NOTIFICATION]) == []
+    assert webhooks.parse_notification("instagram") == []
+    assert webhooks.parse_notification(None) == []
+
+
+def test_coalescer_coalesces_bursts_per_user():
+    handled = []
+    done = threading.Event()
+
+    def handler(instagram_user_id, media_ids):
+        handled.append((instagram_user_id, media_ids))
+        if len(handled) == 2:
+            done.set()
+
+    coalescer = webhooks.WebhookCoalescer(handler, window=0.05)
+    for media_id in ("1", "2", "2", "3"):
+        coalescer.add([webhooks.WebhookEvent("user_a", "media", media_id)])
+    coalescer.add(
+        [
+            webhooks.WebhookEvent("user_b", "media", "4"),
+            webhooks.WebhookEvent("user_b", "media", None),
+        ]
+    )
+    assert done.wait(2)
+    coalescer.close()
+
+    assert sorted(handled, key=lambda call: call[0]) == [
+        ("user_a", {"1", "2", "3"}),
+        ("user_b", None),
+    ]
+    assert coalescer.stats["batches"] == 2
+    assert coalescer.stats["events"] == 6
+
+
+def test_coalescer_does_not_handle_a_user_twice_at_once():
+    running = []
+    max_running = []
+    handled = []
+    release = threading.Event()
+
+    def handler(instagram_user_id, media_ids):
+        running.append(instagram_user_id)
+        max_running.append(len(running))
+        if not handled:
+            release.wait(2)
+        handled.append(media_ids)
+        running.pop()
+
+    coalescer = webhooks.WebhookCoalescer(handler, window=0.01)
+    coalescer.add([webhooks.WebhookEvent("user_a", "media", "1")])
+    time.sleep(0.1)
+    # Arrives while the first batch is being handled
+    coalescer.add([webhooks.WebhookEvent("user_a", "media", "2")])
+    time.sleep(0.1)
+    release.set()
+    deadline = time.time() + 2
+    while len(handled) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    coalescer.close()
+
+    assert handled == [{"1"}, {"2"}]
+    assert max(max_running) == 1
+
+
+def test_coalescer_close_handles_events_of_a_running_user():
+    handled = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def handler(instagram_user_id, media_ids):
+        handled.append(media_ids)
+        started.set()
+        release.wait(2)
+
+    # The window is long enough that only close() hands the batches out
+    coalescer = webhooks.WebhookCoalescer(handler, window=0.05)
+    coalescer.add([webhooks.WebhookEvent("user_a", "media", "1")])
+    assert started.wait(2)
+    coalescer.window = 60
+    # Arrives while the first batch is being handled, and would be scheduled after the window
+    coalescer.add([webhooks.WebhookEvent("user_a", "media", "2")])
+
+    closing = threading.Thread(target=coalescer.close)
+    closing.start()
+    time.sleep(0.05)
+    release.set()
+    closing.join(2)
+    assert not closing.is_alive()
+
+    assert handled == [{"1"}, {"2"}]
+    assert coalescer.stats["batches"] == 2
+
+    # Events added once closed are dropped rather than submitted to the shut down pool
+    coalescer.add([webhooks.WebhookEvent("user_a", "media", "3")])
+    time.sleep(0.05)
+    assert handled == [{"1"}, {"2"}]
+    assert coalescer.stats["dropped"] == 1
+
+
+def test_coalescer_discard():
+    handled = []
+    coalescer = webhooks.WebhookCoalescer(
+        lambda instagram_user_id, media_ids: handled.append(instagram_user_id),
+        window=0.05,
+    )
+    coalescer.add(
+        [
+            webhooks.WebhookEvent("user_a", "media", "1"),
+            webhooks.WebhookEvent("user_b", "media", "2"),
+        ]
+    )
+    coalescer.discard("user_a")
+    time.sleep(0.2)
+    coalescer.close()
+    assert handled == ["user_b"]
@@ -0,0 +1,284 @@
+import asyncio
+import contextvars
+import json
+import logging
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Optional
+
+"""
+Structured span-based tracing of the pipeline runs, exported as OpenTelemetry (OTLP/JSON) traces.
+
+A span records an operation (a run, a stage, a page of /me/media, the description of a media, a model call) with its
+start and end time, its parent span and its attributes. Every span records the thread it ran on (and the asyncio task,
+if any), and inherits the run_id and user_id of its parent, so each span of a sync can be attributed to it.
+
+The current span is held in a context variable, so spans nest without being passed around: work submitted to thread
+pools through usage.submit_in_context() and asyncio tasks (which copy the context) continue the trace of the code
+that started them. A trace is exported once its root span ends:
+
+    - "file": appended as one ExportTraceServiceRequest JSON per line, the format read by the OpenTelemetry
+      Collector's otlpjsonfile receiver
+    - "otlp": posted to an OTLP/HTTP endpoint, e.g. a local collector or Jaeger at http://127.0.0.1:4318/v1/traces
+    - "off": nothing is traced, and span() only checks whether an exporter is set
+
+Span: A finished or running span.
+FileExporter, OTLPHTTPExporter: The exporters of the finished traces.
+get_exporter(): Create an exporter by name.
+set_exporter(): Set the exporter of the process, None disables tracing.
+span(): Trace the block as a child span of the current span.
+set_attributes(), event(): Annotate the current span.
+recording(): Whether a span is active, so annotations can be skipped when nothing records them.
+"""
+
+TRACE_EXPORTERS = ("off", "file", "otlp")
+# Attributes inherited by the child spans, to filter every span of a sync
+INHERITED_ATTRIBUTES = ("run_id", "user_id")
+SERVICE_NAME = "instagram-processor"
+
+logger = logging.getLogger(__name__)
+
+current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+@dataclass(slots=True)
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str] = None
+    start_ns: int = 0
+    end_ns: int = 0
+    attributes: dict = field(default_factory=dict)
+    events: list = field(default_factory=list)
+    error: Optional[str] = None
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(self.attributes),
+            "events": [
+                {
+                    "timeUnixNano": str(time_ns),
+                    "name": name,
+                    "attributes": _otlp_attributes(attributes),
+                }
+                for time_ns, name, attributes in self.events
+            ],
+            # STATUS_CODE_OK or STATUS_CODE_ERROR
+            "status": (
+                {"code": 2, "message": self.error}
+                if self.error is not None
+                else {"code": 1}
+            ),
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class FileExporter:
+    """Appends each trace to a file, as one OTLP/JSON ExportTraceServiceRequest per line."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans: list[Span]) -> None:
+        line = json.dumps(_export_request(spans))
+        with self._lock, open(self.path, "a") as file:
+            file.write(line + "\n")
+
+
+class OTLPHTTPExporter:
+    """Posts each trace to an OTLP/HTTP traces endpoint, as JSON."""
+
+    def __init__(self, endpoint: str, timeout: float = 5.0) -> None:
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    def export(self, spans: list[Span]) -> None:
+        import requests
+
+        try:
+            requests.post(
+                self.endpoint, json=_export_request(spans), timeout=self.timeout
+            ).raise_for_status()
+        except Exception as e:
+            # A collector that is down must not fail the run
+            logger.warning(f"Failed to export {len(spans)} spans: {e}")
+
+
+def get_exporter(
+    name: str,
+    path: str = "traces.jsonl",
+    endpoint: str = "http://127.0.0.1:4318/v1/traces",
+):
+    """
+    Create an exporter by name.
+
+    Args:
+        name (str): "off", "file" or "otlp" (see TRACE_EXPORTERS).
+        path (str): Optional. The file of the "file" exporter.
+        endpoint (str): Optional. The traces endpoint of the "otlp" exporter.
+
+    Returns:
+        The exporter, None for "off".
+    """
+    if name == "off":
+        return None
+    if name == "file":
+        return FileExporter(path)
+    if name == "otlp":
+        return OTLPHTTPExporter(endpoint)
+    raise ValueError(f"Unknown trace exporter: {name}")
+
+
+_exporter = None
+# Finished spans of the traces whose root span is still running, by trace id
+_pending_spans = {}
+_pending_spans_lock = threading.Lock()
+
+
+def set_exporter(exporter) -> None:
+    global _exporter
+    _exporter = exporter
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Trace the block as a child span of the current span, or as the root span of a new trace.
+    An exception raised by the block marks the span as failed, and is raised again.
+
+    Args:
+        name (str): The name of the span.
+        **attributes: The attributes of the span, e.g. run_id, user_id, page_index or media_id. None values are left out.
+
+    Yields:
+        Span: The span, None when tracing is disabled.
+    """
+    if _exporter is None:
+        yield None
+        return
+
+    parent = current_span.get()
+    thread = threading.current_thread()
+    span_attributes = {
+        key: parent.attributes[key]
+        for key in INHERITED_ATTRIBUTES
+        if parent is not None and key in parent.attributes
+    }
+    span_attributes["thread.id"] = thread.ident
+    span_attributes["thread.name"] = thread.name
+    task = _current_task()
+    if task is not None:
+        span_attributes["task.name"] = task.get_name()
+    span_attributes.update(
+        (key, value) for key, value in attributes.items() if value is not None
+    )
+
+    current = Span(
+        name=name,
+        trace_id=parent.trace_id if parent else secrets.token_hex(16),
+        span_id=secrets.token_hex(8),
+        parent_id=parent.span_id if parent else None,
+        start_ns=time.time_ns(),
+        attributes=span_attributes,
+    )
+    token = current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current_span.reset(token)
+        current.end_ns = time.time_ns()
+        _finish(current)
+
+
+def set_attributes(**attributes) -> None:
+    """Set attributes on the current span (if any). None values are left out."""
+    current = current_span.get()
+    if current is not None:
+        current.attributes.update(
+            (key, value) for key, value in attributes.items() if value is not None
+        )
+
+
+def recording() -> bool:
+    """Whether the current context is within a span (tracing is enabled)."""
+    return current_span.get() is not None
+
+
+def event(name: str, **attributes) -> None:
+    """Add a timestamped event to the current span (if any)."""
+    current = current_span.get()
+    if current is not None:
+        current.events.append((time.time_ns(), name, attributes))
+
+
+def _finish(finished: Span) -> None:
+    with _pending_spans_lock:
+        spans = _pending_spans.setdefault(finished.trace_id, [])
+        spans.append(finished)
+        if finished.parent_id is not None:
+            return
+        del _pending_spans[finished.trace_id]
+    exporter = _exporter
+    if exporter is not None:
+        try:
+            exporter.export(spans)
+        except Exception as e:
+            logger.warning(f"Failed to export trace {finished.trace_id}: {e}")
+
+
+def _current_task() -> Optional[asyncio.Task]:
+    try:
+        return asyncio.current_task()
+    except RuntimeError:  # No running event loop in this thread
+        return None
+
+
+def _export_request(spans: list[Span]) -> dict:
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": _otlp_attributes({"service.name": SERVICE_NAME})
+                },
+                "scopeSpans": [
+                    {
+                        "scope": {"name": __name__},
+                        "spans": [span.to_otlp() for span in spans],
+                    }
+                ],
+            }
+        ]
+    }
+
+
+def _otlp_attributes(attributes: dict) -> list[dict]:
+    otlp_attributes = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            otlp_value = {"boolValue": value}
+        elif isinstance(value, int):
+            otlp_value = {"intValue": str(value)}
+        elif isinstance(value, float):
+            otlp_value = {"doubleValue": value}
+        else:
+            otlp_value = {"stringValue": str(value)}
+        otlp_attributes.append({"key": key, "value": otlp_value})
+    return otlp_attributes
@@ -0,0 +1,274 @@
+import concurrent.futures
+import contextvars
+import threading
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Optional
+from llm_providers import LLMResponse
+
+"""
+Token, image and cost accounting of the model calls, with per-sync budgets.
+
+Every response returned by utils.call_OAI is recorded, with the number of images it was sent, on the tracker of the
+current run under the current stage. Both are held in context variables, so the description functions do not need
+to pass them around; work submitted to thread pools must go through submit_in_context() to keep them.
+
+When a run has a budget, its usage degrades the run gracefully instead of stopping it:
+
+    - "low_detail": images are sent at low detail
+    - "skip_albums": albums are left undescribed, their children are still described
+    - "defer": the remaining media is stored undescribed, marked as deferred, so the next sync (or a batch job) picks it up
+
+UsageBudget: The per-sync limits and the budget fractions at which each degradation starts.
+UsageTracker: Rolls up the usage of a run per stage, and reports its degradation.
+track(): Make a tracker the current one.
+stage(): Record the model calls made within the block under a stage.
+record_response(): Record a response on the current tracker.
+degraded(): Whether the current run reached a degradation level.
+skip_album(), defer(): Report an album left undescribed, or a media deferred, by the current run.
+skipped_album_ids(), deferred_media_ids(): The albums left undescribed, and the media deferred, by the current run.
+submit_in_context(): Submit work to an executor within the current context.
+usage_by_user(): The usage of every finished run, rolled up per user.
+forget_user(): Drop the rolled up usage of a user.
+"""
+
+DEGRADATION_LEVELS = ("none", "low_detail", "skip_albums", "defer")
+
+current_tracker: contextvars.ContextVar[Optional["UsageTracker"]] = (
+    contextvars.ContextVar("current_tracker", default=None)
+)
+current_stage: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "current_stage", default="other"
+)
+
+_usage_by_user = {}
+_usage_by_user_lock = threading.Lock()
+
+
+@dataclass(slots=True)
+class StageUsage:
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    requests: int = 0
+    images: int = 0
+    cost: float = 0.0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, other: "StageUsage") -> None:
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.requests += other.requests
+        self.images += other.images
+        self.cost += other.cost
+
+
+@dataclass(slots=True)
+class UsageBudget:
+    # Per-sync limits, None is unlimited
+    max_tokens: Optional[int] = None
+    max_images: Optional[int] = None
+    max_cost: Optional[float] = None
+    # Fractions of the budget at which each degradation level starts
+    low_detail_at: float = 0.8
+    skip_albums_at: float = 0.9
+    defer_at: float = 1.0
+
+    def degradation(self, usage: StageUsage) -> str:
+        """Return the degradation level (see DEGRADATION_LEVELS) of a usage against the budget."""
+        spent = max(
+            (
+                used / limit
+                for used, limit in (
+                    (usage.total_tokens, self.max_tokens),
+                    (usage.images, self.max_images),
+                    (usage.cost, self.max_cost),
+                )
+                if limit
+            ),
+            default=0.0,
+        )
+        if spent >= self.defer_at:
+            return "defer"
+        if spent >= self.skip_albums_at:
+            return "skip_albums"
+        if spent >= self.low_detail_at:
+            return "low_detail"
+        return "none"
+
+
+class UsageTracker:
+    """
+    Rolls up the usage of a run per stage, and reports its degradation against the budget.
+    Concurrent calls may overshoot the budget by the calls already in flight when it is reached.
+    """
+
+    def __init__(
+        self,
+        user_id: str,
+        budget: UsageBudget = None,
+        prompt_price: float = 0.0,
+        completion_price: float = 0.0,
+    ) -> None:
+        """
+        Args:
+            user_id (str): The user the run belongs to.
+            budget (UsageBudget): Optional. The budget of the run, unlimited by default.
+            prompt_price (float): Optional. The price of a million prompt tokens.
+            completion_price (float): Optional. The price of a million completion tokens.
+        """
+        self.user_id = user_id
+        self.budget = budget or UsageBudget()
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+        self.stages = {}
+        self.deferred_media_ids = []
+        self.skipped_album_ids = []
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, response: LLMResponse, images: int = 0) -> None:
+        usage = StageUsage(
+            prompt_tokens=response.usage.prompt_tokens,
+            completion_tokens=response.usage.completion_tokens,
+            requests=response.usage.requests or 1,
+            images=images,
+            cost=(
+                response.usage.prompt_tokens * self.prompt_price
+                + response.usage.completion_tokens * self.completion_price
+            )
+            / 1_000_000,
+        )
+        with self._lock:
+            self.stages.setdefault(stage, StageUsage()).add(usage)
+
+    def totals(self) -> StageUsage:
+        totals = StageUsage()
+        with self._lock:
+            for usage in self.stages.values():
+                totals.add(usage)
+        return totals
+
+    def degradation(self) -> str:
+        return self.budget.degradation(self.totals())
+
+    def defer(self, media_id: str) -> None:
+        with self._lock:
+            self.deferred_media_ids.append(media_id)
+
+    def skip_album(self, media_id: str) -> None:
+        with self._lock:
+            self.skipped_album_ids.append(media_id)
+
+    def finish(self) -> None:
+        """Add the usage of the run to the per user rollup."""
+        totals = self.totals()
+        with _usage_by_user_lock:
+            _usage_by_user.setdefault(self.user_id, StageUsage()).add(totals)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            stages = {name: asdict(usage) for name, usage in self.stages.items()}
+        return {
+            "user_id": self.user_id,
+            "totals": asdict(self.totals()),
+            "stages": stages,
+            "degradation": self.degradation(),
+            "skipped_album_ids": list(self.skipped_album_ids),
+            "deferred_media_ids": list(self.deferred_media_ids),
+        }
+
+
+@contextmanager
+def track(tracker: UsageTracker):
+    """Make a tracker the current one within the block."""
+    token = current_tracker.set(tracker)
+    try:
+        yield tracker
+    finally:
+        current_tracker.reset(token)
+
+
+@contextmanager
+def stage(name: str):
+    """Record the model calls made within the block under a stage."""
+    token = current_stage.set(name)
+    try:
+        yield
+    finally:
+        current_stage.reset(token)
+
+
+def record_response(response: LLMResponse, messages: list[dict]) -> None:
+    """Record a response, and the number of images its messages contain, on the current tracker (if any)."""
+    tracker = current_tracker.get()
+    if tracker is None:
+        return
+    images = sum(
+        1
+        for message in messages
+        if not isinstance(message["content"], str)
+        for part in message["content"]
+        if part.get("type") == "image_url"
+    )
+    tracker.record(current_stage.get(), response, images)
+
+
+def degraded(level: str) -> bool:
+    """Whether the current run reached a degradation level. Always False outside of a tracked run."""
+    tracker = current_tracker.get()
+    if tracker is None:
+        return False
+    return DEGRADATION_LEVELS.index(tracker.degradation()) >= DEGRADATION_LEVELS.index(
+        level
+    )
+
+
+def skip_album(media_id: str) -> None:
+    tracker = current_tracker.get()
+    if tracker is not None:
+        tracker.skip_album(media_id)
+
+
+def defer(media_id: str) -> None:
+    tracker = current_tracker.get()
+    if tracker is not None:
+        tracker.defer(media_id)
+
+
+def skipped_album_ids() -> list[str]:
+    """The albums left undescribed by the current run. Empty outside of a tracked run."""
+    tracker = current_tracker.get()
+    if tracker is None:
+        return []
+    with tracker._lock:
+        return list(tracker.skipped_album_ids)
+
+
+def deferred_media_ids() -> list[str]:
+    """The media deferred by the current run. Empty outside of a tracked run."""
+    tracker = current_tracker.get()
+    if tracker is None:
+        return []
+    with tracker._lock:
+        return list(tracker.deferred_media_ids)
+
+
+def submit_in_context(
+    executor: concurrent.futures.Executor, fn, *args, **kwargs
+) -> concurrent.futures.Future:
+    """Submit work to an executor within a copy of the current context, so it keeps the current tracker and stage (and the current tracing span)."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def forget_user(user_id: str) -> None:
+    """Drop the rolled up usage of a user, e.g. once their data is purged."""
+    with _usage_by_user_lock:
+        _usage_by_user.pop(user_id, None)
+
+
+def usage_by_user() -> dict[str, dict]:
+    """The usage of every finished run of this process, rolled up per user."""
+    with _usage_by_user_lock:
+        return {user_id: asdict(usage) for user_id, usage in _usage_by_user.items()}
@@ -0,0 +1,212 @@
+import concurrent.futures
+import hashlib
+import hmac
+import logging
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+"""
+Push-style ingestion of Instagram webhook notifications.
+
+Notifications are verified against the X-Hub-Signature-256 header (an HMAC-SHA256 of the raw body keyed with the app
+secret), and parsed into one event per changed media. A burst of notifications for the same user (e.g. an album
+published as several changes, or a retried delivery) is coalesced: the events of a user are collected for a short
+window, then handed to the handler once, with every media id they changed. A user is never handled twice at once,
+events that arrive while the user is being handled are collected for the next window.
+
+WebhookEvent: A change notified for a user, and the media it changed (if any).
+verify_signature(): Verify the signature of a notification.
+parse_notification(): Parse a notification into events.
+WebhookCoalescer: Coalesces the events of each user, and hands them to a handler from a thread pool.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class WebhookEvent:
+    instagram_user_id: str
+    field: str
+    # None when the change does not name a media, the whole account is then synced
+    media_id: Optional[str] = None
+
+
+def verify_signature(body: bytes, signature: Optional[str], app_secret: str) -> bool:
+    """
+    Verify the signature of a webhook notification.
+
+    Args:
+        body (bytes): The raw request body.
+        signature (str): The X-Hub-Signature-256 header, "sha256=<hex digest>".
+        app_secret (str): The app secret the notifications are signed with.
+
+    Returns:
+        bool: True if the signature matches the body.
+    """
+    if not signature or not app_secret or not signature.startswith("sha256="):
+        return False
+    expected = hmac.new(app_secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature.removeprefix("sha256="))
+
+
+def parse_notification(payload: dict) -> list[WebhookEvent]:
+    """
+    Parse a webhook notification into events, one per change.
+
+    Args:
+        payload (dict): The decoded notification, {"object": "instagram", "entry": [{"id", "changes": [{"field", "value"}]}]}.
+
+    Returns:
+        list[WebhookEvent]: the events of the notification. Malformed entries are left out.
+    """
+    if not isinstance(payload, dict):
+        return []
+    events = []
+    for entry in payload.get("entry") or []:
+        if not isinstance(entry, dict) or "id" not in entry:
+            continue
+        for change in entry.get("changes") or []:
+            if not isinstance(change, dict):
+                continue
+            value = change.get("value")
+            media_id = (
+                value.get("media_id") or value.get("id")
+                if isinstance(value, dict)
+                else None
+            )
+            events.append(
+                WebhookEvent(
+                    instagram_user_id=str(entry["id"]),
+                    field=str(change.get("field", "")),
+                    media_id=str(media_id) if media_id else None,
+                )
+            )
+    return events
+
+
+class WebhookCoalescer:
+    """Coalesces the webhook events of each user over a window, and hands each batch to a handler from a thread pool."""
+
+    def __init__(
+        self,
+        handler: Callable[[str, Optional[set[str]]], None],
+        window: float = 10.0,
+        max_workers: int = 4,
+    ) -> None:
+        """
+        Args:
+            handler (Callable): Called with the instagram user id and the set of changed media ids,
+                or None when a change did not name a media and the whole account needs a sync.
+            window (float): Optional. The seconds the events of a user are collected for.
+            max_workers (int): Optional. The maximum number of users handled at once.
+        """
+        self.handler = handler
+        self.window = window
+        self.stats = Counter()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="webhook"
+        )
+        self._lock = threading.Lock()
+        self._pending = {}  # instagram user id: set of media ids, None for a full sync
+        self._timers = {}
+        self._running = set()
+        # Set by close(): no window is started anymore, and once the pending users are handed out nothing is submitted
+        self._closed = False
+        self._stopped = False
+
+    def add(self, events: list[WebhookEvent]) -> None:
+        with self._lock:
+            if self._closed:
+                self.stats["dropped"] += len(events)
+                logger.warning(
+                    f"Dropped {len(events)} webhook events, the coalescer is closed"
+                )
+                return
+            for event in events:
+                self.stats["events"] += 1
+                user_id = event.instagram_user_id
+                if user_id in self._pending:
+                    self.stats["coalesced"] += 1
+                    media_ids = self._pending[user_id]
+                else:
+                    media_ids = self._pending[user_id] = set()
+                if media_ids is None:
+                    continue
+                if event.media_id is None:
+                    self._pending[user_id] = None
+                else:
+                    media_ids.add(event.media_id)
+                self._schedule(user_id)
+
+    def flush(self) -> None:
+        """Hand every pending user to the handler now, without waiting for their window."""
+        with self._lock:
+            for timer in self._timers.values():
+                timer.cancel()
+            self._timers.clear()
+            user_ids = [
+                user_id for user_id in self._pending if user_id not in self._running
+            ]
+        for user_id in user_ids:
+            self._dispatch(user_id)
+
+    def discard(self, instagram_user_id: str) -> None:
+        """Drop the pending events of a user, e.g. whose data is being purged. A batch already being handled still runs."""
+        with self._lock:
+            self._pending.pop(instagram_user_id, None)
+            timer = self._timers.pop(instagram_user_id, None)
+            if timer is not None:
+                timer.cancel()
+
+    def close(self) -> None:
+        """Hand every pending user to the handler, and wait until they are handled. Events added afterwards are dropped."""
+        with self._lock:
+            self._closed = True
+        self.flush()
+        with self._lock:
+            self._stopped = True
+        self._executor.shutdown(wait=True)
+
+    def _schedule(self, user_id: str) -> None:
+        # Called with the lock held. A user being handled is scheduled again once it is done.
+        if self._closed or user_id in self._timers or user_id in self._running:
+            return
+        timer = threading.Timer(self.window, self._dispatch, args=(user_id,))
+        timer.daemon = True
+        self._timers[user_id] = timer
+        timer.start()
+
+    def _dispatch(self, user_id: str) -> None:
+        with self._lock:
+            self._timers.pop(user_id, None)
+            # A window that ends after close() has nothing left to submit to
+            if (
+                self._stopped
+                or user_id not in self._pending
+                or user_id in self._running
+            ):
+                return
+            media_ids = self._pending.pop(user_id)
+            self._running.add(user_id)
+            self.stats["batches"] += 1
+            self._executor.submit(self._handle, user_id, media_ids)
+
+    def _handle(self, user_id: str, media_ids: Optional[set[str]]) -> None:
+        while True:
+            try:
+                self.handler(user_id, media_ids)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Failed to handle webhook events of {user_id}: {e}")
+            with self._lock:
+                # Once closed, the events that arrived while the user was handled are handled now rather than after a window
+                if self._closed and user_id in self._pending:
+                    media_ids = self._pending.pop(user_id)
+                    self.stats["batches"] += 1
+                    continue
+                self._running.discard(user_id)
+                if user_id in self._pending:
+                    self._schedule(user_id)
+                return